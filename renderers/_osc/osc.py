@@ -5,14 +5,15 @@ load_dotenv()
 import asyncio
 import logging
 import os
-import re
+import struct
 from base64 import b64encode
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
+import numpy as np
 import requests
-from fastapi import FastAPI
-from PIL import Image
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
 from pythonosc.osc_packet import OscPacket
 from sse_starlette import ServerSentEvent
 from sse_starlette.sse import EventSourceResponse
@@ -25,10 +26,40 @@ UDP_PORT = 12000
 
 SCREEN_WIDTH = 96
 SCREEN_HEIGHT = 38
+# a frame as the display gets it: 1 bit per pixel, rows of 12 bytes, msb first
+FRAME_SIZE = SCREEN_WIDTH // 8 * SCREEN_HEIGHT
 
 WEB_SERVICE_HOST = os.environ["WEB_SERVICE_HOST"]
 
-queues: list[asyncio.Queue[str]] = []
+# raw frames, each one prefixed with its length as a big-endian uint16 --
+# what the worker asks for with its Accept header. otherwise it's SSE
+FRAMES_MIMETYPE = "application/x-rapidriter-frames"
+
+queues: list[asyncio.Queue[bytes]] = []
+
+
+def decode_frame(message_param_value):
+    """
+    the one argument of an osc message, either
+    - a string of 96x38 "0"s and "1"s, one per pixel, row by row
+    - a blob of the 456 bytes of a frame, already packed (the cheapest to send,
+      and to decode)
+    returns the frame, raises ValueError if it's neither
+    """
+    if isinstance(message_param_value, bytes):
+        if len(message_param_value) != FRAME_SIZE:
+            raise ValueError(f"did not receive a {FRAME_SIZE} byte blob")
+        return message_param_value
+    if type(message_param_value) != str:
+        raise ValueError("received a param value that's neither str nor blob")
+    if len(message_param_value) != (SCREEN_WIDTH * SCREEN_HEIGHT):
+        raise ValueError("did not receive 96x38 byte string")
+    # "0" -> 0, "1" -> 1, anything else (wrapping around below "0") -> more
+    bits = np.frombuffer(message_param_value.encode("ascii", "replace"), np.uint8)
+    bits = bits - ord("0")
+    if (bits > 1).any():
+        raise ValueError("strings contains something other than 0 and 1")
+    return np.packbits(bits).tobytes()
 
 
 class OscUDPServer(asyncio.DatagramProtocol):
@@ -39,8 +70,8 @@ class OscUDPServer(asyncio.DatagramProtocol):
         global queues
 
         osc_packet = OscPacket(data)
-        log.info("Received OSC packet")
-        log.info("OSC messages: %s", osc_packet.messages)
+        # (a frame a packet, possibly 60 of them a second)
+        log.debug("OSC messages: %s", osc_packet.messages)
 
         if len(queues) == 0:
             # we've received a message, but there are no queues consuming it
@@ -64,29 +95,15 @@ class OscUDPServer(asyncio.DatagramProtocol):
                 continue
             message_param_value = osc_message.message.params[0]
             # log.info("message_param_value len: %d", len(message_param_value))
-            if type(message_param_value) != str:
-                log.error("received non-str param value")
-                continue
-            if len(message_param_value) != (SCREEN_WIDTH * SCREEN_HEIGHT):
-                log.error("did not receive 96x38 byte string")
-                continue
-            # check that it only has 0 and 1
-            if re.match(r"^[01]+$", message_param_value) is None:
-                log.error("strings contains something other than 0 and 1")
+            try:
+                image_bytes = decode_frame(message_param_value)
+            except ValueError as e:
+                log.error(str(e))
                 continue
 
-            # at this point, assume that we've received a 96x38 byte string of 0 and 1s
-            # make a binary image
-            image = Image.new("1", (SCREEN_WIDTH, SCREEN_HEIGHT))
-            image.putdata([int(bit) for bit in message_param_value])
-            # get bytes
-            image_bytes = image.tobytes()
-            # base64 encode
-            image_base64 = b64encode(image_bytes).decode("utf-8")
-
             # broadcast frame to all queues
             for queue in queues:
-                queue.put_nowait(image_base64)
+                queue.put_nowait(image_bytes)
 
     def connection_lost(self, exception):
         try:
@@ -114,26 +131,53 @@ async def lifespan(app: FastAPI):
 app = FastAPI(lifespan=lifespan)
 
 
-async def render_stream() -> AsyncGenerator[ServerSentEvent, None]:
+async def frames_stream() -> AsyncGenerator[bytes, None]:
     global queues
     log.info("New HTTP connection for /render")
-    queue: asyncio.Queue[str] = asyncio.Queue()
+    queue: asyncio.Queue[bytes] = asyncio.Queue()
     queues.append(queue)
     try:
         while True:
-            osc_str = await queue.get()
-            yield ServerSentEvent(
-                event="screen_update",
-                data=osc_str,
-            )
+            yield await queue.get()
     finally:
         log.info("HTTP connection for /render disconnected")
         queues.remove(queue)
 
 
+async def render_stream() -> AsyncGenerator[ServerSentEvent, None]:
+    async for frame in frames_stream():
+        yield ServerSentEvent(
+            event="screen_update",
+            data=b64encode(frame).decode("utf-8"),
+        )
+
+
+async def render_binary_stream() -> AsyncGenerator[bytes, None]:
+    # osc frames go on for as long as the worker is connected, so there is
+    # never an end marker
+    async for frame in frames_stream():
+        yield struct.pack(">H", len(frame)) + frame
+
+
+@app.get("/info")
+async def info():
+    # live frames, never to be cached by the worker
+    return {"version": "1", "deterministic": False}
+
+
+# osc frames are live: tell the worker to show them as soon as they come in
+FRAME_RATE_HEADERS = {"X-Frame-Rate": "60"}
+
+
 @app.post("/render")
-async def render():
-    return EventSourceResponse(render_stream())
+async def render(request: Request):
+    if FRAMES_MIMETYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            render_binary_stream(),
+            media_type=FRAMES_MIMETYPE,
+            headers=FRAME_RATE_HEADERS,
+        )
+    return EventSourceResponse(render_stream(), headers=FRAME_RATE_HEADERS)
 
 
 log.info("OSC server running")
@@ -0,0 +1,49 @@
+import struct
+from base64 import b64encode
+
+from flask import Response, request
+
+# how the flask renderers send their frames to the worker (and to web
+# previews), see frames_response. every renderer image has this file next to
+# the renderer, see their Dockerfiles
+#
+# - raw frames, each one prefixed with its length as a big-endian uint16, and
+#   a length of 0 at the end of the show. the worker asks for this with its
+#   Accept header: it's about 3x smaller than base64-in-SSE and there's
+#   nothing to parse or decode, so it's what shows are played from
+# - otherwise SSE as before, the frames base64 encoded in screen_update
+#   events, and an end event
+SSE_MIMETYPE = "text/event-stream"
+FRAMES_MIMETYPE = "application/x-rapidriter-frames"
+FRAME_LENGTH = struct.Struct(">H")
+
+
+def frames_response(frames, frame_rate):
+    """
+    frames must be a generator of raw frames, i.e. mode "1" image.tobytes().
+    frame_rate is how many of those frames should be shown per second -- the
+    worker plays them on its own clock, whatever speed they arrive at
+    """
+    binary = (
+        request.accept_mimetypes.best_match([SSE_MIMETYPE, FRAMES_MIMETYPE])
+        == FRAMES_MIMETYPE
+    )
+
+    def stream():
+        for frame in frames:
+            if binary:
+                yield FRAME_LENGTH.pack(len(frame)) + frame
+            else:
+                frame_base64 = b64encode(frame).decode("utf-8")
+                yield f"event: screen_update\ndata: {frame_base64}\n\n"
+
+        if binary:
+            yield FRAME_LENGTH.pack(0)
+        else:
+            yield "event: end\n\n"
+
+    return Response(
+        stream(),
+        mimetype=FRAMES_MIMETYPE if binary else SSE_MIMETYPE,
+        headers={"X-Frame-Rate": str(frame_rate)},
+    )
@@ -1,12 +1,17 @@
 import logging
 import random
-from base64 import b64encode
+import sys
 from pathlib import Path
 from time import sleep
 
-from flask import Flask, Response, request
+from flask import Flask
 from PIL import Image
 
+# the frame transport, shared by the renderers: ../frames.py in the repo, right
+# next to this file in the renderer's image
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from frames import frames_response  # noqa: E402
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 log.info("Initializing Image")
@@ -18,6 +23,16 @@ log.info("ALL_IMAGES_PATH %s", ALL_IMAGES_PATH)
 app = Flask(__name__)
 
 
+# bump this whenever a change to this renderer changes the frames it produces
+# for a given payload -- the worker caches the frames of deterministic renderers
+RENDERER_VERSION = "1"
+
+
+@app.route("/info")
+def info():
+    return {"version": RENDERER_VERSION, "deterministic": True}
+
+
 @app.route("/render", methods=["POST"])
 def render():
     log.info("image /render endpoint")
@@ -34,19 +49,12 @@ def render():
             # check that size is 96x38
             # log.info("image.size %s", image.size)
             assert image.size == (96, 38)
-            # get png data
-            image_bytes = image.tobytes()
-            # base64 encode
-            image_base64 = b64encode(image_bytes).decode("utf-8")
-            # log.info("image_base64 %s", image_base64[:10] + "...")
-
-            yield f"event: screen_update\ndata: {image_base64}\n\n"
+            yield image.tobytes()
 
             sleep(3)
 
-        yield "event: end\n\n"
-
-    return Response(eventStream(), mimetype="text/event-stream")
+    # one image every 3 seconds
+    return frames_response(eventStream(), frame_rate=1 / 3)
 
 
 if __name__ == "__main__":
@@ -1,39 +1,60 @@
 import random
-from base64 import b64encode
+import sys
+from pathlib import Path
 from time import sleep
 
-from flask import Flask, Response, request
+from flask import Flask, request
 from PIL import Image
 
+# the frame transport, shared by the renderers: ../frames.py in the repo, right
+# next to this file in the renderer's image
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from frames import frames_response  # noqa: E402
+
 app = Flask(__name__)
 
 
+def canvas_size():
+    # the worker says how big its canvas is (several displays side by side,
+    # i.e. 192x38), frames of that size span all of them. a 96x38 frame is
+    # shown on every display
+    width, _, height = request.headers.get("X-Canvas-Size", "96x38").partition("x")
+    return int(width), int(height)
+
+
+RENDERER_VERSION = "1"
+
+
+@app.route("/info")
+def info():
+    # the output isn't the same from one render to the next, so the worker
+    # shouldn't cache it
+    return {"version": RENDERER_VERSION, "deterministic": False}
+
+
 @app.route("/render", methods=["POST"])
 def render():
+    width, height = canvas_size()
+
     def eventStream():
         frames = 1
 
         while True:
-            # generate a 96 x 38 black and white 1 channel image
-            # and fill it with random noise
+            # generate a black and white 1 channel image the size of the
+            # canvas (96 x 38 for a single display) and fill it with random noise
 
-            random_image = Image.new("1", (96, 38))
-            random_image.putdata([random.randint(0, 1) for _ in range(96 * 38)])
-            # get png data
-            random_image_bytes = random_image.tobytes()
-            # base64 encode
-            random_image_base64 = b64encode(random_image_bytes).decode("utf-8")
+            random_image = Image.new("1", (width, height))
+            random_image.putdata([random.randint(0, 1) for _ in range(width * height)])
 
-            yield f"event: screen_update\ndata: {random_image_base64}\n\n"
+            yield random_image.tobytes()
 
             sleep(0.1)
 
             frames += 1
             if frames > 10:
-                yield "event: end\n\n"
                 break
 
-    return Response(eventStream(), mimetype="text/event-stream")
+    return frames_response(eventStream(), frame_rate=10)
 
 
 if __name__ == "__main__":
@@ -1,64 +1,295 @@
-import base64
-import io
+import json
+import logging
+import os
+import struct
 import subprocess
-import tempfile
+import sys
+import threading
+import time
 from pathlib import Path
 from time import sleep
 
-from flask import Flask, Response, request
-from PIL import Image
+from flask import Flask, request
+
+# the frame transport, shared by the renderers: ../frames.py in the repo, right
+# next to this file in the renderer's image
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from frames import frames_response  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+
 SUBRENDERER_JS_PATH = Path(__file__).parent / "subrenderer" / "offline-canvas-p5.js"
 
+# starting node with jsdom and p5 takes seconds on the pi, so shows run in a
+# pool of node processes that have it all set up already (see
+# offline-canvas-p5.js): up to P5_POOL_SIZE of them, P5_WARM_SPARES of which
+# are kept ready for the next show. a process is replaced after P5_MAX_RUNS
+# shows, or once it uses more than P5_MAX_RSS_MB of memory
+P5_POOL_SIZE = int(os.environ.get("P5_POOL_SIZE", "2"))
+P5_WARM_SPARES = int(os.environ.get("P5_WARM_SPARES", "1"))
+P5_MAX_RUNS = int(os.environ.get("P5_MAX_RUNS", "20"))
+P5_MAX_RSS_MB = float(os.environ.get("P5_MAX_RSS_MB", "400"))
+# how long a show waits for a process before it gives up (503)
+P5_ACQUIRE_TIMEOUT_S = float(os.environ.get("P5_ACQUIRE_TIMEOUT_S", "30"))
 
-@app.route("/render", methods=["POST"])
-def render():
-    # get program string as arg
-    program_to_render = request.json["p5"]
+# a show is RENDER_S of frames at RENDER_FPS, drawn on a virtual clock (see
+# offline-canvas-p5.js): as far as the program can tell they're 1 / RENDER_FPS
+# apart, however long node had to wait for the worker to read them -- the
+# worker only reads as many frames ahead as it buffers, and it pre-rolls the
+# next show while one is playing, so on a wall clock the next show would be
+# mostly over by the time it starts, with a jump in millis() where it waited
+RENDER_FPS = 60
+RENDER_S = 30
 
-    # write program to temporary file
-    TMP_PROGRAM_PATH = (Path(tempfile.mkdtemp()) / "program.js").resolve()
-    with open(TMP_PROGRAM_PATH, "w") as f:
-        f.write(program_to_render)
+# /prerender draws a whole show at once, at PRERENDER_FPS unless
+# the request says otherwise, for at most PRERENDER_MAX_S. a program that
+# takes longer than PRERENDER_TIMEOUT_S to draw them (i.e. an endless loop in
+# draw()) is killed
+PRERENDER_FPS = 30
+PRERENDER_MAX_FPS = 60
+PRERENDER_S = 30
+PRERENDER_MAX_S = float(os.environ.get("PRERENDER_MAX_S", "120"))
+PRERENDER_TIMEOUT_S = float(os.environ.get("PRERENDER_TIMEOUT_S", "120"))
 
-    def eventStream():
-        proc = subprocess.Popen(
-            ["node", SUBRENDERER_JS_PATH, TMP_PROGRAM_PATH], stdout=subprocess.PIPE
+# the subrenderer writes frames ready for the display, prefixed with their
+# length like everything else it says, see offline-canvas-p5.js. that goes
+# into a pipe of its own and not stdout, where whatever a program prints
+# (print() is all over p5 sketches) would get in between
+FRAME_SIZE = 96 // 8 * 38
+MESSAGE_LENGTH = struct.Struct(">H")
+
+
+class NodeProcess:
+    def __init__(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            self.proc = subprocess.Popen(
+                ["node", SUBRENDERER_JS_PATH],
+                stdin=subprocess.PIPE,
+                pass_fds=(write_fd,),
+                env={**os.environ, "MESSAGES_FD": str(write_fd)},
+            )
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            # node has it, and the pipe ends when node does
+            os.close(write_fd)
+        self.messages = os.fdopen(read_fd, "rb")
+        self.runs = 0
+        self.rss = 0
+        # whether the last run went all the way (and the process is ready for
+        # the next one)
+        self.finished = False
+
+    def _read_message(self):
+        # None once node is gone
+        header = self.messages.read(MESSAGE_LENGTH.size)
+        if len(header) < MESSAGE_LENGTH.size:
+            return None
+        (length,) = MESSAGE_LENGTH.unpack(header)
+        message = self.messages.read(length)
+        return message if len(message) == length else None
+
+    def wait_until_ready(self):
+        return self._read_message() == b"ready"
+
+    def run(self, program, **options):
+        # yields the frames. options: fps and seconds, for a virtual clock
+        self.runs += 1
+        self.finished = False
+        run = {"program": program, **options}
+        self.proc.stdin.write(json.dumps(run).encode() + b"\n")
+        self.proc.stdin.flush()
+        while (message := self._read_message()) is not None:
+            if len(message) == FRAME_SIZE:
+                yield message
+            elif message.startswith(b"done "):
+                self.rss = int(message[len(b"done ") :])
+                self.finished = True
+                return
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.messages.close()
+
+
+class NodePool:
+    def __init__(self, size, spares, max_runs, max_rss_mb):
+        self.size = size
+        self.spares = spares
+        self.max_runs = max_runs
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.condition = threading.Condition()
+        self.idle = []
+        self.busy = 0
+        self.starting = 0
+        self.waiting = 0
+
+    def _total(self):
+        return len(self.idle) + self.busy + self.starting
+
+    def _start(self):
+        # with the condition held. node starts in the background, the
+        # process goes into idle once it's ready
+        self.starting += 1
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        started_at = time.monotonic()
+        process = None
+        try:
+            process = NodeProcess()
+            ready = process.wait_until_ready()
+        except OSError as e:
+            log.error(f"couldn't start node: {e}")
+            ready = False
+        with self.condition:
+            self.starting -= 1
+            if ready:
+                log.info(f"node ready in {time.monotonic() - started_at:.2f} s")
+                self.idle.append(process)
+            elif process is not None:
+                process.kill()
+            self.condition.notify_all()
+
+    def _top_up(self):
+        # with the condition held: spares for whoever comes next, and a
+        # process for everyone waiting
+        while (
+            len(self.idle) + self.starting < self.spares + self.waiting
+            and self._total() < self.size
+        ):
+            self._start()
+
+    def warm_up(self):
+        with self.condition:
+            self._top_up()
+
+    def acquire(self, timeout):
+        # returns a process that's ready to run a program, or None if there
+        # was none within timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while not self.idle:
+                    self._top_up()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+                process = self.idle.pop()
+                self.busy += 1
+            finally:
+                self.waiting -= 1
+            self._top_up()
+            return process
+
+    def release(self, process):
+        # a process that didn't finish its run (the show was cancelled, node
+        # crashed) is in no state for another one
+        reuse = (
+            process.finished
+            and process.runs < self.max_runs
+            and process.rss < self.max_rss
         )
+        if not reuse:
+            process.kill()
+        with self.condition:
+            self.busy -= 1
+            if reuse:
+                self.idle.append(process)
+            self._top_up()
+            self.condition.notify_all()
+
+
+POOL = NodePool(P5_POOL_SIZE, P5_WARM_SPARES, P5_MAX_RUNS, P5_MAX_RSS_MB)
+
+
+RENDERER_VERSION = "1"
 
-        while True:
-            line = proc.stdout.readline()
-            if not line:
-                break
 
-            raw_data = line.rstrip()
-            if not raw_data:
-                continue
+@app.route("/info")
+def info():
+    # the output isn't the same from one render to the next, so the worker
+    # shouldn't cache it
+    return {"version": RENDERER_VERSION, "deterministic": False}
 
-            # unbase64
-            image_data = base64.b64decode(raw_data)
-            # load image from png data
-            image = Image.open(io.BytesIO(image_data))
 
-            # convert to 1-bit mode --- should we ditter here????????
-            image = image.convert("1")
-            # invert the image white/black
-            image = Image.eval(image, lambda x: not x)
-            image_bytes = image.tobytes()
-            image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+@app.route("/render", methods=["POST"])
+def render():
+    # get program string as arg
+    program_to_render = request.json["p5"]
 
-            yield f"event: screen_update\ndata: {image_base64}\n\n"
+    process = POOL.acquire(P5_ACQUIRE_TIMEOUT_S)
+    if process is None:
+        return {"error": "no p5 renderer free, try again later"}, 503
 
-        # delete temporary program file
-        TMP_PROGRAM_PATH.unlink()
+    def eventStream():
+        # the frames are ready for the display as they come
+        yield from process.run(program_to_render, fps=RENDER_FPS, seconds=RENDER_S)
 
         sleep(0.1)
-        yield "event: end\n\n"
 
-    return Response(eventStream(), mimetype="text/event-stream")
+    response = frames_response(eventStream(), frame_rate=RENDER_FPS)
+    # also when the stream is cut short, or never started
+    response.call_on_close(lambda: POOL.release(process))
+    return response
+
+
+@app.route("/prerender", methods=["POST"])
+def prerender():
+    """
+    the whole show at once, drawn on a virtual clock: as fast as node can go,
+    with frames exactly 1 / fps apart as far as the program can tell (millis(),
+    deltaTime, frameCount). the show plays the same however busy the machine
+    that rendered it was, so it can be rendered once, ahead of time or
+    somewhere else, and replayed
+    """
+    program_to_render = request.json["p5"]
+    fps = min(max(1, float(request.json.get("fps", PRERENDER_FPS))), PRERENDER_MAX_FPS)
+    # at least one frame
+    seconds = float(request.json.get("seconds", PRERENDER_S))
+    seconds = min(max(1 / fps, seconds), PRERENDER_MAX_S)
+
+    process = POOL.acquire(P5_ACQUIRE_TIMEOUT_S)
+    if process is None:
+        return {"error": "no p5 renderer free, try again later"}, 503
+    started_at = time.monotonic()
+    # killing node ends the run (there's nothing more to read), and the pool
+    # replaces the process
+    deadline = threading.Timer(PRERENDER_TIMEOUT_S, process.kill)
+    deadline.start()
+    try:
+        frames = list(process.run(program_to_render, fps=fps, seconds=seconds))
+    finally:
+        deadline.cancel()
+        POOL.release(process)
+    # whatever came before node stopped isn't the show, it mustn't be kept
+    # and replayed as if it were
+    if not process.finished and time.monotonic() - started_at >= PRERENDER_TIMEOUT_S:
+        log.info(f"pre-render killed after {PRERENDER_TIMEOUT_S} s")
+        return {"error": f"took longer than {PRERENDER_TIMEOUT_S} s to render"}, 504
+    if not process.finished:
+        log.info(f"pre-render failed after {len(frames)} frames, node stopped")
+        return {"error": "the program crashed before the show was rendered"}, 502
+    log.info(
+        f"pre-rendered {len(frames)} frames ({len(frames) / fps:.1f} s of show) "
+        f"in {time.monotonic() - started_at:.2f} s"
+    )
+    return frames_response(frames, frame_rate=fps)
 
 
 if __name__ == "__main__":
+    # with debug on, this runs twice: in the reloader, and in the process
+    # that actually serves (which has WERKZEUG_RUN_MAIN set). only that one
+    # needs node processes
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        POOL.warm_up()
     app.run(debug=True, threaded=True, port=80, host="0.0.0.0")
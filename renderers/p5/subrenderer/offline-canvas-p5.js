@@ -1,11 +1,33 @@
 const Window = require("window");
 const fs = require("fs");
+const readline = require("readline");
 const { Blob } = require("./blob.js");
 const { ImageData } = require("canvas");
 
-// get path to program file as argument
+// runs p5 programs without a browser, writing every frame ready for the
+// display (see packFrame) to the file descriptor in MESSAGES_FD (p5.py gives
+// it a pipe of its own), or to stdout. everything written there is a message
+// prefixed with its length (uint16, big endian): FRAME_SIZE bytes is a frame,
+// anything else is a status line. whatever else gets printed (console.log,
+// p5's print()) goes to stderr, so that it can't get in between. two ways to
+// use it:
+//
+// - node offline-canvas-p5.js program.js: runs program.js, then exits
+// - node offline-canvas-p5.js: a warm worker for p5.py's pool. the window and
+//   p5 are set up once, then it says "ready" and runs the programs that come
+//   in on stdin, one json line each ({"program": "..."}). after a run it
+//   cleans up after the program and says "done <rss in bytes>"
+//
+// with {"fps": ..., "seconds": ...} next to the program (p5.py always sends
+// them), a run goes on a virtual clock: as far as the program can tell
+// (millis(), deltaTime, frameCount) its frames are exactly 1000 / fps ms
+// apart, but each one is drawn as soon as the one before is out, until there
+// are fps * seconds of them (or the program stops looping). without them it
+// goes in real time (a frame every 1000 / 60 ms, for RUN_PROGRAM_FOR_SECONDS)
+//
+// a program that throws takes the whole process down, p5.py then starts a
+// fresh one
 const programFilePath = process.argv[2];
-const PROGRAM = fs.readFileSync(programFilePath, "utf8");
 
 // THANKS SO MUCH TO
 // https://stackoverflow.com/a/67434089 !!!!!!!!!!!!!!
@@ -24,39 +46,160 @@ global.Event = global.window.Event;
 global.Image = global.window.Image;
 global.ImageData = ImageData;
 
-const startTime = Date.now();
 const RUN_PROGRAM_FOR_SECONDS = 30;
 
-// this determines how long our program runs!!!
+const WIDTH = 96;
+const HEIGHT = 38;
+const FRAME_SIZE = (WIDTH / 8) * HEIGHT;
+
+const MESSAGES_FD = process.env.MESSAGES_FD
+  ? Number(process.env.MESSAGES_FD)
+  : process.stdout.fd;
+
+for (const method of ["log", "info", "debug"]) {
+  console[method] = console.error;
+}
+
+function send(message) {
+  const length = Buffer.alloc(2);
+  length.writeUInt16BE(message.length);
+  const data = Buffer.concat([length, message]);
+  // blocking, like writes to a pipe on stdout are: a run can't get ahead of
+  // whoever reads the frames
+  let written = 0;
+  while (written < data.length) {
+    try {
+      written += fs.writeSync(MESSAGES_FD, data, written);
+    } catch (e) {
+      if (e.code !== "EAGAIN") {
+        throw e;
+      }
+    }
+  }
+}
+
+function packFrame(rgba, invert) {
+  // rgba: WIDTH x HEIGHT pixels, 4 bytes each, row by row. returns the frame
+  // as the display gets it: 1 bit per pixel, rows of 12 bytes, msb first. it's
+  // exactly what PIL's image.convert("1") does (floyd-steinberg dithering,
+  // down to the rounding), so frames look the same as when they were pngs
+  const frame = Buffer.alloc(FRAME_SIZE);
+  const errors = new Int32Array(WIDTH + 1);
+  for (let y = 0; y < HEIGHT; y++) {
+    let l = 0;
+    let l0 = 0;
+    let l1 = 0;
+    for (let x = 0; x < WIDTH; x++) {
+      const i = (y * WIDTH + x) * 4;
+      const luma = Math.trunc(
+        (rgba[i] * 299 + rgba[i + 1] * 587 + rgba[i + 2] * 114) / 1000
+      );
+      l = Math.min(
+        255,
+        Math.max(0, luma + Math.trunc((l + errors[x + 1]) / 16))
+      );
+      const white = l > 128;
+      if (white !== invert) {
+        frame[y * (WIDTH / 8) + (x >> 3)] |= 0x80 >> (x & 7);
+      }
+      // propagate the error
+      l -= white ? 255 : 0;
+      const l2 = l;
+      const d2 = l + l;
+      l += d2;
+      errors[x] = l + l0;
+      l += d2;
+      l0 = l + l1;
+      l1 = l2;
+      l += d2;
+    }
+    errors[WIDTH] = l0;
+  }
+  return frame;
+}
+
+// the run going on, if any
+let run = null;
+
+function sendFrame(thisRun) {
+  // send it back to the parent process, black on white: the display lights
+  // up what's dark on the canvas
+  const { data } = thisRun.canvas.drawingContext.getImageData(
+    0,
+    0,
+    WIDTH,
+    HEIGHT
+  );
+  send(packFrame(data, true));
+  thisRun.framesSent++;
+}
+
 global.window.requestAnimationFrame = (callback) => {
-  setTimeout(callback, 1000 / 60);
-  if (Date.now() - startTime > RUN_PROGRAM_FOR_SECONDS * 1000) {
-    done();
+  if (!(run && run.frameMs)) {
+    setTimeout(callback, 1000 / 60);
+    return;
   }
+  // on a virtual clock, every tick is a frame, whether p5 drew on it or not
+  // (the program might have asked for a lower frameRate()): p5 asks for the
+  // next one once it's done with this one
+  const thisRun = run;
+  if (thisRun.canvas) {
+    sendFrame(thisRun);
+  }
+  setImmediate(() => {
+    if (run !== thisRun) {
+      return;
+    }
+    if (thisRun.framesSent >= thisRun.frames) {
+      endRun();
+    } else {
+      thisRun.clock += thisRun.frameMs;
+      callback(thisRun.clock);
+    }
+  });
 };
+// p5 goes by window.performance.now() for millis() and deltaTime
+const realPerformanceNow = global.window.performance.now.bind(
+  global.window.performance
+);
+global.window.performance.now = () =>
+  run && run.frameMs ? run.clock : realPerformanceNow();
 
 const p5 = require("p5");
 
-const {
-  setup: userSetup,
-  draw: userDraw,
-  preload: userPreload,
-} = eval(`(function() {
-    // nop
-    var console = {log: function() {}};
-    var createCanvas = function() {};
-
-    ${PROGRAM}
-
-    return {
-      setup: (typeof setup === 'function') ? setup : function() {},
-      draw: (typeof draw === 'function') ? draw : function() {},
-      preload: (typeof preload === 'function') ? preload : function() {}
-    };
-  })()
-`);
+// what global looks like before any program ran, so that whatever a program
+// (or copyPPropsToGlobal) leaves behind can be cleaned up for the next one
+const GLOBALS_BEFORE = Object.getOwnPropertyDescriptors(global);
+const realSetTimeout = setTimeout;
+const realSetInterval = setInterval;
 
-let canvas = null;
+function restoreGlobals() {
+  for (const name of Object.getOwnPropertyNames(global)) {
+    try {
+      if (!(name in GLOBALS_BEFORE)) {
+        delete global[name];
+      } else if (GLOBALS_BEFORE[name].value !== global[name]) {
+        Object.defineProperty(global, name, GLOBALS_BEFORE[name]);
+      }
+    } catch (e) {
+      // not configurable, nothing to do about it
+    }
+  }
+}
+
+function trackTimers(timers) {
+  // every timer of the run (the animation frames too) is cleared at its end
+  global.setTimeout = (...args) => {
+    const timer = realSetTimeout(...args);
+    timers.add(timer);
+    return timer;
+  };
+  global.setInterval = (...args) => {
+    const timer = realSetInterval(...args);
+    timers.add(timer);
+    return timer;
+  };
+}
 
 function copyPPropsToGlobal(p) {
   // add every property found on p onto global
@@ -70,41 +213,104 @@ function copyPPropsToGlobal(p) {
   }
 }
 
-const inst = new p5((p) => {
-  p.preload = function () {
-    // must copy props to global so that `loadImage` is available
-    copyPPropsToGlobal(p);
-
-    userPreload();
+function startRun({ program, fps, seconds }) {
+  const thisRun = {
+    timers: new Set(),
+    ended: false,
+    canvas: null,
+    framesSent: 0,
+    // on a virtual clock: ms between frames, the time now, frames to draw
+    frameMs: fps ? 1000 / fps : null,
+    clock: 0,
+    frames: fps ? Math.round(fps * seconds) : null,
   };
+  run = thisRun;
+  trackTimers(thisRun.timers);
+  if (!thisRun.frameMs) {
+    // this determines how long our program runs!!! (also when it stopped
+    // looping, there's no telling whether it would draw again)
+    thisRun.timers.add(realSetTimeout(endRun, RUN_PROGRAM_FOR_SECONDS * 1000));
+  }
 
-  p.setup = function () {
-    canvas = p.createCanvas(96, 38);
+  const {
+    setup: userSetup,
+    draw: userDraw,
+    preload: userPreload,
+  } = eval(`(function() {
+      // nop
+      var console = {log: function() {}};
+      var createCanvas = function() {};
 
-    // after creating the canvas, `p` will set `width`, `height` and...
-    // other globals..? so copy them once again to the globals.
-    copyPPropsToGlobal(p);
+      ${program}
 
-    userSetup();
-  };
-  p.draw = function () {
-    // update frameCount
-    global.frameCount = p.frameCount;
-
-    userDraw();
-
-    canvas.elt.toBlob((data) => {
-      // send it back to the parent process
-      const canvasData = data.arrayBuffer();
-      // base64 encode it
-      const canvasDataBase64 = Buffer.from(canvasData).toString("base64");
-      // print it + newline
-      console.log(canvasDataBase64);
-    }, "image/png");
-  };
-});
+      return {
+        setup: (typeof setup === 'function') ? setup : function() {},
+        draw: (typeof draw === 'function') ? draw : function() {},
+        preload: (typeof preload === 'function') ? preload : function() {}
+      };
+    })()
+  `);
+
+  thisRun.inst = new p5((p) => {
+    p.preload = function () {
+      // must copy props to global so that `loadImage` is available
+      copyPPropsToGlobal(p);
+
+      userPreload();
+    };
+
+    p.setup = function () {
+      thisRun.canvas = p.createCanvas(WIDTH, HEIGHT);
+
+      // after creating the canvas, `p` will set `width`, `height` and...
+      // other globals..? so copy them once again to the globals.
+      copyPPropsToGlobal(p);
+
+      userSetup();
+    };
+    p.draw = function () {
+      // update frameCount
+      global.frameCount = p.frameCount;
+      global.deltaTime = p.deltaTime;
+
+      userDraw();
+
+      if (!thisRun.frameMs) {
+        sendFrame(thisRun);
+      } else if (!p.isLooping()) {
+        // on a virtual clock, there's no next tick to wait for: nothing would
+        // ever happen after this
+        sendFrame(thisRun);
+        setImmediate(() => run === thisRun && endRun());
+      }
+    };
+  });
+}
+
+function endRun() {
+  if (run.ended) {
+    return;
+  }
+  run.ended = true;
+  run.inst.remove();
+  for (const timer of run.timers) {
+    clearTimeout(timer);
+  }
+  run = null;
+  if (programFilePath) {
+    process.exit(0);
+  }
+  restoreGlobals();
+  send(Buffer.from(`done ${process.memoryUsage().rss}`));
+}
 
-function done() {
-  inst.remove();
-  process.exit(0);
+if (programFilePath) {
+  startRun({ program: fs.readFileSync(programFilePath, "utf8") });
+} else {
+  readline
+    .createInterface({ input: process.stdin })
+    .on("line", (line) => startRun(JSON.parse(line)))
+    // p5.py is gone
+    .on("close", () => process.exit(0));
+  send(Buffer.from("ready"));
 }
@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+import glsl_numpy
+import shader
+
+# checks that glsl_numpy draws what nogl-shader-output (the node path) draws,
+# for the shaders in subrenderer/test/shaders, a bunch of typical shaders, and
+# whatever .frag files are given on the command line. needs npm install in
+# subrenderer:
+#
+#   python compare_with_node.py
+#   python compare_with_node.py my-shader.frag
+#   python compare_with_node.py --bench
+#
+# colors have to be within TOLERANCE of each other (they're float32 in the
+# end, and javascript's Math.sin etc. aren't always numpy's to the last bit),
+# and the frames (after dithering) have to be the same, to the pixel.
+# --bench times a whole show both ways (and with node, the first time and when
+# the program is compiled already)
+#
+# node's frames can be kept in expected/ (one file per shader, the packed
+# frames for TIMES one after the other), to check glsl_numpy against them
+# without node, i.e. where npm install can't run:
+#
+#   python compare_with_node.py --save-expected
+#   python compare_with_node.py --expected
+SUBRENDERER_PATH = Path(__file__).parent / "subrenderer"
+TEST_SHADERS_PATH = SUBRENDERER_PATH / "test" / "shaders"
+EXPECTED_PATH = Path(__file__).parent / "expected"
+TOLERANCE = 1e-5
+TIMES = [0, 0.05, 1.3, 7.5, 19.95]
+
+# the uniforms of test/shaders that aren't the renderer's, as test/index.js
+# sets them
+TEST_UNIFORMS = {
+    "uniforms.frag": {"u_value": [0, 0.25, 0.5, 1], "multiplier": 3.0},
+}
+
+SAMPLES = {
+    "gradient": """
+        precision mediump float;
+        uniform vec2 u_resolution;
+        uniform float u_time;
+        void main() {
+            vec2 st = gl_FragCoord.xy / u_resolution.xy;
+            gl_FragColor = vec4(st.x, st.y, abs(sin(u_time)), 1.0);
+        }
+    """,
+    "plot": """
+        #ifdef GL_ES
+        precision mediump float;
+        #endif
+
+        #define PI 3.14159265359
+
+        uniform vec2 u_resolution;
+        uniform vec2 u_mouse;
+        uniform float u_time;
+
+        float plot(vec2 st, float pct) {
+          return smoothstep(pct - 0.02, pct, st.y) -
+                 smoothstep(pct, pct + 0.02, st.y);
+        }
+
+        void main() {
+            vec2 st = gl_FragCoord.xy / u_resolution;
+            float y = 0.5 + 0.4 * sin(st.x * 2.0 * PI + u_time);
+            vec3 color = vec3(y);
+            float pct = plot(st, y);
+            color = (1.0 - pct) * color + pct * vec3(0.0, 1.0, 0.0);
+            gl_FragColor = vec4(color, 1.0);
+        }
+    """,
+    "circles": """
+        precision mediump float;
+        uniform vec2 u_resolution;
+        uniform float u_time;
+        void main() {
+            vec2 st = gl_FragCoord.xy / u_resolution.xy;
+            st.x *= u_resolution.x / u_resolution.y;
+            vec2 center = vec2(1.25 + sin(u_time) * 0.8, 0.5);
+            float d = distance(st, center);
+            float rings = fract(d * 8.0 - u_time);
+            float inside = step(d, 0.3);
+            gl_FragColor = vec4(vec3(mix(rings, 1.0 - rings, inside)), 1.0);
+        }
+    """,
+    "noise": """
+        precision mediump float;
+        uniform vec2 u_resolution;
+        uniform float u_time;
+
+        float random(vec2 st) {
+            return fract(sin(dot(st.xy, vec2(12.9898, 78.233))) * 43758.5453123);
+        }
+
+        float noise(vec2 st) {
+            vec2 i = floor(st);
+            vec2 f = fract(st);
+            float a = random(i);
+            float b = random(i + vec2(1.0, 0.0));
+            float c = random(i + vec2(0.0, 1.0));
+            float d = random(i + vec2(1.0, 1.0));
+            vec2 u = f * f * (3.0 - 2.0 * f);
+            return mix(a, b, u.x) + (c - a) * u.y * (1.0 - u.x) +
+                   (d - b) * u.x * u.y;
+        }
+
+        void main() {
+            vec2 st = gl_FragCoord.xy / u_resolution.xy;
+            st.x *= u_resolution.x / u_resolution.y;
+            float n = noise(st * 6.0 + vec2(u_time, u_time * 0.3));
+            gl_FragColor = vec4(vec3(n), 1.0);
+        }
+    """,
+    "polar": """
+        precision mediump float;
+        uniform vec2 u_resolution;
+        uniform float u_time;
+        const float TWO_PI = 6.28318530718;
+        void main() {
+            vec2 st = gl_FragCoord.xy / u_resolution.xy - 0.5;
+            st.x *= u_resolution.x / u_resolution.y;
+            float angle = atan(st.y, st.x) + u_time;
+            float radius = length(st) * 2.0;
+            float f = abs(cos(angle * 3.0)) * 0.5 + 0.3;
+            vec3 color = vec3(1.0 - smoothstep(f, f + 0.02, radius));
+            color.gb *= radius < 0.2 ? vec2(0.0) : vec2(1.0);
+            gl_FragColor = vec4(clamp(color, 0.0, 1.0), 1.0);
+        }
+    """,
+}
+
+# draws with nogl-shader-output what glsl_numpy draws, for every set of
+# uniforms, the float32 colors one after the other on stdout
+NODE_DRAW = """
+const ShaderOutput = require(process.env.SUBRENDERER_PATH);
+const input = JSON.parse(require("fs").readFileSync(0, "utf8"));
+const draw = ShaderOutput(input.program, {
+  width: input.width,
+  height: input.height,
+});
+for (const uniforms of input.uniforms) {
+  process.stdout.write(Buffer.from(Float32Array.from(draw(uniforms)).buffer));
+}
+"""
+
+
+def node_draw(program, uniform_sets):
+    output = subprocess.run(
+        ["node", "-e", NODE_DRAW],
+        input=json.dumps(
+            {
+                "program": program,
+                "width": shader.WIDTH,
+                "height": shader.HEIGHT,
+                "uniforms": uniform_sets,
+            }
+        ).encode(),
+        env={**os.environ, "SUBRENDERER_PATH": str(SUBRENDERER_PATH.resolve())},
+        capture_output=True,
+        check=True,
+    ).stdout
+    return np.frombuffer(output, dtype=np.float32).reshape(
+        len(uniform_sets), shader.HEIGHT, shader.WIDTH, 4
+    )
+
+
+def samples(paths):
+    # name -> (program, uniforms for every frame to compare)
+    programs = {}
+    for path in map(Path, paths or sorted(TEST_SHADERS_PATH.glob("*.frag"))):
+        programs[path.name] = (path.read_text(), TEST_UNIFORMS.get(path.name, {}))
+    if not paths:
+        programs.update({name: (program, {}) for name, program in SAMPLES.items()})
+    return {
+        name: (program, [{**shader.uniforms(t), **extra} for t in TIMES])
+        for name, (program, extra) in programs.items()
+    }
+
+
+def expected_path(name):
+    return EXPECTED_PATH / f"{name}.bin"
+
+
+def save_expected(name, program, uniform_sets):
+    EXPECTED_PATH.mkdir(exist_ok=True)
+    frames = [shader.pack_frame(rgba) for rgba in node_draw(program, uniform_sets)]
+    expected_path(name).write_bytes(b"".join(frames))
+    print(f"wrote {expected_path(name).name}")
+
+
+def different_pixels(frame, expected_frame):
+    frame_pixels = [
+        np.unpackbits(np.frombuffer(f, dtype=np.uint8)) for f in (frame, expected_frame)
+    ]
+    return int(np.sum(frame_pixels[0] != frame_pixels[1]))
+
+
+def compare(name, program, uniform_sets, with_node=True):
+    uniform_types = {
+        uniform: glsl_numpy.VECTOR_TYPES[np.size(value)]
+        for uniform, value in uniform_sets[0].items()
+    }
+    try:
+        compiled = glsl_numpy.compile_shader(
+            program, shader.WIDTH, shader.HEIGHT, uniform_types
+        )
+    except glsl_numpy.UnsupportedShader as e:
+        print(f"skip {name}: not in the subset, it goes to node ({e})")
+        return True
+
+    if with_node:
+        expected_colors = node_draw(program, uniform_sets)
+        expected_frames = [shader.pack_frame(rgba) for rgba in expected_colors]
+    elif expected_path(name).exists():
+        expected_colors = [None] * len(uniform_sets)
+        data = expected_path(name).read_bytes()
+        expected_frames = [
+            data[i : i + shader.FRAME_SIZE]
+            for i in range(0, len(data), shader.FRAME_SIZE)
+        ]
+    else:
+        print(f"FAIL {name}: nothing in {EXPECTED_PATH.name}/, see --save-expected")
+        return False
+
+    ok = True
+    for uniforms, expected_rgba, expected_frame in zip(
+        uniform_sets, expected_colors, expected_frames
+    ):
+        got_rgba = compiled.draw(uniforms)
+        if expected_rgba is not None:
+            same = np.isclose(got_rgba, expected_rgba, rtol=0, atol=TOLERANCE)
+            same |= np.isnan(got_rgba) & np.isnan(expected_rgba)
+            if not same.all():
+                ok = False
+                worst = np.nanmax(np.abs(got_rgba - expected_rgba))
+                print(
+                    f"FAIL {name} at u_time {uniforms['u_time']}: "
+                    f"{np.sum(~same)} colors off, by up to {worst}"
+                )
+        pixels = different_pixels(shader.pack_frame(got_rgba), expected_frame)
+        if pixels:
+            ok = False
+            print(
+                f"FAIL {name} at u_time {uniforms['u_time']}: "
+                f"{pixels} pixels differ after dithering"
+            )
+    if ok:
+        print(f"ok   {name}")
+    return ok
+
+
+def node_show(program):
+    # as shader.py runs it, on the processes of its pool
+    processes = shader.POOL.acquire(shader.SHADER_ACQUIRE_TIMEOUT_S)
+    for first_frame, process in enumerate(processes):
+        process.start(program, first_frame, len(processes))
+    for process in processes:
+        for _ in process.frames():
+            pass
+    shader.POOL.release(processes)
+
+
+def bench(name, program):
+    try:
+        compiled = glsl_numpy.compile_shader(
+            program, shader.WIDTH, shader.HEIGHT, shader.UNIFORM_TYPES
+        )
+    except glsl_numpy.UnsupportedShader:
+        return
+    started_at = time.perf_counter()
+    frame_count = sum(1 for _ in shader.numpy_frames(compiled))
+    numpy_s = time.perf_counter() - started_at
+
+    node_s = []
+    for _ in range(2):
+        started_at = time.perf_counter()
+        node_show(program)
+        node_s.append(time.perf_counter() - started_at)
+
+    print(
+        f"{name}: {frame_count} frames, numpy {numpy_s:.2f} s "
+        f"({numpy_s / frame_count * 1000:.2f} ms per frame), node "
+        f"{node_s[0]:.2f} s / {node_s[1]:.2f} s compiled already, with "
+        f"{shader.SHADER_PROCESSES} processes. numpy is {node_s[1] / numpy_s:.0f}x "
+        "faster"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="glsl_numpy vs nogl-shader-output")
+    parser.add_argument("paths", nargs="*", help=".frag files")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument("--bench", action="store_true", help="time whole shows")
+    modes.add_argument(
+        "--save-expected", action="store_true", help="write node's frames to expected/"
+    )
+    modes.add_argument(
+        "--expected", action="store_true", help="compare with expected/, no node"
+    )
+    args = parser.parse_args()
+
+    programs = samples(args.paths)
+    if args.bench:
+        shader.POOL.warm_up()
+        while len(shader.POOL.idle) < shader.SHADER_PROCESSES:
+            time.sleep(0.1)
+        for name, (program, _) in programs.items():
+            bench(name, program)
+        return
+    if args.save_expected:
+        for name, (program, uniform_sets) in programs.items():
+            save_expected(name, program, uniform_sets)
+        return
+    failed = 0
+    for name, (program, uniform_sets) in programs.items():
+        if not compare(name, program, uniform_sets, with_node=not args.expected):
+            failed += 1
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,787 @@
+import math
+import re
+
+import numpy as np
+
+# runs the common subset of glsl fragment shaders with numpy, on the whole
+# canvas at once instead of a pixel at a time like nogl-shader-output does:
+#
+#   shader = compile_shader(source, 96, 38, {"u_time": "float"})
+#   rgba = shader.draw({"u_time": 1.5})
+#
+# what's in the subset: float and vec2/3/4 math, swizzles (also on the left of
+# an assignment), constructors, the usual builtins (sin, fract, mix, step,
+# smoothstep, length, ...), ?: and comparisons, uniforms, gl_FragCoord,
+# globals, #define constants, and functions of your own that are a list of
+# declarations and assignments with a return at the end. what's not: if, for
+# and while, ints, matrices, textures, out parameters, varyings. those raise
+# UnsupportedShader when compiling, and the shader renderer uses node instead.
+#
+# every value is a tuple of components, one per vector component, each one a
+# (height, width) float64 array or -- as long as it's the same for every
+# pixel -- a numpy scalar. float64 because nogl runs on javascript numbers,
+# and it's all type checked when compiling, so that a shader that compiles
+# draws
+
+
+class UnsupportedShader(Exception):
+    pass
+
+
+TYPES = {"float": 1, "vec2": 2, "vec3": 3, "vec4": 4, "bool": 1}
+VECTOR_TYPES = {1: "float", 2: "vec2", 3: "vec3", 4: "vec4"}
+SWIZZLE_SETS = ("xyzw", "rgba", "stpq")
+# a qualifier that changes nothing here
+QUALIFIERS = {"const", "highp", "mediump", "lowp"}
+
+TOKEN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+    | (?P<name>[A-Za-z_]\w*)
+    | (?P<op>\+\+|--|[-+*/]=|==|!=|<=|>=|&&|\|\||[-+*/<>=!?:(){}\[\],;.])
+    """,
+    re.VERBOSE,
+)
+COMMENTS = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+
+# the preprocessor directives that don't matter here
+IGNORED_DIRECTIVES = {"version", "extension", "pragma"}
+
+
+def _preprocess(source):
+    # comments out, then #define (constants only), #ifdef / #ifndef / #else /
+    # #endif. GL_ES is defined, it's glsl es
+    defines = {"GL_ES": []}
+    # for each #if*: whether its lines are in
+    including = []
+    lines = []
+    for line in COMMENTS.sub(" ", source).splitlines():
+        stripped = line.strip()
+        if not stripped.startswith("#"):
+            if all(including):
+                lines.append(line)
+            continue
+        directive, *rest = stripped[1:].split(None, 1)
+        rest = rest[0].strip() if rest else ""
+        if directive in ("if", "elif"):
+            raise UnsupportedShader(f"#{directive}")
+        if directive in ("ifdef", "ifndef"):
+            including.append((rest in defines) == (directive == "ifdef"))
+        elif directive == "else" and including:
+            including[-1] = not including[-1]
+        elif directive == "endif" and including:
+            including.pop()
+        elif not all(including) or directive in IGNORED_DIRECTIVES:
+            pass
+        elif directive == "define":
+            name, *value = rest.split(None, 1)
+            value = value[0] if value else ""
+            if not re.fullmatch(r"[A-Za-z_]\w*", name):
+                raise UnsupportedShader(f"#define {name} (macros with arguments)")
+            defines[name] = _tokenize(value)
+        elif directive == "undef":
+            defines.pop(rest, None)
+        else:
+            raise UnsupportedShader(f"#{directive}")
+    if including:
+        raise UnsupportedShader("#ifdef without #endif")
+    return _expand(_tokenize("\n".join(lines)), defines)
+
+
+def _tokenize(source):
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = TOKEN.match(source, position)
+        if match is None:
+            raise UnsupportedShader(f"can't read {source[position:position + 10]!r}")
+        position = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+def _expand(tokens, defines, depth=0):
+    if depth > 16:
+        raise UnsupportedShader("#defines nested too deep")
+    expanded = []
+    for kind, value in tokens:
+        if kind == "name" and value in defines:
+            expanded += _expand(defines[value], defines, depth + 1)
+        else:
+            expanded.append((kind, value))
+    return expanded
+
+
+class Parser:
+    """
+    tokens -> uniforms, globals and functions, with expressions and statements
+    as tuples: ("num", value), ("name", name), ("call", name, args),
+    ("field", expr, swizzle), ("index", expr, i), ("unary", op, expr),
+    ("binary", op, a, b), ("ternary", condition, a, b), and ("decl", type,
+    [(name, expr or None), ...]), ("assign", op, target, expr), ("return", expr)
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset][1]
+        return None
+
+    def next(self):
+        if self.position >= len(self.tokens):
+            raise UnsupportedShader("unexpected end of the program")
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def expect(self, value):
+        _, got = self.next()
+        if got != value:
+            raise UnsupportedShader(f"expected {value!r}, got {got!r}")
+
+    def name(self):
+        kind, value = self.next()
+        if kind != "name":
+            raise UnsupportedShader(f"expected a name, got {value!r}")
+        return value
+
+    def type(self):
+        while self.peek() in QUALIFIERS:
+            self.next()
+        type_name = self.name()
+        if type_name not in TYPES and type_name != "void":
+            raise UnsupportedShader(f"type {type_name}")
+        return type_name
+
+    def program(self):
+        uniforms, global_decls, functions = {}, [], {}
+        while self.position < len(self.tokens):
+            if self.peek() == "precision":
+                while self.next()[1] != ";":
+                    pass
+            elif self.peek() == ";":
+                self.next()
+            elif self.peek() == "uniform":
+                self.next()
+                type_name = self.type()
+                uniforms[self.name()] = type_name
+                while self.peek() == ",":
+                    self.next()
+                    uniforms[self.name()] = type_name
+                self.expect(";")
+            elif self.peek() in ("varying", "attribute", "struct"):
+                raise UnsupportedShader(self.peek())
+            else:
+                type_name = self.type()
+                if self.peek(1) == "(":
+                    name, function = self.function(type_name)
+                    if function is None:
+                        # a prototype
+                        continue
+                    if name in functions:
+                        raise UnsupportedShader(f"overloaded function {name}")
+                    functions[name] = function
+                else:
+                    global_decls.append(self.declaration(type_name))
+        return uniforms, global_decls, functions
+
+    def function(self, return_type):
+        name = self.name()
+        self.expect("(")
+        params = []
+        while self.peek() != ")":
+            if self.peek() in ("out", "inout"):
+                raise UnsupportedShader(f"{self.peek()} parameters")
+            if self.peek() == "in":
+                self.next()
+            type_name = self.type()
+            if type_name == "void":
+                break
+            params.append((type_name, self.name()))
+            if self.peek() == ",":
+                self.next()
+        self.expect(")")
+        if self.peek() == ";":
+            self.next()
+            return name, None
+        self.expect("{")
+        body = []
+        while self.peek() != "}":
+            body.append(self.statement())
+        self.expect("}")
+        return name, (return_type, params, body)
+
+    def statement(self):
+        if self.peek() in ("if", "for", "while", "do", "switch", "discard", "{"):
+            raise UnsupportedShader(f"{self.peek()} statements")
+        if self.peek() == "return":
+            self.next()
+            value = None if self.peek() == ";" else self.expression()
+            self.expect(";")
+            return ("return", value)
+        if self.peek() in TYPES or self.peek() in QUALIFIERS:
+            return self.declaration(self.type())
+        if self.peek() in ("int", "mat2", "mat3", "mat4", "sampler2D"):
+            raise UnsupportedShader(f"type {self.peek()}")
+        target = self.postfix()
+        op = self.next()[1]
+        if op not in ("=", "+=", "-=", "*=", "/="):
+            raise UnsupportedShader(f"statement with {op!r}")
+        value = self.expression()
+        self.expect(";")
+        return ("assign", op, target, value)
+
+    def declaration(self, type_name):
+        declarators = []
+        while True:
+            name = self.name()
+            if self.peek() == "[":
+                raise UnsupportedShader("arrays")
+            value = None
+            if self.peek() == "=":
+                self.next()
+                value = self.expression()
+            declarators.append((name, value))
+            if self.peek() != ",":
+                break
+            self.next()
+        self.expect(";")
+        return ("decl", type_name, declarators)
+
+    # expressions, lowest precedence first
+    def expression(self):
+        condition = self.binary(0)
+        if self.peek() != "?":
+            return condition
+        self.next()
+        a = self.expression()
+        self.expect(":")
+        b = self.expression()
+        return ("ternary", condition, a, b)
+
+    PRECEDENCE = [
+        ("||",),
+        ("&&",),
+        ("==", "!="),
+        ("<", ">", "<=", ">="),
+        ("+", "-"),
+        ("*", "/"),
+    ]
+
+    def binary(self, level):
+        if level == len(self.PRECEDENCE):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.peek() in self.PRECEDENCE[level]:
+            op = self.next()[1]
+            left = ("binary", op, left, self.binary(level + 1))
+        return left
+
+    def unary(self):
+        if self.peek() in ("-", "+", "!"):
+            op = self.next()[1]
+            return ("unary", op, self.unary())
+        if self.peek() in ("++", "--"):
+            raise UnsupportedShader(f"{self.peek()}")
+        return self.postfix()
+
+    def postfix(self):
+        kind, value = self.next()
+        if kind == "number":
+            node = ("num", value)
+        elif kind == "name":
+            if self.peek() == "(":
+                self.next()
+                args = []
+                while self.peek() != ")":
+                    args.append(self.expression())
+                    if self.peek() == ",":
+                        self.next()
+                self.expect(")")
+                node = ("call", value, args)
+            else:
+                node = ("name", value)
+        elif value == "(":
+            node = self.expression()
+            self.expect(")")
+        else:
+            raise UnsupportedShader(f"unexpected {value!r}")
+
+        while self.peek() in (".", "[", "++", "--"):
+            op = self.next()[1]
+            if op == ".":
+                node = ("field", node, self.name())
+            elif op == "[":
+                kind, index = self.next()
+                if kind != "number" or not index.isdigit():
+                    raise UnsupportedShader("indexing with anything but a number")
+                self.expect("]")
+                node = ("index", node, int(index))
+            else:
+                raise UnsupportedShader(op)
+        return node
+
+
+def _broadcast_sizes(name, types):
+    # genType functions and operators: vectors of one size, and floats
+    sizes = {TYPES[t] for t in types}
+    if "bool" in types or len(sizes - {1}) > 1:
+        raise UnsupportedShader(f"{name} on {', '.join(types)}")
+    return max(sizes)
+
+
+def _componentwise(function):
+    def apply(size, *values):
+        columns = [v if len(v) == size else v * size for v in values]
+        return tuple(function(*components) for components in zip(*columns))
+
+    return apply
+
+
+def _step(edge, x):
+    return np.where(x < edge, 0.0, 1.0)
+
+
+def _smoothstep(edge0, edge1, x):
+    t = np.minimum(np.maximum((x - edge0) / (edge1 - edge0), 0.0), 1.0)
+    return t * t * (3.0 - 2.0 * t)
+
+
+# name: (function of the components, number of arguments). they go component
+# by component, with floats going along with vectors
+COMPONENTWISE = {
+    "sin": (np.sin, 1),
+    "cos": (np.cos, 1),
+    "tan": (np.tan, 1),
+    "asin": (np.arcsin, 1),
+    "acos": (np.arccos, 1),
+    "exp": (np.exp, 1),
+    "log": (np.log, 1),
+    "exp2": (np.exp2, 1),
+    "log2": (np.log2, 1),
+    "sqrt": (np.sqrt, 1),
+    "inversesqrt": (lambda x: 1.0 / np.sqrt(x), 1),
+    "abs": (np.abs, 1),
+    "sign": (np.sign, 1),
+    "floor": (np.floor, 1),
+    "ceil": (np.ceil, 1),
+    "fract": (lambda x: x - np.floor(x), 1),
+    "radians": (lambda x: x * (math.pi / 180), 1),
+    "degrees": (lambda x: x * (180 / math.pi), 1),
+    "pow": (np.power, 2),
+    "mod": (lambda x, y: x - y * np.floor(x / y), 2),
+    "min": (np.minimum, 2),
+    "max": (np.maximum, 2),
+    "step": (_step, 2),
+    "clamp": (lambda x, low, high: np.minimum(np.maximum(x, low), high), 3),
+    "mix": (lambda x, y, a: x * (1.0 - a) + y * a, 3),
+    "smoothstep": (_smoothstep, 3),
+}
+
+
+def _sum(values):
+    total = values[0]
+    for value in values[1:]:
+        total = total + value
+    return total
+
+
+def _length(v):
+    return np.sqrt(_sum([c * c for c in v]))
+
+
+def _dot(a, b):
+    return _sum([x * y for x, y in zip(a, b)])
+
+
+BINARY_OPS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.divide,
+}
+COMPARISONS = {
+    "<": np.less,
+    ">": np.greater,
+    "<=": np.less_equal,
+    ">=": np.greater_equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+}
+
+
+class Compiler:
+    """
+    turns the parsed program into closures: every expression becomes
+    (type, function(env) -> tuple of components), env being [globals, locals]
+    """
+
+    def __init__(self, uniforms, global_decls, functions, uniform_types):
+        self.functions = functions
+        self.compiled_functions = {}
+        # name -> type, for what's visible to every function
+        self.global_types = {"gl_FragCoord": "vec4", "gl_FragColor": "vec4"}
+        for name, type_name in uniforms.items():
+            if uniform_types.get(name) != type_name:
+                raise UnsupportedShader(f"uniform {type_name} {name} isn't set")
+            self.global_types[name] = type_name
+        self.uniforms = list(uniforms)
+        self.global_statements = []
+        for decl in global_decls:
+            self.global_statements.append(self.statement(decl, None))
+
+        if "main" not in functions:
+            raise UnsupportedShader("no main()")
+        return_type, params, _ = functions["main"]
+        if return_type != "void" or params:
+            raise UnsupportedShader("main() has to be void main()")
+        self.main = self.function("main")
+
+    def function(self, name):
+        if name in self.compiled_functions:
+            if self.compiled_functions[name] is None:
+                raise UnsupportedShader(f"{name}() calls itself")
+            return self.compiled_functions[name]
+        if name not in self.functions:
+            raise UnsupportedShader(f"function {name}")
+        # until it's done (recursion isn't allowed in glsl)
+        self.compiled_functions[name] = None
+        return_type, params, body = self.functions[name]
+        local_types = {param_name: t for t, param_name in params}
+        statements = []
+        returns = None
+        for i, statement in enumerate(body):
+            if statement[0] == "return":
+                if i != len(body) - 1:
+                    raise UnsupportedShader(f"return before the end of {name}()")
+                if statement[1] is not None:
+                    value_type, returns = self.expression(statement[1], local_types)
+                    if value_type != return_type:
+                        raise UnsupportedShader(f"{name}() returns {value_type}")
+            else:
+                statements.append(self.statement(statement, local_types))
+        if return_type != "void" and returns is None:
+            raise UnsupportedShader(f"{name}() doesn't end with a return")
+
+        param_names = [param_name for _, param_name in params]
+        param_types = [t for t, _ in params]
+
+        def call(env_globals, args):
+            env = [env_globals, dict(zip(param_names, args))]
+            for statement in statements:
+                statement(env)
+            return returns(env) if returns is not None else ()
+
+        self.compiled_functions[name] = (return_type, param_types, call)
+        return self.compiled_functions[name]
+
+    def statement(self, statement, local_types):
+        # local_types is None for the global declarations
+        kind = statement[0]
+        if kind == "decl":
+            _, type_name, declarators = statement
+            setters = []
+            for name, value in declarators:
+                if value is None:
+                    zeros = (np.float64(0),) * TYPES[type_name]
+                    setters.append((name, lambda env, zeros=zeros: zeros))
+                else:
+                    value_type, function = self.expression(value, local_types)
+                    if value_type != type_name:
+                        raise UnsupportedShader(f"{type_name} {name} = {value_type}")
+                    setters.append((name, function))
+                if local_types is None:
+                    self.global_types[name] = type_name
+                else:
+                    local_types[name] = type_name
+            scope = 0 if local_types is None else 1
+
+            def declare(env):
+                for name, function in setters:
+                    env[scope][name] = function(env)
+
+            return declare
+
+        _, op, target, value = statement
+        target_type, target_value = self.expression(target, local_types)
+        if op != "=":
+            value = ("binary", op[0], target, value)
+        value_type, function = self.expression(value, local_types)
+        if value_type != target_type:
+            raise UnsupportedShader(f"{target_type} {op} {value_type}")
+        return self.assignment(target, local_types, function)
+
+    def assignment(self, target, local_types, function):
+        # components: which of the variable's components get assigned, None
+        # for all of them
+        components = None
+        if target[0] in ("field", "index"):
+            base = target[1]
+            if target[0] == "field":
+                components = self.swizzle(target[2], self._type_of(base, local_types))
+                if len(set(components)) != len(components):
+                    raise UnsupportedShader(f"assigning to .{target[2]}")
+            else:
+                components = [target[2]]
+            target = base
+        if target[0] != "name":
+            raise UnsupportedShader("assigning to an expression")
+        name = target[1]
+        if local_types is not None and name in local_types:
+            scope = 1
+        elif name in self.global_types and name not in self.uniforms:
+            scope = 0
+        else:
+            raise UnsupportedShader(f"assigning to {name}")
+
+        if components is None:
+
+            def assign(env):
+                env[scope][name] = function(env)
+
+        else:
+
+            def assign(env):
+                current = list(env[scope][name])
+                for i, component in zip(components, function(env)):
+                    current[i] = component
+                env[scope][name] = tuple(current)
+
+        return assign
+
+    def _type_of(self, node, local_types):
+        return self.expression(node, local_types)[0]
+
+    def swizzle(self, swizzle, type_name):
+        if type_name not in ("vec2", "vec3", "vec4"):
+            raise UnsupportedShader(f".{swizzle} on {type_name}")
+        for letters in SWIZZLE_SETS:
+            if all(c in letters[: TYPES[type_name]] for c in swizzle):
+                if len(swizzle) > 4:
+                    break
+                return [letters.index(c) for c in swizzle]
+        raise UnsupportedShader(f".{swizzle} on {type_name}")
+
+    def expression(self, node, local_types):
+        kind = node[0]
+        if kind == "num":
+            value = (np.float64(node[1]),)
+            return "float", lambda env: value
+
+        if kind == "name":
+            name = node[1]
+            if name in ("true", "false"):
+                value = (np.bool_(name == "true"),)
+                return "bool", lambda env: value
+            if local_types is not None and name in local_types:
+                return local_types[name], lambda env: env[1][name]
+            if name in self.global_types:
+                return self.global_types[name], lambda env: env[0][name]
+            raise UnsupportedShader(f"unknown name {name}")
+
+        if kind == "field":
+            base_type, base = self.expression(node[1], local_types)
+            components = self.swizzle(node[2], base_type)
+
+            def field(env):
+                value = base(env)
+                return tuple(value[i] for i in components)
+
+            return VECTOR_TYPES[len(components)], field
+
+        if kind == "index":
+            base_type, base = self.expression(node[1], local_types)
+            i = node[2]
+            if base_type not in ("vec2", "vec3", "vec4") or i >= TYPES[base_type]:
+                raise UnsupportedShader(f"[{i}] on {base_type}")
+            return "float", lambda env: (base(env)[i],)
+
+        if kind == "unary":
+            op = node[1]
+            value_type, value = self.expression(node[2], local_types)
+            if op == "!":
+                if value_type != "bool":
+                    raise UnsupportedShader(f"! on {value_type}")
+                return "bool", lambda env: (np.logical_not(value(env)[0]),)
+            if value_type == "bool":
+                raise UnsupportedShader(f"{op} on bool")
+            if op == "+":
+                return value_type, value
+            return value_type, lambda env: tuple(-c for c in value(env))
+
+        if kind == "binary":
+            return self.binary(node, local_types)
+
+        if kind == "ternary":
+            condition_type, condition = self.expression(node[1], local_types)
+            a_type, a = self.expression(node[2], local_types)
+            b_type, b = self.expression(node[3], local_types)
+            if condition_type != "bool" or a_type != b_type:
+                raise UnsupportedShader(f"{condition_type} ? {a_type} : {b_type}")
+
+            def ternary(env):
+                (c,) = condition(env)
+                return tuple(np.where(c, x, y) for x, y in zip(a(env), b(env)))
+
+            return a_type, ternary
+
+        if kind == "call":
+            return self.call(node, local_types)
+
+        raise UnsupportedShader(kind)
+
+    def binary(self, node, local_types):
+        _, op, a_node, b_node = node
+        a_type, a = self.expression(a_node, local_types)
+        b_type, b = self.expression(b_node, local_types)
+
+        if op in ("&&", "||"):
+            if a_type != "bool" or b_type != "bool":
+                raise UnsupportedShader(f"{a_type} {op} {b_type}")
+            logical = np.logical_and if op == "&&" else np.logical_or
+            return "bool", lambda env: (logical(a(env)[0], b(env)[0]),)
+
+        if op in COMPARISONS:
+            if a_type != "float" or b_type != "float":
+                raise UnsupportedShader(f"{a_type} {op} {b_type}")
+            compare = COMPARISONS[op]
+            return "bool", lambda env: (compare(a(env)[0], b(env)[0]),)
+
+        size = _broadcast_sizes(op, [a_type, b_type])
+        apply = _componentwise(BINARY_OPS[op])
+        return VECTOR_TYPES[size], lambda env: apply(size, a(env), b(env))
+
+    def call(self, node, local_types):
+        _, name, arg_nodes = node
+        compiled = [self.expression(arg, local_types) for arg in arg_nodes]
+        types = [t for t, _ in compiled]
+        args = [function for _, function in compiled]
+
+        if name in ("float", "vec2", "vec3", "vec4"):
+            size = TYPES[name]
+            if "bool" in types or not args:
+                raise UnsupportedShader(f"{name}({', '.join(types)})")
+            if types == ["float"]:
+                # vec3(x) is (x, x, x)
+                return name, lambda env: args[0](env) * size
+            if sum(TYPES[t] for t in types) < size:
+                raise UnsupportedShader(f"{name}({', '.join(types)})")
+
+            def construct(env):
+                components = ()
+                for arg in args:
+                    components += arg(env)
+                return components[:size]
+
+            return name, construct
+
+        if name in COMPONENTWISE:
+            function, arg_count = COMPONENTWISE[name]
+            if len(args) != arg_count:
+                raise UnsupportedShader(f"{name} with {len(args)} arguments")
+            size = _broadcast_sizes(name, types)
+            apply = _componentwise(function)
+            return VECTOR_TYPES[size], lambda env: apply(
+                size, *(arg(env) for arg in args)
+            )
+
+        if name == "atan":
+            if len(args) not in (1, 2):
+                raise UnsupportedShader(f"atan with {len(args)} arguments")
+            size = _broadcast_sizes(name, types)
+            # atan(y, x) is atan2
+            function = np.arctan2 if len(args) == 2 else np.arctan
+            apply = _componentwise(function)
+            return VECTOR_TYPES[size], lambda env: apply(
+                size, *(arg(env) for arg in args)
+            )
+
+        if name in ("length", "distance", "dot", "normalize", "cross"):
+            return self.geometric(name, types, args)
+
+        if name in self.functions:
+            return_type, param_types, call = self.function(name)
+            if param_types != types:
+                raise UnsupportedShader(f"{name}({', '.join(types)})")
+            return return_type, lambda env: call(env[0], [arg(env) for arg in args])
+
+        raise UnsupportedShader(f"function {name}")
+
+    def geometric(self, name, types, args):
+        vector_count = {"length": 1, "normalize": 1}.get(name, 2)
+        if len(args) != vector_count or "bool" in types or len(set(types)) != 1:
+            raise UnsupportedShader(f"{name}({', '.join(types)})")
+        if name == "length":
+            return "float", lambda env: (_length(args[0](env)),)
+        if name == "distance":
+            return "float", lambda env: (
+                _length([x - y for x, y in zip(args[0](env), args[1](env))]),
+            )
+        if name == "dot":
+            return "float", lambda env: (_dot(args[0](env), args[1](env)),)
+        if name == "normalize":
+
+            def normalize(env):
+                v = args[0](env)
+                length = _length(v)
+                return tuple(c / length for c in v)
+
+            return types[0], normalize
+        if types[0] != "vec3":
+            raise UnsupportedShader(f"cross({', '.join(types)})")
+
+        def cross(env):
+            (ax, ay, az), (bx, by, bz) = args[0](env), args[1](env)
+            return (ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx)
+
+        return "vec3", cross
+
+
+class Shader:
+    def __init__(self, compiler, width, height):
+        self.compiler = compiler
+        self.width, self.height = width, height
+        # rows from the bottom, like gl (and nogl-shader-output's output)
+        x, y = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+        self.frag_coord = (x, y, np.float64(1), np.float64(1))
+
+    def draw(self, uniforms):
+        """
+        returns the frag colors as (height, width, 4) float32, the bottom row
+        first, like nogl-shader-output's draw() (which returns them flat)
+        """
+        env_globals = {
+            "gl_FragCoord": self.frag_coord,
+            "gl_FragColor": (np.float64(0),) * 4,
+        }
+        for name in self.compiler.uniforms:
+            value = np.atleast_1d(np.asarray(uniforms[name], dtype=np.float64))
+            env_globals[name] = tuple(value)
+        env = [env_globals, {}]
+        # shaders divide by zero and take the sqrt of negative numbers all the
+        # time, it's inf and nan like on a gpu (or in javascript)
+        with np.errstate(all="ignore"):
+            for statement in self.compiler.global_statements:
+                statement(env)
+            self.compiler.main[2](env_globals, [])
+            color = env_globals["gl_FragColor"]
+            rgba = np.empty((self.height, self.width, 4), dtype=np.float32)
+            for i, component in enumerate(color):
+                rgba[..., i] = component
+        return rgba
+
+
+def compile_shader(source, width, height, uniform_types):
+    """
+    uniform_types: the uniforms that draw() will be given, name -> type (e.g.
+    "vec2"). raises UnsupportedShader if the shader is outside of the subset
+    """
+    tokens = _preprocess(source)
+    uniforms, global_decls, functions = Parser(tokens).program()
+    return Shader(
+        Compiler(uniforms, global_decls, functions, uniform_types), width, height
+    )
@@ -1,66 +1,328 @@
-import base64
-import io
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import struct
 import subprocess
-import tempfile
+import sys
+import threading
+import time
 from pathlib import Path
 from time import sleep
 
-from flask import Flask, Response, request
+import numpy as np
+from flask import Flask, request
 from PIL import Image
 
+import glsl_numpy
+
+# the frame transport, shared by the renderers: ../frames.py in the repo, right
+# next to this file in the renderer's image
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from frames import frames_response  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
+
 SUBRENDERER_JS_PATH = Path(__file__).parent / "subrenderer" / "shader-nogl-renderer.js"
+# the subrenderer writes frames ready for the display, prefixed with their
+# length like everything else it says, see shader-nogl-renderer.js
+FRAME_SIZE = 96 // 8 * 38
+MESSAGE_LENGTH = struct.Struct(">H")
 
+# frames only depend on their time, so a show is rendered by up to this many
+# node processes at once (one per core by default): with n of them, process k
+# renders frames k, k + n, k + 2n, ...
+SHADER_PROCESSES = int(os.environ.get("SHADER_PROCESSES", os.cpu_count() or 1))
+# the node processes stay up from one show to the next, and keep the
+# SHADER_CACHE_SIZE programs they ran last compiled (so does glsl_numpy, here):
+# a shader that comes back around the playlist starts drawing right away
+SHADER_CACHE_SIZE = int(os.environ.get("SHADER_CACHE_SIZE", "32"))
+# how long a show waits for a node process before it gives up (503)
+SHADER_ACQUIRE_TIMEOUT_S = float(os.environ.get("SHADER_ACQUIRE_TIMEOUT_S", "30"))
 
-@app.route("/render", methods=["POST"])
-def render():
-    # get program string as arg
-    program_to_render = request.json["shader"]
+# with SHADER_NUMPY=true, shaders that glsl_numpy can run (most of them) are
+# drawn right here, a whole frame at a time, the rest go to node. it's off
+# until compare_with_node.py has been run against node and its expected/
+# frames are in the repo -- until then everything goes to node
+SHADER_NUMPY = os.environ.get("SHADER_NUMPY", "false") == "true"
 
-    # write program to temporary file
-    TMP_PROGRAM_PATH = (Path(tempfile.mkdtemp()) / "program.js").resolve()
-    with open(TMP_PROGRAM_PATH, "w") as f:
-        f.write(program_to_render)
+WIDTH = 96
+HEIGHT = 38
+# what shader-nogl-renderer.js gives the shader
+UNIFORM_TYPES = {"u_time": "float", "u_resolution": "vec2", "u_mouse": "vec2"}
 
-    def eventStream():
-        proc = subprocess.Popen(
-            ["node", SUBRENDERER_JS_PATH, TMP_PROGRAM_PATH], stdout=subprocess.PIPE
+
+# bump this whenever a change to this renderer changes the frames it produces
+# for a given payload -- the worker caches the frames of deterministic renderers
+RENDERER_VERSION = "3"
+
+
+def uniforms(u_time):
+    return {"u_mouse": (0.5, 0.5), "u_resolution": (WIDTH, HEIGHT), "u_time": u_time}
+
+
+def pack_frame(rgba):
+    # rgba: what a shader drew, (HEIGHT, WIDTH, 4) floats from the bottom row
+    # up. returns the frame the way shader-nogl-renderer.js packs it: clamped to
+    # 0-255 (nan is 0), dithered bottom row first, then flipped
+    channels = np.trunc(255 * rgba[..., :3].astype(np.float64))
+    channels = np.nan_to_num(channels, nan=0, posinf=255, neginf=0)
+    rgb = np.clip(channels, 0, 255).astype(np.uint8)
+    # pillow's floyd-steinberg is packFrame's, to the rounding (and a lot
+    # faster than that loop in python)
+    image = Image.fromarray(rgb, "RGB").convert("1")
+    return image.transpose(Image.Transpose.FLIP_TOP_BOTTOM).tobytes()
+
+
+def numpy_frames(shader):
+    # the same times as shader-nogl-renderer.js, rounding errors included
+    u_time = 0
+    while u_time < 20:
+        yield pack_frame(shader.draw(uniforms(u_time)))
+        u_time += 0.05
+
+
+@functools.lru_cache(maxsize=SHADER_CACHE_SIZE)
+def compile_numpy_shader(program):
+    # None if it has to go to node
+    if not SHADER_NUMPY:
+        return None
+    try:
+        shader = glsl_numpy.compile_shader(program, WIDTH, HEIGHT, UNIFORM_TYPES)
+    except glsl_numpy.UnsupportedShader as e:
+        log.info(f"shader goes to node: {e}")
+        return None
+    return shader
+
+
+class NodeProcess:
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            ["node", SUBRENDERER_JS_PATH],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env={**os.environ, "SHADER_CACHE_SIZE": str(SHADER_CACHE_SIZE)},
         )
+        # whether the last job went all the way (and the process is ready for
+        # the next one)
+        self.finished = False
+        # when it last finished a job, the longer ago the fewer of the shaders
+        # that are playing it has compiled (0: none at all)
+        self.last_used_at = 0
+
+    def _read_message(self):
+        # None once node is gone
+        header = self.proc.stdout.read(MESSAGE_LENGTH.size)
+        if len(header) < MESSAGE_LENGTH.size:
+            return None
+        (length,) = MESSAGE_LENGTH.unpack(header)
+        message = self.proc.stdout.read(length)
+        return message if len(message) == length else None
+
+    def wait_until_ready(self):
+        return self._read_message() == b"ready"
 
-        while True:
-            line = proc.stdout.readline()
-            if not line:
-                break
+    def start(self, program, first_frame, frame_stride):
+        # node gets going right away, frames() reads what it renders
+        self.finished = False
+        job = {"program": program, "first": first_frame, "stride": frame_stride}
+        try:
+            self.proc.stdin.write(json.dumps(job).encode() + b"\n")
+            self.proc.stdin.flush()
+        except OSError as e:
+            # node is gone, frames() finds nothing
+            log.error(f"couldn't send a shader to node: {e}")
 
-            raw_data = line.rstrip()
-            if not raw_data:
+    def frames(self):
+        while (message := self._read_message()) is not None:
+            if len(message) == FRAME_SIZE:
+                # dithered, and mirrored vertically (bottom is top) already
+                yield message
                 continue
+            if message.startswith(b"error "):
+                log.error(f"shader failed: {message[len(b'error ') :].decode()}")
+            self.finished = True
+            return
 
-            # unbase64
-            image_data = base64.b64decode(raw_data)
-            # load image from png data
-            image = Image.open(io.BytesIO(image_data))
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
 
-            # convert to 1-bit mode --- should we ditter here????????
-            image = image.convert("1")
-            # invert the image white/black
-            # image = Image.eval(image, lambda x: not x)
-            # mirror vertically - bottom is top
-            image = image.transpose(Image.FLIP_TOP_BOTTOM)
-            image_bytes = image.tobytes()
-            image_base64 = base64.b64encode(image_bytes).decode("utf-8")
 
-            yield f"event: screen_update\ndata: {image_base64}\n\n"
+class NodePool:
+    def __init__(self, size):
+        self.size = size
+        self.condition = threading.Condition()
+        self.idle = []
+        self.busy = 0
+        self.starting = 0
+        # acquires waiting for processes
+        self.waiting = 0
 
-        # delete temporary program file
-        TMP_PROGRAM_PATH.unlink()
+    def _start(self):
+        # with the condition held. node starts in the background, the
+        # process goes into idle once it's ready
+        self.starting += 1
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        started_at = time.monotonic()
+        process = None
+        try:
+            process = NodeProcess()
+            ready = process.wait_until_ready()
+        except OSError as e:
+            log.error(f"couldn't start node: {e}")
+            ready = False
+        with self.condition:
+            self.starting -= 1
+            if ready:
+                log.info(f"node ready in {time.monotonic() - started_at:.2f} s")
+                self.idle.append(process)
+            elif process is not None:
+                process.kill()
+            self.condition.notify_all()
+
+    def _top_up(self):
+        # with the condition held
+        while len(self.idle) + self.busy + self.starting < self.size:
+            self._start()
+
+    def warm_up(self):
+        with self.condition:
+            self._top_up()
+
+    def acquire(self, timeout):
+        # returns some of the processes that are ready (at least one), or []
+        # if there was none within timeout. with other shows waiting, the
+        # ready ones are shared with them instead of all going to this one,
+        # and a show that finds every process busy starts one more for itself
+        # (past size, it goes away once it's not needed), so that it doesn't
+        # have to wait for the others to finish
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while True:
+                    # one that crashed while idle is replaced
+                    self.idle = [p for p in self.idle if p.proc.poll() is None]
+                    if self.idle:
+                        break
+                    self._top_up()
+                    if self.starting < self.waiting:
+                        self._start()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return []
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            share = max(1, len(self.idle) // (self.waiting + 1))
+            # the ones that were used last first, they're the likeliest to have
+            # the shader compiled already
+            self.idle.sort(key=lambda process: process.last_used_at, reverse=True)
+            processes, self.idle = self.idle[:share], self.idle[share:]
+            self.busy += len(processes)
+            return processes
+
+    def release(self, processes):
+        # a process that didn't finish its job (the show was cancelled, node
+        # crashed) is in no state for another one
+        for process in processes:
+            if process.finished:
+                process.last_used_at = time.monotonic()
+            else:
+                process.kill()
+        with self.condition:
+            self.busy -= len(processes)
+            self.idle += [process for process in processes if process.finished]
+            # back down to size (unless someone's waiting for them), by getting
+            # rid of the ones that weren't used for the longest
+            while (
+                len(self.idle) > self.waiting
+                and len(self.idle) + self.busy + self.starting > self.size
+            ):
+                coldest = min(self.idle, key=lambda process: process.last_used_at)
+                self.idle.remove(coldest)
+                coldest.kill()
+            self._top_up()
+            self.condition.notify_all()
+
+
+POOL = NodePool(SHADER_PROCESSES)
+
+
+@app.route("/info")
+def info():
+    return {"version": RENDERER_VERSION, "deterministic": True}
+
+
+@app.route("/render", methods=["POST"])
+def render():
+    # get program string as arg
+    program_to_render = request.json["shader"]
+
+    shader = compile_numpy_shader(program_to_render)
+    if shader is not None:
+        return frames_response(numpy_frames(shader), frame_rate=20)
+
+    processes = POOL.acquire(SHADER_ACQUIRE_TIMEOUT_S)
+    if not processes:
+        return {"error": "no shader renderer free, try again later"}, 503
+    for first_frame, process in enumerate(processes):
+        process.start(program_to_render, first_frame, len(processes))
+
+    # the frames are read from node as fast as it renders them, into memory
+    # (a whole show is 400 frames, ~180 KB), and not as fast as the worker
+    # plays them: that way the processes go back to the pool as soon as the
+    # show is rendered, warm for the next one (which the worker asks for
+    # while this one is still playing), and not when it's done playing
+    rendered = queue.SimpleQueue()
+
+    def render_show():
+        try:
+            frames = [process.frames() for process in processes]
+            # frame i comes from process i % n. the frames that are done ahead
+            # of their turn wait in their process's pipe (that's the reorder
+            # buffer, ~140 frames each), so every frame goes out as soon as it
+            # and the ones before it are ready. the show ends at the first
+            # frame that doesn't come
+            for frame_index in itertools.count():
+                frame = next(frames[frame_index % len(frames)], None)
+                if frame is None:
+                    break
+                rendered.put(frame)
+            # the other processes are done too (or failed), this reads their
+            # "done"
+            for process_frames in frames:
+                for _ in process_frames:
+                    pass
+        finally:
+            POOL.release(processes)
+            rendered.put(None)
+
+    threading.Thread(target=render_show, daemon=True).start()
+
+    def eventStream():
+        while (frame := rendered.get()) is not None:
+            yield frame
 
         sleep(0.01)
-        yield "event: end\n\n"
 
-    return Response(eventStream(), mimetype="text/event-stream")
+    # shader-nogl-renderer.js advances u_time by 0.05 per frame
+    return frames_response(eventStream(), frame_rate=20)
 
 
 if __name__ == "__main__":
+    # with debug on, this runs twice: in the reloader, and in the process
+    # that actually serves (which has WERKZEUG_RUN_MAIN set). only that one
+    # needs node processes
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        POOL.warm_up()
     app.run(debug=True, threaded=True, port=80, host="0.0.0.0")
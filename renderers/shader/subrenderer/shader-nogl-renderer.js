@@ -1,51 +1,144 @@
+const crypto = require("crypto");
 const fs = require("fs");
-var zeros = require("zeros");
-var savePixels = require("save-pixels");
+const readline = require("readline");
 var ShaderOutput = require(".");
 
+// renders frames first, first + n, first + 2n, ... of a show (by default, all
+// of them), so that shader.py can have n of these going at once, one per
+// core, and put their frames back in order. two ways to use it:
+//
+// - node shader-nogl-renderer.js program.glsl [first frame] [every nth frame]:
+//   renders, then exits
+// - node shader-nogl-renderer.js: stays up for shader.py's pool. it says
+//   "ready", then renders the jobs that come in on stdin, one json line each
+//   ({"program": "...", "first": 0, "stride": 1}), and says "done" after each
+//   one (or "error <what went wrong>")
+//
+// either way, everything on stdout is prefixed with its length (uint16, big
+// endian): FRAME_SIZE bytes is a frame, anything else is a status line. the
+// last SHADER_CACHE_SIZE programs stay compiled, so a shader that comes back
+// around is drawn right away
 const programFilePath = process.argv[2];
-const PROGRAM = fs.readFileSync(programFilePath, "utf8");
-
-// parse the glsl!!!!!!!!!!!!!!!!!!!!
-var draw = ShaderOutput(PROGRAM, {
-  width: 96,
-  height: 38,
-});
-
-function streamToString(stream) {
-  const chunks = [];
-  return new Promise((resolve, reject) => {
-    stream.on("data", (chunk) => chunks.push(Buffer.from(chunk)));
-    stream.on("error", (err) => reject(err));
-    stream.on("end", () => resolve(Buffer.concat(chunks)));
-  });
+const FIRST_FRAME = parseInt(process.argv[3] || "0", 10);
+const FRAME_STRIDE = parseInt(process.argv[4] || "1", 10);
+const SHADER_CACHE_SIZE = parseInt(process.env.SHADER_CACHE_SIZE || "32", 10);
+
+const WIDTH = 96;
+const HEIGHT = 38;
+const FRAME_SIZE = (WIDTH / 8) * HEIGHT;
+
+// draw functions by the sha256 of their program, least recently used first
+const compiled = new Map();
+
+function compile(program) {
+  const key = crypto.createHash("sha256").update(program).digest("hex");
+  let draw = compiled.get(key);
+  if (draw) {
+    compiled.delete(key);
+  } else {
+    // parse the glsl!!!!!!!!!!!!!!!!!!!!
+    draw = ShaderOutput(program, {
+      width: WIDTH,
+      height: HEIGHT,
+    });
+    if (compiled.size >= SHADER_CACHE_SIZE) {
+      compiled.delete(compiled.keys().next().value);
+    }
+  }
+  compiled.set(key, draw);
+  return draw;
+}
+
+function send(message) {
+  const length = Buffer.alloc(2);
+  length.writeUInt16BE(message.length);
+  process.stdout.write(Buffer.concat([length, message]));
 }
 
-async function main() {
-  for (let time = 0; time < 20; time += 0.05) {
+function packFrame(rgba) {
+  // rgba: WIDTH x HEIGHT pixels, 4 bytes each, row by row from the bottom
+  // (that's where gl puts y = 0). returns the frame as the display gets it:
+  // 1 bit per pixel, rows of 12 bytes from the top, msb first. it's exactly
+  // what PIL's image.convert("1") does (floyd-steinberg dithering, down to
+  // the rounding), so frames look the same as when they were pngs
+  const frame = Buffer.alloc(FRAME_SIZE);
+  const errors = new Int32Array(WIDTH + 1);
+  for (let y = 0; y < HEIGHT; y++) {
+    const frameRow = (HEIGHT - 1 - y) * (WIDTH / 8);
+    let l = 0;
+    let l0 = 0;
+    let l1 = 0;
+    for (let x = 0; x < WIDTH; x++) {
+      const i = (y * WIDTH + x) * 4;
+      const luma = Math.trunc(
+        (rgba[i] * 299 + rgba[i + 1] * 587 + rgba[i + 2] * 114) / 1000
+      );
+      l = Math.min(
+        255,
+        Math.max(0, luma + Math.trunc((l + errors[x + 1]) / 16))
+      );
+      const white = l > 128;
+      if (white) {
+        frame[frameRow + (x >> 3)] |= 0x80 >> (x & 7);
+      }
+      // propagate the error
+      l -= white ? 255 : 0;
+      const l2 = l;
+      const d2 = l + l;
+      l += d2;
+      errors[x] = l + l0;
+      l += d2;
+      l0 = l + l1;
+      l1 = l2;
+      l += d2;
+    }
+    errors[WIDTH] = l0;
+  }
+  return frame;
+}
+
+function render(draw, firstFrame, frameStride) {
+  const rgba = new Uint8Array(WIDTH * HEIGHT * 4);
+  // time goes up the same way for every process (adding up 0.05s, rounding
+  // errors included), whichever frames it renders, so that the frames are the
+  // same however many processes there are
+  let frame = 0;
+  for (let time = 0; time < 20; time += 0.05, frame++) {
+    if (frame < firstFrame || (frame - firstFrame) % frameStride !== 0) {
+      continue;
+    }
     //returns the frag color as [R, G, B, A]
     var color = draw({
       u_mouse: [0.5, 0.5],
-      u_resolution: [96, 38],
+      u_resolution: [WIDTH, HEIGHT],
       u_time: time,
     });
 
-    //Create an image
-    var x = zeros([96, 38, 4]);
-
-    // iterate through 'color' which is an array of [r, g, b, a, r, g, b, a, etc.]
-    for (var i = 0; i < color.length; i += 4) {
-      var j = i / 4;
-      x.set(j % 96, Math.floor(j / 96), 0, 255 * color[i]);
-      x.set(j % 96, Math.floor(j / 96), 1, 255 * color[i + 1]);
-      x.set(j % 96, Math.floor(j / 96), 2, 255 * color[i + 2]);
-      x.set(j % 96, Math.floor(j / 96), 3, 255 * color[i + 3]);
+    // colors are floats, 0 to 1 -- and clamped to that, like a gpu would
+    for (let i = 0; i < color.length; i++) {
+      rgba[i] = Math.min(255, Math.max(0, Math.trunc(255 * color[i]))) || 0;
     }
-
-    // base64 pipe convert, then console log
-    const imageData = await streamToString(savePixels(x, "png"));
-    console.log(Buffer.from(imageData).toString("base64"));
+    send(packFrame(rgba));
   }
 }
 
-main();
+if (programFilePath) {
+  const program = fs.readFileSync(programFilePath, "utf8");
+  render(compile(program), FIRST_FRAME, FRAME_STRIDE);
+} else {
+  readline
+    .createInterface({ input: process.stdin })
+    .on("line", (line) => {
+      const { program, first, stride } = JSON.parse(line);
+      try {
+        render(compile(program), first, stride);
+        send(Buffer.from("done"));
+      } catch (e) {
+        // (kept short, so that it can't pass for a frame)
+        send(Buffer.from(`error ${e}`.slice(0, 100)));
+      }
+    })
+    // shader.py is gone
+    .on("close", () => process.exit(0));
+  send(Buffer.from("ready"));
+}
@@ -0,0 +1,94 @@
+import argparse
+import hashlib
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+import text
+
+# checks that text.draw_caption (TEXT_RASTERIZER=pil) draws the same pixels as
+# the imagemagick command text.py runs by default, for a bunch of texts (and whatever is given on the
+# command line). needs imagemagick 7 (for the negative interline spacing):
+#
+#   python compare_with_magick.py
+#   python compare_with_magick.py "some text" "some other text"
+#
+# or against what imagemagick drew for SAMPLES once, kept in golden/ -- no
+# imagemagick needed:
+#
+#   python compare_with_magick.py --golden
+#
+# golden/ is (re)written with --update-golden, by Dockerfile.golden (which
+# builds imagemagick 7 the way this renderer's image does):
+#
+#   cd renderers && docker build -f text/Dockerfile.golden --output text/golden .
+GOLDEN_PATH = Path(__file__).parent / "golden"
+SAMPLES = [
+    "hello",
+    "Hello, World!",
+    "send 3648 chars of 0 and 1 by osc to 10.100.7.28 port 12000",
+    "a verylongwordthatdoesnotfitononelineatall and then some",
+    "two  spaces   and three, at the end of a line like this one",
+    "line one\\nline two\\n\\nline four",
+    "0123456789 !\"#$%&'()*+,-./:;<=>?@[]^_`{|}~",
+    "the quick brown fox jumps over the lazy dog THE QUICK BROWN FOX JUMPS "
+    "OVER THE LAZY DOG, long enough to scroll all the way down the display",
+]
+
+
+def golden_path(text_to_render):
+    name = hashlib.sha256(text_to_render.encode("utf-8")).hexdigest()[:16]
+    return GOLDEN_PATH / f"{name}.png"
+
+
+def show(image):
+    return "\n".join(
+        "".join("#" if image.getpixel((x, y)) else "." for x in range(image.width))
+        for y in range(image.height)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="text.py vs imagemagick")
+    parser.add_argument("texts", nargs="*", default=SAMPLES)
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument(
+        "--golden", action="store_true", help="compare with golden/, no imagemagick"
+    )
+    modes.add_argument(
+        "--update-golden", action="store_true", help="write golden/ with imagemagick"
+    )
+    args = parser.parse_args()
+
+    if args.update_golden:
+        GOLDEN_PATH.mkdir(exist_ok=True)
+        for text_to_render in args.texts:
+            text.magick_caption(text_to_render).save(golden_path(text_to_render))
+            print(f"wrote {golden_path(text_to_render).name} for {text_to_render!r}")
+        return
+
+    failed = 0
+    for text_to_render in args.texts:
+        if args.golden:
+            if not golden_path(text_to_render).exists():
+                failed += 1
+                print(
+                    f"FAIL {text_to_render!r}: no golden image, see Dockerfile.golden"
+                )
+                continue
+            expected = Image.open(golden_path(text_to_render)).convert("1")
+        else:
+            expected = text.magick_caption(text_to_render)
+        got = text.draw_caption(text_to_render)
+        if expected.size == got.size and expected.tobytes() == got.tobytes():
+            print(f"ok   {text_to_render!r}")
+            continue
+        failed += 1
+        print(f"FAIL {text_to_render!r}: {expected.size} vs {got.size}")
+        print(f"imagemagick:\n{show(expected)}\ndraw_caption:\n{show(got)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,22 @@
+import functools
+import io
+import itertools
 import logging
+import math
+import os
 import random
 import subprocess
-from base64 import b64encode
+import sys
 from pathlib import Path
-from time import sleep
 
-from flask import Flask, Response, request
-from PIL import Image
+import numpy as np
+from flask import Flask, request
+from PIL import Image, ImageDraw, ImageFont
+
+# the frame transport, shared by the renderers: ../frames.py in the repo, right
+# next to this file in the renderer's image
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from frames import frames_response  # noqa: E402
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -14,84 +24,281 @@ log.info("Initializing Text")
 
 app = Flask(__name__)
 
-FONT_PATH = Path("./bubbletea.ttf")
+FONT_PATH = Path(__file__).parent / "bubbletea.ttf"
 
+# text is rendered by imagemagick (magick -size 96x -pointsize 8
+# -interline-spacing -1 caption:...), one process per show. it can also be
+# drawn right here, the same way (TEXT_RASTERIZER=pil): the font is a pixel
+# font, at 8 pixels it has no anti-aliasing, so it can go straight into a mode
+# "1" image. that only becomes the default once compare_with_magick.py --golden
+# passes, against images imagemagick drew (see Dockerfile.golden), which
+# haven't been made yet -- until then imagemagick stays
+TEXT_RASTERIZER = os.environ.get("TEXT_RASTERIZER", "magick")
+WIDTH = 96
+HEIGHT = 38
+FONT = ImageFont.truetype(str(FONT_PATH), 8)
+FONT_ASCENT, FONT_DESCENT = FONT.getmetrics()
+# -interline-spacing -1
+LINE_HEIGHT = FONT_ASCENT + FONT_DESCENT - 1
+# imagemagick measures lines with its default stroke width of 1 added
+STROKE_WIDTH = 1
+GLYPH_PADDING = 4
 
-@app.route("/render", methods=["POST"])
-def render():
-    text_to_render = request.json["text"]
-    log.info("Rendering text: %s", text_to_render)
+# text that's taller than the display scrolls up through it, "step" pixels
+# (default SCROLL_STEP) every frame, after the first frame was up for
+# "hold_s" seconds (default SCROLL_HOLD_S). the last frame stays up for
+# END_HOLD_S. the holds are repeated frames, the worker plays them at
+# FRAME_RATE on its own clock (and doesn't send the same frame twice)
+FRAME_RATE = 5
+SCROLL_STEP = 1
+SCROLL_HOLD_S = 2
+END_HOLD_S = 5
+# anything else is a 400
+MAX_SCROLL_STEP = HEIGHT
+MAX_SCROLL_HOLD_S = 60
+
+# with {"mode": "marquee"} in the payload, the text goes across the display
+# on one line instead, "direction": "left" (default) or "right", at "speed"
+# pixels per second. the display tops out at around 40 fps, faster marquees
+# move several pixels per frame -- up to MAX_MARQUEE_SPEED (a 400 past that,
+# it's a blur anyway and more than the display's width per frame can't be
+# drawn)
+MARQUEE_DIRECTIONS = ("left", "right")
+MARQUEE_SPEED = 30
+MAX_FRAME_RATE = 40
+MAX_MARQUEE_SPEED = 10 * MAX_FRAME_RATE
+# the line is in the middle of the display
+MARQUEE_TOP = (HEIGHT - (FONT_ASCENT + FONT_DESCENT)) // 2
+
+
+# bump this whenever a change to this renderer changes the frames it produces
+# for a given payload -- the worker caches the frames of deterministic renderers
+RENDERER_VERSION = "6"
+
+
+@functools.cache
+def _advance(char):
+    # the font has no kerning, a line is as wide as its characters' advances
+    return FONT.getlength(char)
+
+
+def _fits(width):
+    return round(width + STROKE_WIDTH) <= WIDTH
+
+
+def wrap_caption(text):
+    """
+    splits text into lines the way imagemagick's caption: does: a line goes
+    on until it's too wide, then breaks at its last space (which goes away),
+    or right before the character that didn't fit if it has no space
+    """
+    # imagemagick turns a backslash-n into a newline
+    text = text.replace("\\n", "\n")
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        width = 0
+        for char in paragraph:
+            if _fits(width + _advance(char)):
+                line += char
+                width += _advance(char)
+                continue
+            last_space = line.rfind(" ")
+            if char == " ":
+                # the space that didn't fit is where the line breaks
+                lines.append(line)
+                line = ""
+            elif last_space != -1:
+                lines.append(line[:last_space])
+                line = line[last_space + 1 :] + char
+            else:
+                lines.append(line)
+                line = char
+            width = sum(map(_advance, line))
+        lines.append(line)
+    return lines
+
+
+@functools.cache
+def _glyph(char):
+    # drawn once, then pasted wherever the character shows up. a glyph can
+    # stick out of its advance a little, hence the padding on both sides
+    advance = round(_advance(char))
+    glyph = Image.new("1", (advance + 2 * GLYPH_PADDING, FONT_ASCENT + FONT_DESCENT))
+    ImageDraw.Draw(glyph).text((GLYPH_PADDING, 0), char, font=FONT, fill=1)
+    return glyph
+
+
+def magick_caption(text):
+    # imagemagick 7, for the negative interline spacing
+    png = subprocess.run(
+        [
+            "magick",
+            "-background",
+            "black",
+            "-fill",
+            "white",
+            "-size",
+            f"{WIDTH}x",
+            "-pointsize",
+            "8",
+            "-interline-spacing",
+            "-1",
+            "-font",
+            FONT_PATH.resolve(),
+            f"caption:{text}",
+            "png:-",
+        ],
+        capture_output=True,
+        check=True,
+    ).stdout
+    return Image.open(io.BytesIO(png)).convert("1")
 
-    def eventStream():
-        # command
-        # convert -background black -fill white -size 96x38 -font "/Users/g/Desktop/recurse/42.rapidriter/1.mode-tests/1.text-mode/0.fonts-NotJamFontPack/Undead Pixel Light 8/Undead Pixel 8.ttf" caption:'send 3648 chars of 0 and 1 by osc to 10.100.7.28 port 12000' "out-Undead Pixel 8.png";
-        subprocess.run(
-            [
-                # in version 7 of imagemagick, 'convert' and 'magick convert'
-                # are considered deprecated in favor of just calling "magick"
-                # version 7 is CRUCIAL to be able to use negative 'interline-spacing' values!!
-                "magick",
-                "-background",
-                "black",
-                "-fill",
-                "white",
-                "-size",
-                "96x",
-                "-pointsize",
-                "8",
-                "-interline-spacing",
-                "-1",
-                "-font",
-                # absolute path to font
-                FONT_PATH.resolve(),
-                f"caption:{text_to_render}",
-                "/tmp/out.png",
-            ]
+
+def draw_caption(text):
+    """
+    what magick_caption gives, drawn in-process: text as a mode "1" image,
+    WIDTH wide and as high as its lines need (not necessarily HEIGHT)
+    """
+    lines = wrap_caption(text)
+    height = (len(lines) - 1) * LINE_HEIGHT + FONT_ASCENT + FONT_DESCENT
+    image = Image.new("1", (WIDTH, height), 0)
+    for i, line in enumerate(lines):
+        x = 0
+        for char in line:
+            # pasting white through the glyph as a mask only ever adds pixels,
+            # like drawing the line in one go would
+            image.paste(1, (x - GLYPH_PADDING, i * LINE_HEIGHT), _glyph(char))
+            x += round(_advance(char))
+    return image
+
+
+def rasterize(text):
+    if TEXT_RASTERIZER == "pil":
+        return draw_caption(text)
+    return magick_caption(text)
+
+
+def scroll_frames(image, step=SCROLL_STEP, hold_s=SCROLL_HOLD_S):
+    """
+    yields the frames of a caption: the caption as it is if it fits on the
+    display, or scrolling up through it if it's taller. frames are windows
+    over the rows of one packed bitmap, cut when they're needed
+    """
+    bitmap = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(
+        image.height, WIDTH // 8
+    )
+    if image.height <= HEIGHT:
+        frame = np.zeros((HEIGHT, WIDTH // 8), dtype=np.uint8)
+        frame[: image.height] = bitmap
+        tops = [0]
+        bitmap = frame
+    else:
+        last_top = image.height - HEIGHT
+        tops = itertools.chain(
+            itertools.repeat(0, round(hold_s * FRAME_RATE)),
+            range(0, last_top, max(1, step)),
+            [last_top],
         )
 
-        # imagemagic will return images of 96px of width BUT NOT NECESSARILY
-        # 38 pixels high. if we are less than 38 pixels high, pad with black pixels
-        # and send it back
+    for top in tops:
+        yield bitmap[top : top + HEIGHT].tobytes()
+    # and then the last one stays up
+    yield from itertools.repeat(
+        bitmap[top : top + HEIGHT].tobytes(), round(END_HOLD_S * FRAME_RATE)
+    )
 
-        image = Image.open("/tmp/out.png")
-        # convert to 1 mode
-        image = image.convert("1")
 
-        all_images_to_send = []
+@functools.cache
+def _glyph_columns(char):
+    # the atlas for marquees: a glyph as one byte per pixel column, msb at the
+    # top (the font is exactly 8 pixels high), cut to its advance
+    advance = round(_advance(char))
+    glyph = _glyph(char).crop((GLYPH_PADDING, 0, GLYPH_PADDING + advance, 8))
+    return np.packbits(np.array(glyph), axis=0).tobytes()
 
-        # if image is less than or exactly 38 pixels high, pad with black pixels
-        # (it's better than creating two images if the output is already 38px high)
-        if image.height <= 38:
-            new_image = Image.new("1", (96, 38), 0)
-            new_image.paste(image, (0, 0))
-            all_images_to_send = [new_image]
-        else:
-            # if more than 38 pixels high,
-            # extract 38 pixels from the top, then shift y by 1 pixel,
-            # get 38 pixels, etc. until the end of the image
-            for y in range(0, image.height - 38):
-                new_image = image.crop((0, y, 96, y + 38))
-                all_images_to_send.append(new_image)
 
-        if len(all_images_to_send) > 2:
-            # make 5 copies of first frame so that scrolling doesn't begin immediately
-            # when frames are shown
-            all_images_to_send = [all_images_to_send[0]] * 10 + all_images_to_send
+def marquee_step(speed):
+    # how many pixels the text moves per frame, enough of them for speed /
+    # step to stay at or under MAX_FRAME_RATE
+    return max(1, math.ceil(speed / MAX_FRAME_RATE))
+
+
+def marquee_frames(text, direction="left", speed=MARQUEE_SPEED):
+    """
+    yields frames of text moving across the display. the line is never drawn
+    as a whole: its pixel columns come out of the glyph atlas as they're
+    needed, into a window as wide as the display, so any length of text takes
+    the same memory and about the same time per frame
+    """
+    step = marquee_step(speed)
+    if direction == "right":
+        # the end of the text comes in first, from the left. the window is
+        # filled the same way, and flipped when it's shown
+        glyphs = (_glyph_columns(char)[::-1] for char in reversed(text))
+    else:
+        glyphs = (_glyph_columns(char) for char in text)
+    # and then blank columns, until the text is gone
+    columns = itertools.chain(itertools.chain.from_iterable(glyphs), bytes(WIDTH))
+
+    window = bytearray(WIDTH)
+    frame = np.zeros((HEIGHT, WIDTH // 8), dtype=np.uint8)
+    line = frame[MARQUEE_TOP : MARQUEE_TOP + 8]
+    while new_columns := bytes(itertools.islice(columns, step)):
+        del window[: len(new_columns)]
+        window += new_columns
+        shown = window if direction == "left" else window[::-1]
+        # one byte per column -> 8 rows of packed pixels
+        bits = np.unpackbits(np.frombuffer(shown, dtype=np.uint8)[None], axis=0)
+        line[:] = np.packbits(bits, axis=1)
+        yield frame.tobytes()
 
-        for image in all_images_to_send:
-            # get png data
-            image_bytes = image.tobytes()
-            # base64 encode
-            image_base64 = b64encode(image_bytes).decode("utf-8")
 
-            yield f"event: screen_update\ndata: {image_base64}\n\n"
-            sleep(0.2)
+@app.route("/info")
+def info():
+    return {"version": RENDERER_VERSION, "deterministic": True}
 
-        sleep(5)
 
-        yield "event: end\n\n"
+def _number(name, default, minimum, maximum, integer=False):
+    # an option from the payload, or the ValueError to send back as a 400
+    value = request.json.get(name, default)
+    kinds = int if integer else (int, float)
+    if (
+        isinstance(value, bool)
+        or not isinstance(value, kinds)
+        or not minimum <= value <= maximum
+    ):
+        kind = "a whole number" if integer else "a number"
+        raise ValueError(f"{name} must be {kind} from {minimum} to {maximum}")
+    return value
+
+
+@app.route("/render", methods=["POST"])
+def render():
+    text_to_render = request.json.get("text")
+    log.info("Rendering text: %s", text_to_render)
+    if not isinstance(text_to_render, str) or not text_to_render.strip():
+        return {"error": "text must not be empty"}, 400
+
+    try:
+        if request.json.get("mode") == "marquee":
+            direction = request.json.get("direction", "left")
+            if direction not in MARQUEE_DIRECTIONS:
+                raise ValueError(f"direction must be one of {MARQUEE_DIRECTIONS}")
+            speed = _number("speed", MARQUEE_SPEED, 1, MAX_MARQUEE_SPEED)
+        else:
+            step = _number("step", SCROLL_STEP, 1, MAX_SCROLL_STEP, integer=True)
+            hold_s = _number("hold_s", SCROLL_HOLD_S, 0, MAX_SCROLL_HOLD_S)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if request.json.get("mode") == "marquee":
+        frames = marquee_frames(text_to_render, direction, speed)
+        # no sleeping, the worker only reads as many frames as it can buffer
+        return frames_response(frames, frame_rate=speed / marquee_step(speed))
 
-    return Response(eventStream(), mimetype="text/event-stream")
+    frames = scroll_frames(rasterize(text_to_render), step, hold_s)
+    return frames_response(frames, frame_rate=FRAME_RATE)
 
 
 if __name__ == "__main__":
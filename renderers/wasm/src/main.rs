@@ -1,11 +1,16 @@
 use axum::{
+    body::Body,
     extract::DefaultBodyLimit,
+    http::{
+        header::{ACCEPT, CONTENT_TYPE},
+        HeaderMap,
+    },
     response::sse::{Event, Sse},
+    response::{IntoResponse, Response},
     routing::post,
     Json, Router,
 };
 use base64::{engine::general_purpose::STANDARD, Engine as _};
-use futures::stream::Stream;
 use serde::Deserialize;
 use std::{convert::Infallible, time::{SystemTime, UNIX_EPOCH, Duration}};
 use tokio_stream::StreamExt;
@@ -64,10 +69,16 @@ impl WasmRunner {
 }
 
 // ~10 fps
-const FRAME_DURATION: Duration = Duration::from_millis(1000 / 10);
+const FRAME_RATE: u64 = 10;
+const FRAME_DURATION: Duration = Duration::from_millis(1000 / FRAME_RATE);
+
+// Raw frames, each one prefixed with its length as a big-endian u16, and a
+// length of 0 to mark the end. The worker asks for it with its Accept header,
+// otherwise we send SSE.
+const FRAMES_MIMETYPE: &str = "application/x-rapidriter-frames";
 
 impl Iterator for WasmRunner {
-    type Item = Result<Event, Infallible>;
+    type Item = [u8; 456];
 
     fn next(&mut self) -> Option<Self::Item> {
         if self.returned_end {
@@ -77,7 +88,7 @@ impl Iterator for WasmRunner {
         // for anyone.
         if self.i > 100 {
             self.returned_end = true;
-            return Some(Ok(Event::default().event("end")));
+            return None;
         }
 
         let mut img = [0; 456];
@@ -98,23 +109,18 @@ impl Iterator for WasmRunner {
         if let Value::I32(v) = done[0] {
             if v == 1 {
                 self.returned_end = true;
-                return Some(Ok(Event::default().event("end")));
+                return None;
             }
         }
         self.i += 1;
         let view = memory.view(&self.store);
         view.read(1, img.as_mut_slice()).unwrap();
 
-        // Write the image out
-        return Some(Ok(Event::default()
-            .event("screen_update")
-            .data(STANDARD.encode(&img))));
+        Some(img)
     }
 }
 
-async fn render(
-    Json(payload): Json<Payload>,
-) -> Sse<impl Stream<Item = Result<Event, Infallible>>> {
+async fn render(headers: HeaderMap, Json(payload): Json<Payload>) -> Response {
     // Okay, what's the API?
     // Worker hits /render
     // Expecting an event stream response
@@ -127,8 +133,42 @@ async fn render(
     // event: end
     //
 
+    //
+    // Or, if the worker asked for FRAMES_MIMETYPE, the same frames without
+    // the base64 + SSE framing.
+
     let runner = WasmRunner::new_from_wasm(&payload.wasm).unwrap();
-    let stream = tokio_stream::iter(runner).throttle(FRAME_DURATION);
+    // The worker plays the frames on its own clock, at this rate
+    let frame_rate = ("x-frame-rate", FRAME_RATE.to_string());
+
+    let wants_binary = headers
+        .get(ACCEPT)
+        .and_then(|accept| accept.to_str().ok())
+        .map_or(false, |accept| accept.contains(FRAMES_MIMETYPE));
+
+    if wants_binary {
+        let chunks = runner
+            .map(|img| [&(img.len() as u16).to_be_bytes()[..], &img[..]].concat())
+            .chain(std::iter::once(0u16.to_be_bytes().to_vec()))
+            .map(Ok::<_, Infallible>);
+        let stream = tokio_stream::iter(chunks).throttle(FRAME_DURATION);
+
+        return (
+            [(CONTENT_TYPE.as_str(), FRAMES_MIMETYPE.to_string()), frame_rate],
+            Body::from_stream(stream),
+        )
+            .into_response();
+    }
+
+    let events = runner
+        .map(|img| {
+            Event::default()
+                .event("screen_update")
+                .data(STANDARD.encode(&img))
+        })
+        .chain(std::iter::once(Event::default().event("end")))
+        .map(Ok::<_, Infallible>);
+    let stream = tokio_stream::iter(events).throttle(FRAME_DURATION);
 
-    Sse::new(stream)
+    ([frame_rate], Sse::new(stream)).into_response()
 }
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.utils import timezone
 
 from .models import User
 from .models import KV, Show
@@ -17,7 +18,9 @@ class ShowAdmin(admin.ModelAdmin):
     actions = ['bulk_disable', 'bulk_enable']
     
     def bulk_disable(self, request, queryset):
-        updated = queryset.update(disabled=True)
+        # .update() doesn't touch auto_now fields, and the worker needs
+        # updated_at to notice the change
+        updated = queryset.update(disabled=True, updated_at=timezone.now())
         if updated == 1:
             message_bit = "1 show was"
         else:
@@ -26,7 +29,7 @@ class ShowAdmin(admin.ModelAdmin):
     bulk_disable.short_description = "Disable selected shows"
     
     def bulk_enable(self, request, queryset):
-        updated = queryset.update(disabled=False)
+        updated = queryset.update(disabled=False, updated_at=timezone.now())
         if updated == 1:
             message_bit = "1 show was"
         else:
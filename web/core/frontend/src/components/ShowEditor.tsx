@@ -38,6 +38,13 @@ export const ShowEditor: React.FC<ShowEditorProps> = ({ show, onClose, onSave })
     return Cookies.get('csrftoken') || '';
   };
 
+  // everything in the payload next to the content (i.e. a text show's mode),
+  // previews have to be rendered with it too
+  const getOptions = () =>
+    Object.fromEntries(
+      Object.entries(show.payload || {}).filter(([key]) => key !== show.show_type)
+    );
+
   // Cleanup on unmount
   useEffect(() => {
     return () => {
@@ -102,7 +109,8 @@ export const ShowEditor: React.FC<ShowEditorProps> = ({ show, onClose, onSave })
         },
         body: JSON.stringify({
           show_type: show.show_type,
-          content: payload
+          content: payload,
+          options: getOptions()
         })
       });
       
@@ -182,6 +190,7 @@ export const ShowEditor: React.FC<ShowEditorProps> = ({ show, onClose, onSave })
         body: JSON.stringify({
           show_type: show.show_type,
           content: payload,
+          options: getOptions(),
           preview_show_id: previewShowId
         })
       });
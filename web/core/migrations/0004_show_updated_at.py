@@ -0,0 +1,20 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_show_is_preview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='show',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -9,6 +9,8 @@ class User(AbstractUser):
 
 class Show(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
+    # used by the worker to only sync the shows that changed, see get_shows
+    updated_at = models.DateTimeField(auto_now=True)
 
     SHOW_TYPES = [
         ("text", "Text"),
@@ -4,6 +4,7 @@ import django_eventstream
 from core.views.index import (
     get_all_show_ids,
     get_show,
+    get_shows,
 )
 
 from core.views.oauth.oauth_redirect import oauth_redirect
@@ -19,6 +20,7 @@ urlpatterns = [
     # paths below called by the worker
     path("internalapi/get_all_show_ids", get_all_show_ids, name="get_all_show_ids"),
     path("internalapi/get_show/<int:show_id>", get_show, name="get_show"),
+    path("internalapi/shows", get_shows, name="get_shows"),
 
     # the worker connects to internalapi/events to be informed of
     # shows to be immediately shown
@@ -2,14 +2,57 @@ from ninja import NinjaAPI
 from core.models import Show
 from ninja.security import django_auth
 from django.conf import settings
-import requests
 from django.http import StreamingHttpResponse
+import asyncio
 import json
+import time
 from django_eventstream import send_event
 import httpx
 
 api = NinjaAPI(csrf=True)
 
+
+TEXT_DIRECTIONS = ('left', 'right')
+# the number options of text shows and what they can be (the same as text.py
+# takes): (smallest, largest, whole numbers only)
+TEXT_NUMBER_OPTIONS = {
+    'speed': (1, 400, False),
+    'step': (1, 38, True),
+    'hold_s': (0, 60, False),
+}
+
+# renderers send frames as fast as they can and say how fast they should be
+# shown with an X-Frame-Rate header (the worker plays them on its own clock),
+# so previews are paced here, the same way
+PREVIEW_DEFAULT_FRAME_RATE = 10
+
+
+def make_payload(show_type, content, options=None):
+    # options go into the payload next to the content, i.e. for text shows
+    # {"mode": "marquee", "direction": "left", "speed": 30}, see text.py
+    if options is not None and not isinstance(options, dict):
+        raise ValueError('options must be an object')
+    options = options or {}
+    if show_type == 'text':
+        validate_text_options(content, options)
+    return {**options, show_type: content}
+
+
+def validate_text_options(content, options):
+    if not isinstance(content, str) or not content.strip():
+        raise ValueError('text must not be empty')
+    if options.get('direction', 'left') not in TEXT_DIRECTIONS:
+        raise ValueError(f'direction must be one of {", ".join(TEXT_DIRECTIONS)}')
+    for name, (smallest, largest, whole) in TEXT_NUMBER_OPTIONS.items():
+        if name not in options:
+            continue
+        value = options[name]
+        kinds = int if whole else (int, float)
+        if isinstance(value, bool) or not isinstance(value, kinds) or not smallest <= value <= largest:
+            kind = 'a whole number' if whole else 'a number'
+            raise ValueError(f'{name} must be {kind} from {smallest} to {largest}')
+
+
 @api.get("/shows", auth=django_auth)
 def get_shows(request):
     shows = Show.objects.filter(is_preview=False).order_by('created_at')
@@ -70,7 +113,7 @@ def create_show(request):
             return {'success': False, 'error': 'Invalid show_type'}
         
         # Create payload with show_type as key
-        payload = {show_type: content}
+        payload = make_payload(show_type, content, data.get('options'))
         
         # Create new show
         show = Show.objects.create(
@@ -101,7 +144,7 @@ def create_or_update_preview(request):
             return {'success': False, 'error': 'Invalid show_type'}
 
         # Create payload with show_type as key
-        payload = {show_type: content}
+        payload = make_payload(show_type, content, data.get('options'))
 
         # Update existing preview or create new one
         if preview_show_id:
@@ -156,9 +199,16 @@ def save_show(request, show_id: int):
         # Get the new payload from request body
         import json
         payload_data = json.loads(request.body)
-        
-        # Update the show's payload
-        show.payload = payload_data
+        if not isinstance(payload_data, dict):
+            return {'success': False, 'error': 'Payload must be an object'}
+
+        # Update the show's payload -- the options it had (i.e. a text show's
+        # mode) stay, unless they're in the new payload too
+        content = payload_data.pop(show.show_type, None)
+        options = {
+            key: value for key, value in show.payload.items() if key != show.show_type
+        }
+        show.payload = make_payload(show.show_type, content, {**options, **payload_data})
         show.save()
         
         return {'success': True}
@@ -198,7 +248,7 @@ def preview_content(request):
             return {'success': False, 'error': f'No renderer configured for {show_type}. Available: {list(renderer_hosts.keys())}, Hosts: {renderer_hosts}'}
         
         # Prepare payload for renderer
-        payload = {show_type: content}
+        payload = make_payload(show_type, content, data.get('options'))
         
         # Forward to renderer microservice with async generator
         async def stream_renderer_response():
@@ -211,8 +261,18 @@ def preview_content(request):
                         timeout=30.0
                     ) as response:
                         response.raise_for_status()
-                        
+                        frame_period = 1 / float(
+                            response.headers.get('X-Frame-Rate', PREVIEW_DEFAULT_FRAME_RATE)
+                        )
+                        frame_due = time.monotonic()
+
                         async for line in response.aiter_lines():
+                            if line == 'event: screen_update':
+                                # wait for the frame's turn, without catching
+                                # up if the renderer was slower than that
+                                now = time.monotonic()
+                                await asyncio.sleep(max(0, frame_due - now))
+                                frame_due = max(frame_due, now) + frame_period
                             if line:
                                 yield line + '\n'
             except Exception as e:
@@ -1,4 +1,9 @@
-from django.http import HttpResponse, JsonResponse
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from django.db.models import Max
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
 from django.shortcuts import redirect, render, get_object_or_404
 from django.conf import settings
 
@@ -27,3 +32,45 @@ def get_all_show_ids(request):
     for show in all_shows:
         show_ids.append(show.id)
     return JsonResponse({"show_ids": show_ids})
+
+
+# JSON api for the worker to sync all the shows it plays in one request.
+#
+# returns the ordered list of show ids to play, a version stamp, and the full
+# shows (type + payload) that changed since the version given as `?since=`.
+# the ETag covers the version and the list of ids, so if nothing was added,
+# changed, disabled or deleted the worker gets a 304 for its If-None-Match
+def get_shows(request):
+    all_shows = Show.objects.filter(disabled=False, is_preview=False).order_by("created_at")
+    show_ids = list(all_shows.values_list("id", flat=True))
+
+    latest_update = all_shows.aggregate(Max("updated_at"))["updated_at__max"]
+    # microseconds since the epoch
+    version = int(latest_update.timestamp() * 1_000_000) if latest_update else 0
+
+    etag_data = json.dumps([version, show_ids]).encode("utf-8")
+    etag = '"' + hashlib.sha256(etag_data).hexdigest()[:32] + '"'
+    if request.headers.get("If-None-Match") == etag:
+        return HttpResponseNotModified(headers={"ETag": etag})
+
+    changed_shows = all_shows
+    since = int(request.GET.get("since", 0))
+    if since:
+        # >= rather than >, in case a show was saved within the same
+        # microsecond as the last one we sent
+        changed_shows = changed_shows.filter(
+            updated_at__gte=datetime.fromtimestamp(since / 1_000_000, tz=timezone.utc)
+        )
+
+    response = JsonResponse(
+        {
+            "version": version,
+            "show_ids": show_ids,
+            "shows": {
+                show.id: {"show_type": show.show_type, "payload": show.payload}
+                for show in changed_shows
+            },
+        }
+    )
+    response["ETag"] = etag
+    return response
@@ -0,0 +1,58 @@
+# micro-benchmark of the per-frame work done before a frame goes out over udp
+#
+# python bench_frame_encoder.py
+#
+# compares the encoder in frame_encoder.py with what send_frame_to_display
+# used to do (pillow image + numpy flip + packbits), and checks that both
+# give the exact same bytes
+
+import os
+import timeit
+
+import numpy as np
+from PIL import Image
+
+import frame_encoder
+
+# the display tops out somewhere around 40 fps
+DISPLAY_FPS = 40
+ITERATIONS = 20000
+
+
+def encode_frame_with_pillow(frame):
+    pil_image = Image.frombytes("1", (96, 38), frame)
+    np_image = np.flip(np.asarray(pil_image), 1)
+    return np.packbits(np_image.astype("bool"), axis=None, bitorder="little")
+
+
+def main():
+    frames = [os.urandom(frame_encoder.FRAME_SIZE) for _ in range(64)]
+    out = frame_encoder.new_output_buffer()
+
+    for frame in frames:
+        expected = encode_frame_with_pillow(frame).tobytes()
+        assert frame_encoder.encode_frame(frame, out).tobytes() == expected
+
+    for name, encode in (
+        ("pillow + packbits", encode_frame_with_pillow),
+        ("frame_encoder", lambda frame: frame_encoder.encode_frame(frame, out)),
+    ):
+        i = 0
+
+        def encode_next():
+            nonlocal i
+            encode(frames[i % len(frames)])
+            i += 1
+
+        seconds = min(timeit.repeat(encode_next, number=ITERATIONS, repeat=5))
+        per_frame_us = seconds / ITERATIONS * 1e6
+        max_fps = ITERATIONS / seconds
+        print(
+            f"{name:>20}: {per_frame_us:6.2f} us/frame, "
+            f"{max_fps:9.0f} fps max, "
+            f"{DISPLAY_FPS / max_fps * 100:.3f}% of a core at {DISPLAY_FPS} fps"
+        )
+
+
+if __name__ == "__main__":
+    main()
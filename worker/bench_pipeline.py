@@ -0,0 +1,356 @@
+# end to end benchmark of the worker, with no network and no real renderers
+#
+# python bench_pipeline.py [--duration 30] [--out bench_results.json]
+#
+# worker.py runs as is in a subprocess, in between
+# - stub renderers, that stream frames at a given frame rate over SSE or the
+#   binary transport (both at /render, the show payload says which)
+# - a fake web service serving /internalapi/*, that also sends a
+#   show_immediately event every --immediately-every seconds
+# - a udp sink standing in for the display
+#
+# every frame a stub renderer emits carries when it was emitted and which show
+# it belongs to, so that the sink can tell how long it took to get through
+# the worker. results go to --out as json, to compare runs over time
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import frame_encoder
+
+# emitted at (time.monotonic_ns, which is the same clock for every process),
+# show id, frame number -- at the start of every frame
+STAMP = struct.Struct(">QIH")
+FRAMES_MIMETYPE = "application/x-rapidriter-frames"
+FRAME_LENGTH = struct.Struct(">H")
+
+# the playlist: every show is 3 seconds long, at different frame rates and
+# over both transports. 60 fps is faster than the display, so frames get dropped
+SHOWS = {
+    1: {"fps": 10, "frames": 30, "transport": "sse"},
+    2: {"fps": 20, "frames": 60, "transport": "binary"},
+    3: {"fps": 40, "frames": 120, "transport": "sse"},
+    4: {"fps": 60, "frames": 180, "transport": "binary"},
+}
+# not in the playlist, only ever played with show_immediately
+IMMEDIATE_SHOW = {"fps": 20, "frames": 40, "transport": "binary"}
+IMMEDIATE_SHOW_ID = 99
+
+
+def show_payload(show_id):
+    return {"show_id": show_id, **SHOWS.get(show_id, IMMEDIATE_SHOW)}
+
+
+def stub_frame(show_id, frame_number):
+    # a stamp, and a pattern so that no two frames are the same (the worker
+    # doesn't resend identical frames)
+    stamp = STAMP.pack(time.monotonic_ns(), show_id, frame_number)
+    pattern = bytes([frame_number % 256]) * (frame_encoder.FRAME_SIZE - STAMP.size)
+    return stamp + pattern
+
+
+class StubServer:
+    """the stub renderers and the fake web service, on one port"""
+
+    def __init__(self, immediately_every_s):
+        self.immediately_every_s = immediately_every_s
+        self.frames_emitted = {}
+        # monotonic_ns of every show_immediately event sent
+        self.immediately_sent_at = []
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while line := (await reader.readline()).strip():
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            path = target.split("?")[0]
+
+            if path == "/info":
+                await self.send_json(writer, {"version": "bench", "deterministic": False})
+            elif path == "/render" and method == "POST":
+                await self.render(writer, json.loads(body))
+            elif path == "/internalapi/shows":
+                shows = {
+                    str(show_id): {"show_type": "text", "payload": show_payload(show_id)}
+                    for show_id in SHOWS
+                }
+                await self.send_json(
+                    writer, {"version": 1, "show_ids": list(SHOWS), "shows": shows}
+                )
+            elif path.startswith("/internalapi/get_show/"):
+                show_id = int(path.rsplit("/", 1)[1])
+                await self.send_json(
+                    writer, {"show_type": "text", "payload": show_payload(show_id)}
+                )
+            elif path == "/internalapi/events":
+                await self.events(writer)
+            else:
+                await self.send_response(writer, "404 Not Found", "text/plain", b"")
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # the worker went away, or the benchmark is over
+            pass
+        finally:
+            writer.close()
+
+    async def send_response(self, writer, status, content_type, body, headers=""):
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n{headers}"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+
+    async def send_json(self, writer, data):
+        await self.send_response(
+            writer, "200 OK", "application/json", json.dumps(data).encode()
+        )
+
+    async def start_stream(self, writer, content_type, headers=""):
+        # no content length, the stream ends when the connection is closed
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n{headers}"
+            "Connection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+
+    async def render(self, writer, payload):
+        show_id, fps = payload["show_id"], payload["fps"]
+        binary = payload["transport"] == "binary"
+        await self.start_stream(
+            writer,
+            FRAMES_MIMETYPE if binary else "text/event-stream",
+            f"X-Frame-Rate: {fps}\r\n",
+        )
+
+        started = time.monotonic()
+        for i in range(payload["frames"]):
+            await asyncio.sleep(max(0, started + i / fps - time.monotonic()))
+            frame = stub_frame(show_id, i)
+            if binary:
+                writer.write(FRAME_LENGTH.pack(len(frame)) + frame)
+            else:
+                data = base64.b64encode(frame).decode()
+                writer.write(f"event: screen_update\ndata: {data}\n\n".encode())
+            # i.e. blocks while the worker's pre-roll buffer is full
+            await writer.drain()
+            self.frames_emitted[show_id] = self.frames_emitted.get(show_id, 0) + 1
+
+        writer.write(FRAME_LENGTH.pack(0) if binary else b"event: end\n\n")
+        await writer.drain()
+
+    async def events(self, writer):
+        await self.start_stream(writer, "text/event-stream")
+        while True:
+            await asyncio.sleep(self.immediately_every_s)
+            data = json.dumps({"show_id": IMMEDIATE_SHOW_ID})
+            self.immediately_sent_at.append(time.monotonic_ns())
+            writer.write(f"event: show_immediately\ndata: {data}\n\n".encode())
+            await writer.drain()
+
+
+class UdpSink(asyncio.DatagramProtocol):
+    def __init__(self):
+        # (received at, show id, frame number, emitted at)
+        self.received = []
+        self.buffer = frame_encoder.new_output_buffer()
+
+    def datagram_received(self, data, addr):
+        received_at = time.monotonic_ns()
+        # the display encoding only reverses the bytes of every row, doing it
+        # again gives back the frame as the renderer sent it
+        frame = frame_encoder.encode_frame(data, self.buffer).tobytes()
+        emitted_at, show_id, frame_number = STAMP.unpack_from(frame)
+        self.received.append((received_at, show_id, frame_number, emitted_at))
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": round(statistics.median(values), 3),
+        "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+        "max": round(values[-1], 3),
+    }
+
+
+def process_cpu_s(pid):
+    # utime + stime of a running process, linux only
+    try:
+        fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def analyze(sink, stub, cpu_s):
+    received = sink.received
+    if not received:
+        return {"error": "no frames reached the display"}
+
+    first_at, last_at = received[0][0], received[-1][0]
+    duration_s = (last_at - first_at) / 1e9
+    # this includes the time frames spend pre-rolled, i.e. mostly shows how
+    # far ahead the worker renders
+    latencies_ms = [(r[0] - r[3]) / 1e6 for r in received]
+
+    # how far off its frame rate every frame went out, from the first frame
+    # of every run of a show on
+    jitter_ms = []
+    run_start = None
+    for previous, current in zip([None] + received, received):
+        if previous is None or previous[1] != current[1] or previous[2] > current[2]:
+            run_start = current
+            continue
+        fps = show_payload(current[1])["fps"]
+        expected_at = run_start[0] + (current[2] - run_start[2]) / fps * 1e9
+        jitter_ms.append(abs(current[0] - expected_at) / 1e6)
+
+    # gaps between the last frame of a show and the first one of the next,
+    # minus how long the last frame was supposed to stay up anyway
+    switch_gaps_ms = []
+    for previous, current in zip(received, received[1:]):
+        if previous[1] != current[1] and IMMEDIATE_SHOW_ID not in (previous[1], current[1]):
+            hold_ms = 1000 / show_payload(previous[1])["fps"]
+            switch_gaps_ms.append((current[0] - previous[0]) / 1e6 - hold_ms)
+
+    immediately_ms = []
+    for sent_at in stub.immediately_sent_at:
+        first_frame = next(
+            (r for r in received if r[1] == IMMEDIATE_SHOW_ID and r[0] > sent_at), None
+        )
+        if first_frame is not None:
+            immediately_ms.append((first_frame[0] - sent_at) / 1e6)
+
+    per_show = {}
+    for show_id in sorted({r[1] for r in received}):
+        per_show[show_id] = {
+            "frames_emitted": stub.frames_emitted.get(show_id, 0),
+            "frames_sent_to_display": sum(1 for r in received if r[1] == show_id),
+            "latency_ms": summarize(
+                [(r[0] - r[3]) / 1e6 for r in received if r[1] == show_id]
+            ),
+        }
+
+    return {
+        "frames_sent_to_display": len(received),
+        "throughput_fps": round(len(received) / duration_s, 2) if duration_s else None,
+        "cpu_per_frame_us": round(cpu_s / len(received) * 1e6, 1) if cpu_s else None,
+        "latency_ms": summarize(latencies_ms),
+        "pacing_jitter_ms": summarize(jitter_ms),
+        "show_switch_gap_ms": summarize(switch_gaps_ms),
+        "show_immediately_ms": summarize(immediately_ms),
+        "per_show": per_show,
+    }
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    stub = StubServer(args.immediately_every)
+    server = await asyncio.start_server(stub.handle, "127.0.0.1", 0)
+    stub_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    transport, sink = await loop.create_datagram_endpoint(
+        UdpSink, local_addr=("127.0.0.1", 0)
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "DO_NOT_SEND_TO_RITER": "false",
+            "SCREEN_UDP_IP": "127.0.0.1",
+            "SCREEN_UDP_PORT": str(transport.get_extra_info("sockname")[1]),
+            "WEB_SERVICE_HOST": stub_url,
+            "RENDERER_TEXT_HOST": stub_url,
+            "RENDERER_P5_HOST": stub_url,
+            "RENDERER_SHADER_HOST": stub_url,
+            "RENDERER_WASM_HOST": stub_url,
+            "SHOW_STORE_DIR": os.path.join(tmp, "show_store"),
+            "FRAME_CACHE_DIR": os.path.join(tmp, "frame_cache"),
+            "METRICS_PORT": "0",
+        }
+        env.pop("RECORD_DIR", None)
+        with open(os.path.join(tmp, "worker.log"), "wb") as worker_log:
+            worker = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "worker.py",
+                cwd=Path(__file__).parent,
+                env=env,
+                stdout=worker_log,
+                stderr=subprocess.STDOUT,
+            )
+
+            # cpu is counted from the first frame on, i.e. without the
+            # worker starting up (imports etc.)
+            while not sink.received and worker.returncode is None:
+                await asyncio.sleep(0.01)
+            cpu_at_start = process_cpu_s(worker.pid)
+            await asyncio.sleep(args.duration)
+            cpu_at_end = process_cpu_s(worker.pid)
+
+            worker.terminate()
+            await worker.wait()
+
+        if cpu_at_start is None or cpu_at_end is None:
+            # not linux, fall back to everything the worker used
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_s = usage.ru_utime + usage.ru_stime
+        else:
+            cpu_s = cpu_at_end - cpu_at_start
+
+    transport.close()
+    server.close()
+    return analyze(sink, stub, cpu_s)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end to end worker benchmark")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--immediately-every", type=float, default=7, help="seconds")
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    output = {
+        "timestamp": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            "duration_s": args.duration,
+            "immediately_every_s": args.immediately_every,
+            "shows": SHOWS,
+            "immediate_show": IMMEDIATE_SHOW,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(output, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
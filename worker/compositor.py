@@ -0,0 +1,166 @@
+import os
+import time
+
+import numpy as np
+
+# works on frames as they come from the renderers (packed, 1 bit per pixel,
+# msb = leftmost pixel), with numpy bitwise ops on whole rows of bytes --
+# nothing is ever unpacked per frame:
+#
+# - transitions between shows: when a show starts, its frames are blended
+#   into the last frame of the previous show over TRANSITION_S, with masks
+#   computed once (out = old & ~mask | new & mask)
+#   - wipe: left to right
+#   - dissolve: pixels flip in a fixed random order
+#   - slide: the new show pushes the old one out to the left, a byte (8
+#     pixels) at a time, so that it's only slicing
+#   - cut: no transition, as before
+# - an overlay on top of everything, i.e. OVERLAY=clock: drawn once per
+#   minute, and then it's a mask (to clear the pixels under it) and an OR
+TRANSITION = os.environ.get("TRANSITION", "cut")
+TRANSITION_S = float(os.environ.get("TRANSITION_S", "0.5"))
+OVERLAY = os.environ.get("OVERLAY", "")
+
+TRANSITIONS = ("cut", "wipe", "dissolve", "slide")
+
+# 3x5 digits for the clock
+FONT = {
+    "0": ["###", "#.#", "#.#", "#.#", "###"],
+    "1": [".#.", "##.", ".#.", ".#.", "###"],
+    "2": ["###", "..#", "###", "#..", "###"],
+    "3": ["###", "..#", ".##", "..#", "###"],
+    "4": ["#.#", "#.#", "###", "..#", "..#"],
+    "5": ["###", "#..", "###", "..#", "###"],
+    "6": ["###", "#..", "###", "#.#", "###"],
+    "7": ["###", "..#", ".#.", ".#.", ".#."],
+    "8": ["###", "#.#", "###", "#.#", "###"],
+    "9": ["###", "#.#", "###", "..#", "###"],
+    ":": [".", "#", ".", "#", "."],
+}
+
+
+def _pack(pixels):
+    # (..., height, width) bools -> (..., height, width / 8) packed bytes
+    return np.packbits(pixels, axis=-1)
+
+
+class ClockOverlay:
+    """HH:MM in the top right corner, on a black box one pixel wider"""
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.drawn_for = None
+        self.mask = self.pixels = None
+
+    def update(self, now):
+        # returns whether it changed
+        text = time.strftime("%H:%M", time.localtime(now))
+        if text == self.drawn_for:
+            return False
+        self.drawn_for = text
+
+        glyphs = [
+            np.array([[pixel == "#" for pixel in row] for row in FONT[char]])
+            for char in text
+        ]
+        # one pixel between glyphs
+        text_pixels = np.concatenate(
+            [np.pad(glyph, ((0, 0), (0, 1))) for glyph in glyphs], axis=1
+        )[:, :-1]
+        text_height, text_width = text_pixels.shape
+
+        pixels = np.zeros((self.height, self.width), dtype=bool)
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        x = self.width - text_width - 1
+        pixels[1 : 1 + text_height, x : x + text_width] = text_pixels
+        mask[: text_height + 2, x - 1 :] = True
+        self.pixels, self.mask = _pack(pixels), _pack(mask)
+        return True
+
+    def apply(self, frame):
+        # frame: (height, width / 8) packed, changed in place
+        np.bitwise_and(frame, ~self.mask, out=frame)
+        np.bitwise_or(frame, self.pixels, out=frame)
+
+
+class Compositor:
+    def __init__(self, width, height, fps, transition=TRANSITION, overlay=OVERLAY):
+        if transition not in TRANSITIONS:
+            raise ValueError(f"unknown transition {transition}, one of {TRANSITIONS}")
+        if TRANSITION_S <= 0:
+            # no time to transition in
+            transition = "cut"
+        self.width, self.height = width, height
+        self.row_bytes = width // 8
+        self.transition = transition
+        self.steps = max(1, round(TRANSITION_S * fps))
+        self.overlay = ClockOverlay(width, height) if overlay == "clock" else None
+
+        # packed masks for every step of the transition, 0 -> 1
+        progress = np.linspace(0, 1, self.steps + 1)[:, None, None]
+        if transition == "wipe":
+            columns = np.arange(width)[None, None, :]
+            wiped = np.broadcast_to(
+                columns < progress * width, (self.steps + 1, height, width)
+            )
+            self.masks = _pack(wiped)
+        elif transition == "dissolve":
+            order = np.random.default_rng(42).permutation(width * height)
+            self.masks = _pack(
+                order.reshape(height, width)[None] < progress * order.size
+            )
+
+        # the last frame that went out (before the overlay), where the next
+        # transition starts from
+        self.last_frame = np.zeros((height, self.row_bytes), dtype=np.uint8)
+        self.from_frame = None
+        self.transition_started_at = None
+        self.out = np.empty((height, self.row_bytes), dtype=np.uint8)
+
+    @property
+    def active(self):
+        # i.e. whether frames have to go through compose at all
+        return self.transition != "cut" or self.overlay is not None
+
+    def start_transition(self, now):
+        if self.transition != "cut":
+            self.from_frame = self.last_frame.copy()
+            self.transition_started_at = now
+
+    def needs_redraw(self, now):
+        # whether there's something new to show even without a new frame
+        overlay_changed = self.overlay is not None and self.overlay.update(now)
+        return overlay_changed or self.transition_started_at is not None
+
+    def _step(self, now):
+        step = int((now - self.transition_started_at) * self.steps / TRANSITION_S)
+        if step >= self.steps:
+            self.transition_started_at = self.from_frame = None
+            return None
+        return step
+
+    def compose(self, frame, now):
+        """
+        frame: width x height, packed. returns the frame to send, as bytes
+        """
+        new = np.frombuffer(frame, dtype=np.uint8).reshape(
+            self.height, self.row_bytes
+        )
+        step = self._step(now) if self.transition_started_at is not None else None
+        if step is None:
+            np.copyto(self.out, new)
+        elif self.transition == "slide":
+            # step / steps of the new frame has come in from the right
+            shift = self.row_bytes * step // self.steps
+            self.out[:, : self.row_bytes - shift] = self.from_frame[:, shift:]
+            self.out[:, self.row_bytes - shift :] = new[:, :shift]
+        else:
+            mask = self.masks[step]
+            np.bitwise_and(self.from_frame, ~mask, out=self.out)
+            self.out |= new & mask
+        np.copyto(self.last_frame, self.out)
+
+        if self.overlay is not None:
+            self.overlay.update(now)
+            self.overlay.apply(self.out)
+        return self.out.tobytes()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+FRAME_CACHE_DIR = Path(os.environ.get("FRAME_CACHE_DIR", "./frame_cache"))
+FRAME_CACHE_MAX_BYTES = int(os.environ.get("FRAME_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+# every cache entry is two files:
+# - <key>.frames: all the frames of the show, back to back. they're all the
+#   same size: 456 bytes (96x38 pixels, 1 bit per pixel), or bigger when the
+#   renderer draws on a canvas made of several displays
+# - <key>.index: for every frame, how long it stays on screen (in ms, uint32)
+#   i.e. the time until the next frame, or until the end of the show for the
+#   last frame
+#
+# the .index file is written last, so an entry only "exists" once it's complete.
+# its mtime is bumped on every hit, and used for LRU eviction
+
+
+def cache_key(show_type, payload, renderer_version, canvas_size):
+    key_data = json.dumps(
+        [show_type, payload, renderer_version, canvas_size], sort_keys=True
+    )
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def _paths(key):
+    return FRAME_CACHE_DIR / f"{key}.frames", FRAME_CACHE_DIR / f"{key}.index"
+
+
+class CachedShow:
+    def __init__(self, key):
+        self.frames_path, self.index_path = _paths(key)
+        self.holds_ms = np.fromfile(self.index_path, dtype="<u4")
+        frames_size = self.frames_path.stat().st_size
+        self.frame_size = frames_size // max(1, len(self.holds_ms))
+        self.is_valid = len(self.holds_ms) and (
+            self.frame_size * len(self.holds_ms) == frames_size
+        )
+
+    def __iter__(self):
+        # yields (frame, seconds to hold the frame)
+        frame_size = self.frame_size
+        with open(self.frames_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as frames:
+            for i, hold_ms in enumerate(self.holds_ms):
+                yield frames[i * frame_size : (i + 1) * frame_size], hold_ms / 1000
+
+
+def lookup(key):
+    _, index_path = _paths(key)
+    try:
+        # mark as recently used
+        os.utime(index_path)
+        cached_show = CachedShow(key)
+    except FileNotFoundError:
+        return None
+
+    if not cached_show.is_valid:
+        log.error(f"frame cache entry {key} is corrupted, removing it")
+        _remove(key)
+        return None
+
+    return cached_show
+
+
+async def record(key, frames, stream_info):
+    """
+    passes frames through while also writing them to the cache.
+
+    every frame is held for 1 / stream_info["frame_rate"] seconds (see
+    receive_frames_from_renderer), except the last one, which is held for as
+    long as the renderer took to end the show after it.
+
+    the entry is only kept if the stream got all the way to its end, i.e. if
+    stream_info["completed"] is set (see receive_frames_from_renderer) -- a
+    show that was interrupted or errored out half way is never cached
+    """
+    FRAME_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    frames_path, index_path = _paths(key)
+    # pid in the name so that two processes can't clobber each other's files
+    tmp_frames_path = frames_path.with_suffix(f".frames.{os.getpid()}.tmp")
+
+    frame_count = 0
+    try:
+        with open(tmp_frames_path, "wb") as f:
+            waiting_since = time.monotonic()
+            async for frame in frames:
+                f.write(frame)
+                frame_count += 1
+                yield frame
+                waiting_since = time.monotonic()
+
+        if stream_info.get("completed") and frame_count:
+            hold_ms = round(1000 / stream_info["frame_rate"])
+            holds_ms = np.full(frame_count, hold_ms, dtype="<u4")
+            holds_ms[-1] = max(hold_ms, round((time.monotonic() - waiting_since) * 1000))
+
+            os.replace(tmp_frames_path, frames_path)
+            holds_ms.tofile(index_path)
+            log.info(f"frame cache: stored {frame_count} frames as {key}")
+            evict()
+    finally:
+        await frames.aclose()
+        tmp_frames_path.unlink(missing_ok=True)
+
+
+def _remove(key):
+    for path in _paths(key):
+        path.unlink(missing_ok=True)
+
+
+def evict():
+    entries = []
+    total_size = 0
+    for index_path in FRAME_CACHE_DIR.glob("*.index"):
+        frames_path = index_path.with_suffix(".frames")
+        try:
+            size = index_path.stat().st_size + frames_path.stat().st_size
+            entries.append((index_path.stat().st_mtime, size, index_path.stem))
+        except FileNotFoundError:
+            continue
+        total_size += size
+
+    # least recently used first
+    for _, size, key in sorted(entries):
+        if total_size <= FRAME_CACHE_MAX_BYTES:
+            break
+        log.info(f"frame cache: evicting {key}")
+        _remove(key)
+        total_size -= size
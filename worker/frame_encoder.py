@@ -0,0 +1,93 @@
+import numpy as np
+
+SCREEN_WIDTH = 96
+SCREEN_HEIGHT = 38
+
+ROW_BYTES = SCREEN_WIDTH // 8
+FRAME_SIZE = ROW_BYTES * SCREEN_HEIGHT
+
+# renderers send frames as pillow mode "1" raw bytes: rows of 12 bytes, the
+# leftmost pixel of each byte in its most significant bit.
+#
+# the display wants every row mirrored (right-left to left-right), with the
+# first pixel of each byte in its *least* significant bit.
+#
+# mirroring a row reverses the order of its bytes *and* the order of the bits
+# in each byte, and going from msb-first to lsb-first reverses the bits once
+# more -- so the two bit reversals cancel out, and all there is to do is to
+# reverse the order of the bytes of every row. no unpacking, no lookup table.
+
+
+def new_output_buffer():
+    return np.empty((SCREEN_HEIGHT, ROW_BYTES), dtype=np.uint8)
+
+
+def encode_frame(frame, out):
+    """
+    turns a renderer frame (FRAME_SIZE bytes, or any buffer of them) into what
+    the display expects, written into `out` (see new_output_buffer) so that
+    nothing gets allocated per frame. returns `out`, which can be passed to
+    socket.sendto as is
+    """
+    rows = np.frombuffer(frame, dtype=np.uint8).reshape(SCREEN_HEIGHT, ROW_BYTES)
+    np.copyto(out, rows[:, ::-1])
+    return out
+
+
+# several displays, each one showing a SCREEN_WIDTH x SCREEN_HEIGHT tile of a
+# bigger canvas (or all of them the same frame, when they're all at 0, 0).
+# cutting out the tiles and reversing their rows is one np.take, with an index
+# that's computed once
+
+
+def tile_index(canvas_width, canvas_height, tiles):
+    """
+    tiles: (x, y) of the top left corner of every display in the canvas, x a
+    multiple of 8 (i.e. tiles start on a byte). returns the index to pass to
+    encode_tiles
+    """
+    canvas_row_bytes = canvas_width // 8
+    rows = np.arange(SCREEN_HEIGHT)[:, None]
+    # reversed, see encode_frame
+    columns = np.arange(ROW_BYTES)[::-1][None, :]
+    index = []
+    for x, y in tiles:
+        if x % 8 or x < 0 or y < 0:
+            raise ValueError(f"tile at {x}, {y}: x has to be a multiple of 8")
+        if x + SCREEN_WIDTH > canvas_width or y + SCREEN_HEIGHT > canvas_height:
+            raise ValueError(
+                f"tile at {x}, {y} doesn't fit in a {canvas_width}x{canvas_height} canvas"
+            )
+        index.append(((y + rows) * canvas_row_bytes + x // 8 + columns).ravel())
+    return np.stack(index)
+
+
+def new_tiles_buffer(tile_count):
+    return np.empty((tile_count, FRAME_SIZE), dtype=np.uint8)
+
+
+def encode_tiles(frame, index, out):
+    # frame: canvas_width x canvas_height, packed like a renderer frame.
+    # out[i] is what goes to the i-th display
+    np.take(np.frombuffer(frame, dtype=np.uint8), index, out=out)
+    return out
+
+
+def mirror_index(canvas_width, canvas_height, tiles):
+    """
+    the other way around: the index to pass to mirror_to_canvas, to put a
+    single display's frame (from a renderer that doesn't know about the
+    canvas) at every tile of the canvas
+    """
+    # FRAME_SIZE is the zero byte added after the frame, for what's not
+    # covered by any tile
+    index = np.full((canvas_height, canvas_width // 8), FRAME_SIZE)
+    frame_bytes = np.arange(FRAME_SIZE).reshape(SCREEN_HEIGHT, ROW_BYTES)
+    for x, y in tiles:
+        index[y : y + SCREEN_HEIGHT, x // 8 : x // 8 + ROW_BYTES] = frame_bytes
+    return index.ravel()
+
+
+def mirror_to_canvas(frame, index):
+    padded = np.append(np.frombuffer(frame, dtype=np.uint8), np.uint8(0))
+    return padded[index].tobytes()
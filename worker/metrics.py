@@ -0,0 +1,167 @@
+import asyncio
+import bisect
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# just enough of the prometheus text format to see what the pipeline is doing,
+# without a dependency, and cheap enough to leave on on the pi: updating a
+# metric is a dict lookup and an addition, rendering happens only when
+# /metrics is scraped.
+#
+#   curl http://localhost:9200/metrics
+#
+# METRICS_PORT=0 turns the endpoint off (the metrics are still kept). it's
+# only reachable from the pi itself unless METRICS_HOST says otherwise (i.e.
+# 0.0.0.0 for a prometheus somewhere else), and a connection that doesn't get
+# its request in (and the response out) within METRICS_TIMEOUT_S is dropped
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9200"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_TIMEOUT_S = float(os.environ.get("METRICS_TIMEOUT_S", "5"))
+
+REGISTRY = []
+
+# for things that take microseconds (i.e. per frame work), and for things
+# that take a good part of a second (i.e. waiting for a renderer)
+FAST_BUCKETS = (5e-6, 10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 5e-3, 25e-3)
+SLOW_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # label values (in labelnames order) -> value
+        self.values = {}
+        REGISTRY.append(self)
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in self.values.items():
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            # so that it shows up as 0 before anything happened
+            self.values[()] = 0
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelvalues):
+        self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=FAST_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        # [count per bucket (not cumulative, the last one is +Inf), sum]
+        counts_and_sum = self.values.get(labelvalues)
+        if counts_and_sum is None:
+            counts_and_sum = [[0] * (len(self.buckets) + 1), 0]
+            self.values[labelvalues] = counts_and_sum
+        counts_and_sum[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts_and_sum[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_request(reader, writer):
+    try:
+        async with asyncio.timeout(METRICS_TIMEOUT_S):
+            await _respond(reader, writer)
+    except (ConnectionError, UnicodeDecodeError, ValueError, TimeoutError) as e:
+        log.info(f"metrics request failed: {e!r}")
+    finally:
+        writer.close()
+
+
+async def _respond(reader, writer):
+    request_line = await reader.readline()
+    # skip the headers
+    while (await reader.readline()).strip():
+        pass
+
+    parts = request_line.decode("latin-1").split()
+    if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+        status = "200 OK"
+        body = render().encode("utf-8")
+    else:
+        status = "404 Not Found"
+        body = b"not found\n"
+
+    headers = (
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+    )
+    writer.write(headers.encode("latin-1") + body)
+    await writer.drain()
+
+
+async def serve():
+    if not METRICS_PORT:
+        return
+    server = await asyncio.start_server(
+        _handle_request, host=METRICS_HOST, port=METRICS_PORT
+    )
+    log.info(f"metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import httpx
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# a circuit breaker per renderer, so that a renderer that's down costs
+# nothing instead of a connect timeout for every one of its shows:
+#
+# - closed: all good, shows go to the renderer
+# - open: the renderer failed (couldn't be reached, timed out, answered 5xx or
+#   stalled) RENDERER_FAILURE_THRESHOLD times in a row, its shows are skipped
+#   right away. a 4xx is the show's fault (i.e. a bad payload), not the
+#   renderer's, it doesn't count
+# - half open: RENDERER_RETRY_AFTER_S after opening -- or as soon as a probe
+#   gets an answer, if the renderer couldn't be reached -- one show gets to
+#   try. if it works the circuit closes, if not it opens again
+#
+# on top of that, every renderer gets probed (GET /info) every
+# RENDERER_PROBE_INTERVAL_S, so that a renderer going down is noticed before
+# one of its shows is due, and one coming back up is noticed right away. a
+# probe that gets an answer ends a run of failures. a probe that times out
+# while a show is streaming from the renderer doesn't count, the renderer is
+# just busy (i.e. a pi rendering a shader)
+RENDERER_FAILURE_THRESHOLD = int(os.environ.get("RENDERER_FAILURE_THRESHOLD", "2"))
+RENDERER_RETRY_AFTER_S = float(os.environ.get("RENDERER_RETRY_AFTER_S", "10"))
+RENDERER_PROBE_INTERVAL_S = float(os.environ.get("RENDERER_PROBE_INTERVAL_S", "5"))
+RENDERER_PROBE_TIMEOUT_S = 1
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = metrics.Gauge(
+    "rapidriter_renderer_circuit_state",
+    "0 = closed (healthy), 1 = half open (trying again), 2 = open (skipped)",
+    ("renderer",),
+)
+RENDERER_FAILURES = metrics.Counter(
+    "rapidriter_renderer_failures_total",
+    "failed requests, probes and stalled streams",
+    ("renderer", "reason"),
+)
+
+
+class RendererHealth:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.last_failure_reason = None
+        self.opened_at = 0
+        # when the half open trial started, None if there's none going on
+        self.trial_started_at = None
+        # shows streaming from the renderer right now
+        self.active_streams = 0
+
+
+HEALTH = {}
+
+
+def _health(renderer_name):
+    if renderer_name not in HEALTH:
+        HEALTH[renderer_name] = RendererHealth()
+        CIRCUIT_STATE.set(STATE_VALUES[CLOSED], renderer_name)
+    return HEALTH[renderer_name]
+
+
+def _set_state(renderer_name, health, state):
+    if health.state != state:
+        log.info(f"renderer {renderer_name}: circuit {health.state} -> {state}")
+    health.state = state
+    CIRCUIT_STATE.set(STATE_VALUES[state], renderer_name)
+
+
+def is_open(renderer_name):
+    return _health(renderer_name).state == OPEN
+
+
+def allow_request(renderer_name):
+    """
+    whether a show should go to the renderer now. while half open, only one
+    show at a time gets to try
+    """
+    health = _health(renderer_name)
+    now = time.monotonic()
+    if health.state == OPEN and now - health.opened_at >= RENDERER_RETRY_AFTER_S:
+        _set_state(renderer_name, health, HALF_OPEN)
+
+    if health.state == CLOSED:
+        return True
+    if health.state == HALF_OPEN and (
+        health.trial_started_at is None
+        # i.e. the trial show was cancelled before it could tell
+        or now - health.trial_started_at >= RENDERER_RETRY_AFTER_S
+    ):
+        health.trial_started_at = now
+        return True
+    return False
+
+
+def record_success(renderer_name):
+    health = _health(renderer_name)
+    health.failures = 0
+    health.trial_started_at = None
+    _set_state(renderer_name, health, CLOSED)
+
+
+def record_failure(renderer_name, reason):
+    health = _health(renderer_name)
+    health.failures += 1
+    health.last_failure_reason = reason
+    health.trial_started_at = None
+    RENDERER_FAILURES.inc(renderer_name, reason)
+    if health.state == HALF_OPEN or health.failures >= RENDERER_FAILURE_THRESHOLD:
+        health.opened_at = time.monotonic()
+        _set_state(renderer_name, health, OPEN)
+
+
+@contextmanager
+def streaming(renderer_name):
+    # around reading a show's frames from the renderer
+    health = _health(renderer_name)
+    health.active_streams += 1
+    try:
+        yield
+    finally:
+        health.active_streams -= 1
+
+
+async def probe(client, renderer_name, host):
+    health = _health(renderer_name)
+    try:
+        r = await client.get(host + "/info", timeout=RENDERER_PROBE_TIMEOUT_S)
+    except httpx.TimeoutException as e:
+        if health.active_streams:
+            log.info(f"renderer {renderer_name}: probe timed out while busy: {e!r}")
+        else:
+            log.info(f"renderer {renderer_name}: probe failed: {e!r}")
+            record_failure(renderer_name, "probe")
+        return
+    except httpx.HTTPError as e:
+        log.info(f"renderer {renderer_name}: probe failed: {e!r}")
+        record_failure(renderer_name, "probe")
+        return
+
+    if r.status_code >= 500:
+        record_failure(renderer_name, "probe")
+    elif health.state == CLOSED:
+        # i.e. a stall or a failed request before this one doesn't add up
+        # with one after it
+        health.failures = 0
+    elif health.state == OPEN and health.last_failure_reason in ("probe", "info"):
+        # it couldn't be reached, and now it answers (any answer, not every
+        # renderer has /info): let the next show find out if it renders.
+        # a renderer that answers but fails or stalls when rendering waits
+        # for RENDERER_RETRY_AFTER_S
+        _set_state(renderer_name, health, HALF_OPEN)
+
+
+async def probe_forever(client, renderer_hosts):
+    while True:
+        await asyncio.gather(
+            *(probe(client, name, host) for name, host in renderer_hosts.items())
+        )
+        await asyncio.sleep(RENDERER_PROBE_INTERVAL_S)
@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+from datetime import datetime
+
+import httpx
+import numpy as np
+
+import show_store
+
+log = logging.getLogger(__name__)
+
+# show bundles: a show as the frames that went (or would go) to the display,
+# with how long each one stays up. used to record what the worker sends, and
+# to move pre-rendered shows around / replay them without any renderer.
+#
+#   python show_bundle.py info recording.rrshow
+#   python show_bundle.py replay recording.rrshow --speed 2
+#   python show_bundle.py export 42 show42.rrshow
+#
+# file layout (little endian):
+# - HEADER, then the metadata as json (metadata_length bytes)
+# - the frames, one after the other, either as they are (width x height
+#   pixels packed like a renderer frame, 456 bytes for one display) or
+#   delta/rle encoded (see _encode_delta)
+# - the index at index_offset: for every frame, how long it stays up (ms) and
+#   where it starts in the file
+#
+# frame_count and index_offset are only filled in when the writer is closed,
+# a bundle that wasn't closed properly has no frames. that's why recordings
+# (see BundleRecorder) are split into segments of RECORD_SEGMENT_S
+
+MAGIC = b"RRSHOW\x00\x00"
+FORMAT_VERSION = 2
+# magic, format version, compression, width, height, frame_count, index_offset,
+# metadata_length
+HEADER = struct.Struct("<8sHHHHIQI")
+INDEX_DTYPE = np.dtype([("hold_ms", "<u4"), ("offset", "<u8")])
+
+# a recording goes into a new bundle every RECORD_SEGMENT_S, so that a worker
+# that's killed (or crashes) only loses the segment it was recording, and the
+# index kept in memory stays small
+RECORD_SEGMENT_S = float(os.environ.get("RECORD_SEGMENT_S", "300"))
+
+# one display
+WIDTH = 96
+HEIGHT = 38
+
+COMPRESSION_NONE = 0
+# every frame is xor-ed with the one before it (the first with all zeros),
+# and the result is run length encoded: a control byte c < 128 is followed by
+# c + 1 bytes as they are, c >= 128 stands for c - 125 zero bytes.
+# frames that don't change much (text, images, most animations) end up a few
+# bytes long
+COMPRESSION_DELTA_RLE = 1
+COMPRESSIONS = {"none": COMPRESSION_NONE, "delta": COMPRESSION_DELTA_RLE}
+
+MIN_ZERO_RUN = 3
+MAX_ZERO_RUN = 255 - 125
+MAX_LITERAL_RUN = 128
+ZERO_RUNS = re.compile(rb"\x00{%d,}" % MIN_ZERO_RUN)
+
+
+def _encode_literals(data, out):
+    for start in range(0, len(data), MAX_LITERAL_RUN):
+        chunk = data[start : start + MAX_LITERAL_RUN]
+        out.append(len(chunk) - 1)
+        out += chunk
+
+
+def _encode_delta(frame, previous):
+    delta = np.bitwise_xor(
+        np.frombuffer(frame, dtype=np.uint8), np.frombuffer(previous, dtype=np.uint8)
+    ).tobytes()
+    out = bytearray()
+    position = 0
+    for zeros in ZERO_RUNS.finditer(delta):
+        _encode_literals(delta[position : zeros.start()], out)
+        run = zeros.end() - zeros.start()
+        while run >= MIN_ZERO_RUN:
+            n = min(run, MAX_ZERO_RUN)
+            out.append(n + 125)
+            run -= n
+        # a leftover of 1 or 2 zeros goes in as literals
+        position = zeros.end() - run
+    _encode_literals(delta[position:], out)
+    return bytes(out)
+
+
+def _decode_delta(encoded, previous):
+    delta = bytearray(len(previous))
+    i = position = 0
+    while i < len(encoded):
+        c = encoded[i]
+        if c < 128:
+            delta[position : position + c + 1] = encoded[i + 1 : i + c + 2]
+            position += c + 1
+            i += c + 2
+        else:
+            # already zeros
+            position += c - 125
+            i += 1
+    return np.bitwise_xor(np.frombuffer(previous, dtype=np.uint8), delta).tobytes()
+
+
+class BundleWriter:
+    def __init__(
+        self,
+        path,
+        compression=COMPRESSION_NONE,
+        metadata=None,
+        width=WIDTH,
+        height=HEIGHT,
+    ):
+        self.file = open(path, "wb")
+        self.compression = compression
+        self.width, self.height = width, height
+        self.frame_size = width // 8 * height
+        self.index = []
+        self.previous = bytes(self.frame_size)
+        metadata_json = json.dumps(metadata or {}).encode("utf-8")
+        self.metadata_length = len(metadata_json)
+        self._write_header(frame_count=0, index_offset=0)
+        self.file.write(metadata_json)
+
+    def _write_header(self, frame_count, index_offset):
+        self.file.write(
+            HEADER.pack(
+                MAGIC,
+                FORMAT_VERSION,
+                self.compression,
+                self.width,
+                self.height,
+                frame_count,
+                index_offset,
+                self.metadata_length,
+            )
+        )
+
+    def add(self, frame, hold_s):
+        frame = bytes(frame)
+        assert len(frame) == self.frame_size
+        self.index.append((round(hold_s * 1000), self.file.tell()))
+        if self.compression == COMPRESSION_DELTA_RLE:
+            self.file.write(_encode_delta(frame, self.previous))
+            self.previous = frame
+        else:
+            self.file.write(frame)
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self.file.seek(0)
+        self._write_header(len(self.index), index_offset)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BundleRecorder:
+    """
+    records frames as they are sent to the display: every frame is held until
+    the next one comes along (or until the recorder is closed).
+
+    the recording goes into directory, a new bundle (named after when it
+    started, and its segment number) with the first frame that comes along
+    after segment_s
+    """
+
+    def __init__(
+        self,
+        directory,
+        metadata=None,
+        width=WIDTH,
+        height=HEIGHT,
+        segment_s=RECORD_SEGMENT_S,
+    ):
+        self.directory = directory
+        self.metadata = metadata or {}
+        self.width, self.height = width, height
+        self.segment_s = segment_s
+        self.segment = 0
+        self.writer = None
+        self.pending = None
+
+    def _start_segment(self, now):
+        started_at = datetime.now()
+        # the segment number keeps segments started in the same second apart
+        # (and one left there by a worker that was restarted within it)
+        while True:
+            path = os.path.join(
+                self.directory,
+                f"recording-{started_at:%Y%m%d-%H%M%S}-{self.segment:04d}.rrshow",
+            )
+            if not os.path.exists(path):
+                break
+            self.segment += 1
+        metadata = {
+            **self.metadata,
+            "recorded_at": started_at.isoformat(),
+            "segment": self.segment,
+        }
+        self.writer = BundleWriter(
+            path, COMPRESSION_DELTA_RLE, metadata, self.width, self.height
+        )
+        self.segment += 1
+        self.segment_started_at = now
+        log.info(f"recording to {path}")
+
+    def frame(self, frame):
+        now = time.monotonic()
+        if self.writer is None:
+            self._start_segment(now)
+        if self.pending is not None:
+            pending_frame, pending_at = self.pending
+            self.writer.add(pending_frame, now - pending_at)
+        if now - self.segment_started_at >= self.segment_s:
+            self.writer.close()
+            self._start_segment(now)
+        self.pending = bytes(frame), now
+
+    def close(self):
+        # the last frame was up until now
+        if self.pending is not None:
+            pending_frame, pending_at = self.pending
+            self.writer.add(pending_frame, time.monotonic() - pending_at)
+            self.pending = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ShowBundle:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            format_version,
+            self.compression,
+            self.width,
+            self.height,
+            frame_count,
+            index_offset,
+            metadata_length,
+        ) = HEADER.unpack_from(self.data)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"{path} isn't a version {FORMAT_VERSION} show bundle")
+
+        metadata_end = HEADER.size + metadata_length
+        self.metadata = json.loads(self.data[HEADER.size : metadata_end])
+        self.index = np.frombuffer(
+            self.data, dtype=INDEX_DTYPE, count=frame_count, offset=index_offset
+        )
+        self.index_offset = index_offset
+        self.frame_size = self.width // 8 * self.height
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def duration_s(self):
+        return int(self.index["hold_ms"].sum()) / 1000
+
+    def __iter__(self):
+        # yields (frame, seconds to hold the frame), like frame_cache.CachedShow
+        previous = bytes(self.frame_size)
+        holds_ms = self.index["hold_ms"].tolist()
+        starts = self.index["offset"].tolist()
+        # every frame ends where the next one starts
+        ends = starts[1:] + [self.index_offset]
+        for hold_ms, start, end in zip(holds_ms, starts, ends):
+            if self.compression == COMPRESSION_DELTA_RLE:
+                frame = previous = _decode_delta(self.data[start:end], previous)
+            else:
+                frame = self.data[start:end]
+            yield frame, hold_ms / 1000
+
+    def close(self):
+        # the index is a view into the mmap, it has to go first
+        self.index = None
+        self.data.close()
+
+
+def replay(path, speed=1):
+    # goes through send_frame_to_display, i.e. to the display, or the terminal
+    # with DO_NOT_SEND_TO_RITER=true. speed 0 means as fast as possible.
+    # (worker is imported here, it records with BundleRecorder)
+    import worker
+
+    bundle = ShowBundle(path)
+    started = time.monotonic()
+    due = 0
+    for frame, hold_s in bundle:
+        if speed:
+            time.sleep(max(0, started + due / speed - time.monotonic()))
+        worker.send_frame_to_display(frame)
+        due += hold_s
+    elapsed = time.monotonic() - started
+    log.info(f"replayed {len(bundle)} frames in {elapsed:.2f} s")
+    bundle.close()
+
+
+async def export(show_id, path, compression):
+    # renders a show (the same way the worker does) into a bundle. every frame
+    # is held for 1 / the show's frame rate, the last one until the renderer
+    # ended the show
+    import worker
+
+    async with httpx.AsyncClient(timeout=worker.RENDERER_READ_TIMEOUT_S) as client:
+        worker.HTTP_CLIENT = client
+        show = show_store.get_show(show_id) or await worker.get_show(show_id)
+        if show is None:
+            raise SystemExit(f"show id {show_id} not found")
+
+        stream_info = {}
+        frames = worker.receive_frames_from_renderer(
+            show["show_type"], show["payload"], stream_info
+        )
+        metadata = {"show_id": show_id, "show_type": show["show_type"]}
+        writer = previous = None
+        waiting_since = time.monotonic()
+        async for frame in frames:
+            if writer is None:
+                # the renderer drew on the whole canvas, or on one display
+                width, height = WIDTH, HEIGHT
+                if len(frame) == worker.CANVAS_FRAME_SIZE:
+                    width, height = worker.CANVAS_WIDTH, worker.CANVAS_HEIGHT
+                writer = BundleWriter(path, compression, metadata, width, height)
+            if previous is not None:
+                writer.add(previous, 1 / stream_info["frame_rate"])
+            previous = frame
+            waiting_since = time.monotonic()
+        if writer is None:
+            raise SystemExit(f"show id {show_id} didn't render any frames")
+        writer.add(
+            previous,
+            max(1 / stream_info["frame_rate"], time.monotonic() - waiting_since),
+        )
+        writer.close()
+        if not stream_info.get("completed"):
+            log.error(f"show id {show_id} didn't render all the way, bundle is partial")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="show bundles (.rrshow)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = commands.add_parser("info", help="what's in a bundle")
+    info_parser.add_argument("path")
+
+    replay_parser = commands.add_parser("replay", help="send a bundle to the display")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument(
+        "--speed", type=float, default=1, help="0 = as fast as possible"
+    )
+
+    export_parser = commands.add_parser("export", help="render a show into a bundle")
+    export_parser.add_argument("show_id", type=int)
+    export_parser.add_argument("path")
+    export_parser.add_argument(
+        "--compression", choices=COMPRESSIONS, default="delta"
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "info":
+        bundle = ShowBundle(args.path)
+        compression = {v: k for k, v in COMPRESSIONS.items()}[bundle.compression]
+        size = len(bundle.data)
+        print(json.dumps(bundle.metadata))
+        print(
+            f"{bundle.width}x{bundle.height}, {len(bundle)} frames, {bundle.duration_s:.2f} s, "
+            f"compression {compression}, {size} bytes "
+            f"({size / max(1, len(bundle) * bundle.frame_size) * 100:.1f}% of raw)"
+        )
+        bundle.close()
+    elif args.command == "replay":
+        replay(args.path, args.speed)
+    elif args.command == "export":
+        asyncio.run(
+            export(args.show_id, args.path, COMPRESSIONS[args.compression])
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# local copy of the shows from the web service (see sync_shows in worker.py),
+# so that the worker starts playing right away, and keeps playing when the
+# web service is down
+#
+# - state.json: {"version": ..., "etag": ..., "show_ids": [...]} as of the last sync
+# - shows/<id>.json: {"show_type": ..., "payload": ...} for every show in show_ids
+SHOW_STORE_DIR = Path(os.environ.get("SHOW_STORE_DIR", "./show_store"))
+
+STATE_PATH = SHOW_STORE_DIR / "state.json"
+SHOWS_DIR = SHOW_STORE_DIR / "shows"
+
+EMPTY_STATE = {"version": 0, "etag": None, "show_ids": []}
+
+
+def _write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write + rename so that a crash never leaves a half written file behind
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def load_state():
+    try:
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict(EMPTY_STATE)
+
+
+def save_state(state):
+    _write_json(STATE_PATH, state)
+
+
+def get_show(show_id):
+    try:
+        with open(SHOWS_DIR / f"{show_id}.json") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_show(show_id, show):
+    _write_json(SHOWS_DIR / f"{show_id}.json", show)
+
+
+def remove_shows_except(show_ids):
+    keep = {f"{show_id}.json" for show_id in show_ids}
+    for path in SHOWS_DIR.glob("*.json"):
+        if path.name not in keep:
+            log.info(f"show store: removing {path.name}")
+            path.unlink(missing_ok=True)
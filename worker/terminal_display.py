@@ -0,0 +1,150 @@
+import shutil
+import sys
+import time
+
+from frame_encoder import SCREEN_HEIGHT, SCREEN_WIDTH
+
+# stand-in for the display when DO_NOT_SEND_TO_RITER is set: draws the frames
+# in the terminal with ansi escapes.
+#
+# - every row string is put together from precomputed strings for whole bytes
+#   of the packed frame, the pixels are never unpacked one by one
+# - only the terminal lines that changed since the last drawn frame get
+#   redrawn, each one after a cursor move to its line
+# - with half_blocks, every terminal line shows two pixel rows using
+#   ▀ ▄ █, so that the screen keeps its aspect ratio (19 lines for one display)
+# - frames coming in faster than max_fps are skipped, but the last skipped one
+#   is drawn as soon as max_fps allows it (see catch_up), so a change is never
+#   lost
+# - the lines below the screen are made into a scroll region, so that log
+#   output scrolls there instead of shifting the screen up (which would leave
+#   the lines we don't redraw in the wrong place)
+
+# one string of 8 pixels for each possible byte, msb = leftmost pixel
+BYTE_PIXELS = [
+    "".join("#" if byte & (0x80 >> i) else "." for i in range(8)) for byte in range(256)
+]
+
+HALF_BLOCKS = " ▄▀█"  # indexed by (top pixel << 1) | bottom pixel
+
+HIDE_CURSOR = "\033[?25l"
+SHOW_CURSOR = "\033[?25h"
+CLEAR_SCREEN = "\033[2J"
+SAVE_CURSOR = "\0337"
+RESTORE_CURSOR = "\0338"
+RESET_SCROLL_REGION = "\033[r"
+
+
+def _half_block_pixels(top, bottom):
+    return "".join(
+        HALF_BLOCKS[(top >> (7 - i) & 1) << 1 | (bottom >> (7 - i) & 1)]
+        for i in range(8)
+    )
+
+
+class TerminalDisplay:
+    def __init__(
+        self,
+        half_blocks=False,
+        max_fps=0,
+        width=SCREEN_WIDTH,
+        height=SCREEN_HEIGHT,
+        out=sys.stdout,
+    ):
+        # width x height is the whole canvas, i.e. all the displays
+        self.height = height
+        self.row_bytes = width // 8
+        self.half_blocks = half_blocks
+        self.min_interval_s = 1 / max_fps if max_fps > 0 else 0
+        self.out = out
+        self.last_draw_at = None
+        self.last_frame = None
+        # the latest frame that came in too soon after the last one drawn
+        self.skipped_frame = None
+        # what is currently on every terminal line, as the frame bytes it
+        # was drawn from
+        self.lines_on_screen = None
+
+        if half_blocks:
+            # two pixel rows per line; an odd last row gets an empty row below it
+            self.line_rows = [(y, y + 1) for y in range(0, height, 2)]
+            # one string of 8 columns for every (top byte, bottom byte) pair,
+            # 65536 of them
+            self.pair_pixels = [
+                _half_block_pixels(top, bottom)
+                for top in range(256)
+                for bottom in range(256)
+            ]
+        else:
+            self.line_rows = [(y,) for y in range(height)]
+
+    def _line_bytes(self, frame, rows):
+        return b"".join(
+            frame[y * self.row_bytes : (y + 1) * self.row_bytes]
+            if y < self.height
+            else bytes(self.row_bytes)
+            for y in rows
+        )
+
+    def _line_string(self, line_bytes):
+        if self.half_blocks:
+            top, bottom = line_bytes[: self.row_bytes], line_bytes[self.row_bytes :]
+            return "".join(self.pair_pixels[t << 8 | b] for t, b in zip(top, bottom))
+        return "".join(BYTE_PIXELS[byte] for byte in line_bytes)
+
+    def draw(self, frame):
+        now = time.monotonic()
+        if (
+            self.last_draw_at is not None
+            and now - self.last_draw_at < self.min_interval_s
+        ):
+            self.skipped_frame = bytes(frame)
+            return
+        self.last_draw_at = now
+        self.skipped_frame = None
+
+        frame = bytes(frame)
+        if frame == self.last_frame:
+            return
+        self.last_frame = frame
+
+        output = []
+        if self.lines_on_screen is None:
+            self._set_up_terminal()
+            self.lines_on_screen = [None] * len(self.line_rows)
+
+        for i, rows in enumerate(self.line_rows):
+            line_bytes = self._line_bytes(frame, rows)
+            if line_bytes == self.lines_on_screen[i]:
+                continue
+            self.lines_on_screen[i] = line_bytes
+            # terminal lines and columns start at 1
+            output.append(f"\033[{i + 1};1H{self._line_string(line_bytes)}")
+
+        if output:
+            # put the cursor back where the log output left it
+            self.out.write(SAVE_CURSOR + "".join(output) + RESTORE_CURSOR)
+            self.out.flush()
+
+    def catch_up(self):
+        # draws the frame that was skipped last, if max_fps allows it by now.
+        # to be called when there's nothing new to draw, i.e. on every tick of
+        # the playout clock that didn't draw anything
+        if self.skipped_frame is not None:
+            self.draw(self.skipped_frame)
+
+    def _set_up_terminal(self):
+        screen_lines = len(self.line_rows)
+        terminal_lines = shutil.get_terminal_size().lines
+        setup = HIDE_CURSOR + CLEAR_SCREEN
+        if terminal_lines > screen_lines + 1:
+            # one empty line between the screen and the log output
+            setup += f"\033[{screen_lines + 2};{terminal_lines}r"
+        setup += f"\033[{screen_lines + 2};1H"
+        self.out.write(setup)
+        self.out.flush()
+
+    def close(self):
+        self.out.write(RESET_SCROLL_REGION + SHOW_CURSOR)
+        self.out.flush()
+
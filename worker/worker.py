@@ -2,25 +2,32 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import asyncio
 import base64
 import io
 import json
 import logging
 import os
+import signal
 import socket
-import threading
+import struct
 import time
-import threading
 
+from contextlib import aclosing
 from datetime import datetime
 from itertools import cycle
 from collections import deque
 
-import numpy as np
-import requests
-import sseclient
-from PIL import Image
-from requests.exceptions import ConnectionError
+import httpx
+
+import compositor
+import frame_cache
+import frame_encoder
+import metrics
+import renderer_health
+import show_bundle
+import show_store
+import terminal_display
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -29,115 +36,384 @@ log.info("Initializing Worker")
 DO_NOT_SEND_TO_RITER = os.environ["DO_NOT_SEND_TO_RITER"] == "true"
 WEB_SERVICE_HOST = os.environ["WEB_SERVICE_HOST"]
 
-RENDERER_URLS = {
-    "text": os.environ["RENDERER_TEXT_HOST"] + "/render",
-    "p5": os.environ["RENDERER_P5_HOST"] + "/render",
-    "shader": os.environ["RENDERER_SHADER_HOST"] + "/render",
-    "wasm": os.environ["RENDERER_WASM_HOST"] + "/render",
+RENDERER_HOSTS = {
+    "text": os.environ["RENDERER_TEXT_HOST"],
+    "p5": os.environ["RENDERER_P5_HOST"],
+    "shader": os.environ["RENDERER_SHADER_HOST"],
+    "wasm": os.environ["RENDERER_WASM_HOST"],
     # ---
-    # "osc": os.environ["RENDERER_OSC_HOST"] + "/render",
-    # "noise": "http://renderernoise/render",
-    # "image": "http://rendererimage/render",
+    # "osc": os.environ["RENDERER_OSC_HOST"],
+    # "noise": "http://renderernoise",
+    # "image": "http://rendererimage",
 }
+RENDERER_URLS = {name: host + "/render" for name, host in RENDERER_HOSTS.items()}
 
 # PROD i.e. disco on raspi
-SCREEN_UDP_IP = "10.0.0.42"
-SCREEN_UDP_PORT = 6450
-
-SCREEN_WIDTH = 96
-SCREEN_HEIGHT = 38
+SCREEN_UDP_IP = os.environ.get("SCREEN_UDP_IP", "10.0.0.42")
+SCREEN_UDP_PORT = int(os.environ.get("SCREEN_UDP_PORT", "6450"))
+
+# more than one display: frames are CANVAS_WIDTH x CANVAS_HEIGHT, and every
+# display shows its own 96x38 tile of that canvas, i.e. two side by side:
+#
+#   CANVAS_WIDTH=192 DISPLAYS="10.0.0.42:6450@0,0 10.0.0.43:6450@96,0"
+#
+# displays at the same position show the same thing. renderers are told the
+# canvas size with an X-Canvas-Size header, the frames of those that ignore it
+# (i.e. 96x38 ones) are shown on every display
+CANVAS_WIDTH = int(os.environ.get("CANVAS_WIDTH", frame_encoder.SCREEN_WIDTH))
+CANVAS_HEIGHT = int(os.environ.get("CANVAS_HEIGHT", frame_encoder.SCREEN_HEIGHT))
+CANVAS_FRAME_SIZE = CANVAS_WIDTH // 8 * CANVAS_HEIGHT
+
+
+def parse_displays(spec):
+    # "ip:port@x,y ip:port@x,y ..." -> [((ip, port), (x, y))], @x,y defaults to 0,0
+    displays = []
+    for display in spec.split():
+        address, _, position = display.partition("@")
+        ip, _, port = address.rpartition(":")
+        x, _, y = (position or "0,0").partition(",")
+        displays.append(((ip, int(port)), (int(x), int(y))))
+    return displays
+
+
+DISPLAYS = parse_displays(
+    os.environ.get("DISPLAYS", f"{SCREEN_UDP_IP}:{SCREEN_UDP_PORT}@0,0")
+)
+if CANVAS_WIDTH % 8:
+    raise ValueError(f"CANVAS_WIDTH={CANVAS_WIDTH} has to be a multiple of 8")
+DISPLAY_ADDRESSES = [address for address, _ in DISPLAYS]
+DISPLAY_TILES = [tile for _, tile in DISPLAYS]
+# see frame_encoder.py
+TILE_INDEX = frame_encoder.tile_index(CANVAS_WIDTH, CANVAS_HEIGHT, DISPLAY_TILES)
+MIRROR_INDEX = frame_encoder.mirror_index(CANVAS_WIDTH, CANVAS_HEIGHT, DISPLAY_TILES)
 
 SCREEN_SOCK = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
+# a display that can't keep up shouldn't hold up the others (or the worker):
+# a frame that doesn't fit in the socket buffer is dropped
+SCREEN_SOCK.setblocking(False)
+# every frame gets encoded into this same buffer, one row per display
+SCREEN_BUFFERS = frame_encoder.new_tiles_buffer(len(DISPLAYS))
+
+# a frame that's identical to the previous one isn't sent again (text and
+# image shows repeat the same frame a lot), unless the previous one was sent
+# more than DISPLAY_MAX_HOLD_S ago -- so the display still gets refreshed
+# every now and then, i.e. if it missed a packet or was restarted. when no
+# frames come at all (a slow show, a renderer holding its last frame), the
+# last one is sent again after DISPLAY_MAX_HOLD_S (see play)
+DISPLAY_MAX_HOLD_S = float(os.environ.get("DISPLAY_MAX_HOLD_S", "1"))
+LAST_SENT_FRAME = None
+LAST_SENT_AT = 0
+
+# with RECORD_DIR set, everything that's sent to the display is also recorded
+# into a show bundle there, one per run of the worker (see show_bundle.py)
+RECORD_DIR = os.environ.get("RECORD_DIR")
+RECORDER = None
+
+# with DO_NOT_SEND_TO_RITER, frames are drawn in the terminal instead, see
+# terminal_display.py. half blocks draw two pixel rows per line, and frames
+# coming faster than SIMULATOR_MAX_FPS are skipped (0 = no limit)
+SIMULATOR_HALF_BLOCKS = os.environ.get("SIMULATOR_HALF_BLOCKS", "false") == "true"
+SIMULATOR_MAX_FPS = float(os.environ.get("SIMULATOR_MAX_FPS", "40"))
+TERMINAL_DISPLAY = (
+    terminal_display.TerminalDisplay(
+        SIMULATOR_HALF_BLOCKS, SIMULATOR_MAX_FPS, CANVAS_WIDTH, CANVAS_HEIGHT
+    )
+    if DO_NOT_SEND_TO_RITER
+    else None
+)
 
 RENDERER_CONNECT_TIMEOUT_S = 5
 RENDERER_READ_TIMEOUT_S = 5
 
-SHOW_IDS_TO_PLAY = deque()
-SHOW_IMMEDIATELY_FLAG = threading.Event()
+# one client for everything, so that connections to the web service and to
+# the renderers are kept alive and reused. set up in main()
+HTTP_CLIENT = None
 
-def receive_frames_from_renderer(renderer_name, json_payload=None):
+SHOW_IDS_TO_PLAY = deque()
+# the task playing the current show -- a show_immediately event cancels it,
+# which tears down the current renderer stream right away
+PLAYING_TASK = None
+# when the last show_immediately event came in (time.monotonic())
+SHOW_IMMEDIATELY_AT = None
+# the shows queued by show_immediately events, they're fetched from the web
+# service rather than show_store -- they've usually just been edited, and the
+# next sync might not have happened yet
+SHOW_IMMEDIATELY_IDS = set()
+
+# how many frames of the *next* show we buffer while the current show is
+# still playing. the renderer stream for the next show is opened as soon as
+# the current show starts, so that switching shows doesn't leave the display
+# frozen during the http round trip + renderer cold start
+PREROLL_DEPTH = int(os.environ.get("PREROLL_DEPTH", "40"))
+
+# renderers tell us (via GET /info) if they always render the same frames for
+# the same payload, and which version of their rendering code is running.
+# we only ask every so often
+RENDERER_INFO_TTL_S = 60
+RENDERER_INFO = {}
+
+# raw frames, each one prefixed with its length as a big-endian uint16, and
+# a length of 0 at the end of the show. renderers that don't know about it
+# just answer with SSE (base64 frames in screen_update events)
+FRAMES_MIMETYPE = "application/x-rapidriter-frames"
+FRAME_LENGTH = struct.Struct(">H")
+
+# the worker owns the playout clock: it ticks DISPLAY_FPS times a second (the
+# display tops out at around 40 fps) and on every tick sends the latest frame
+# that is due, if any. when frames are due comes from the show's frame rate,
+# which renderers declare with an X-Frame-Rate response header
+DISPLAY_FPS = float(os.environ.get("DISPLAY_FPS", "40"))
+# transitions between shows and an overlay on top, see compositor.py
+COMPOSITOR = compositor.Compositor(CANVAS_WIDTH, CANVAS_HEIGHT, DISPLAY_FPS)
+DEFAULT_FRAME_RATE = 10
+# a show's clock only starts once this many of its frames are buffered (or
+# once it's done), so that a renderer being a little late here and there
+# doesn't make it miss its deadlines. pre-rolled shows usually have them already
+JITTER_BUFFER_FRAMES = int(os.environ.get("JITTER_BUFFER_FRAMES", "3"))
+# a renderer that doesn't send the next frame within RENDERER_STALL_FRAMES frame
+# periods (and at least RENDERER_STALL_MIN_S) is stalled: the show ends there
+# and the next one takes over, instead of the display sitting on the last
+# frame until the read timeout. the first frame gets the whole read timeout.
+# a renderer that holds frames for longer than its frame rate says declares
+# the longest hold (in seconds) with an X-Max-Hold header, and gets that
+# much more time
+RENDERER_STALL_FRAMES = float(os.environ.get("RENDERER_STALL_FRAMES", "3"))
+RENDERER_STALL_MIN_S = float(os.environ.get("RENDERER_STALL_MIN_S", "1"))
+
+# served on /metrics, see metrics.py
+SHOW_LABELS = ("show_type", "show_id")
+TIME_TO_FIRST_FRAME = metrics.Histogram(
+    "rapidriter_renderer_time_to_first_frame_seconds",
+    "time from the render request to the first frame",
+    ("show_type",),
+    metrics.SLOW_BUCKETS,
+)
+FRAMES_RECEIVED = metrics.Counter(
+    "rapidriter_frames_received_total",
+    "frames received from renderers (or the frame cache, with source=cache)",
+    (*SHOW_LABELS, "source"),
+)
+FRAMES_PLAYED = metrics.Counter(
+    "rapidriter_frames_played_total",
+    "frames sent to the output on the playout clock",
+    SHOW_LABELS,
+)
+FRAMES_DROPPED = metrics.Counter(
+    "rapidriter_frames_dropped_total",
+    "frames skipped because a later one was due on the same tick",
+    SHOW_LABELS,
+)
+FRAMES_LATE = metrics.Counter(
+    "rapidriter_frames_late_total",
+    "frames that showed up after they were due, i.e. renderer stalls",
+    SHOW_LABELS,
+)
+SHOW_FPS = metrics.Gauge(
+    "rapidriter_show_fps",
+    "frames per second played over the last run of the show",
+    SHOW_LABELS,
+)
+DISPLAY_FRAMES = metrics.Counter(
+    "rapidriter_display_frames_total",
+    "frames that reached the output, sent or suppressed as identical to the last one",
+    ("outcome",),
+)
+FRAME_DECODE_SECONDS = metrics.Histogram(
+    "rapidriter_frame_decode_seconds",
+    "time to get a frame out of the renderer stream",
+    ("transport",),
+)
+FRAME_PACK_SECONDS = metrics.Histogram(
+    "rapidriter_frame_pack_seconds",
+    "time to encode a frame for the display and send it",
+)
+UDP_SEND_ERRORS = metrics.Counter(
+    "rapidriter_udp_send_errors_total",
+    "frames that couldn't be sent to the display",
+)
+SHOWS_SKIPPED = metrics.Counter(
+    "rapidriter_shows_skipped_total",
+    "shows that weren't played, because their renderer is down or rejected them",
+    ("show_type", "reason"),
+)
+PREEMPTION_SECONDS = metrics.Histogram(
+    "rapidriter_show_immediately_seconds",
+    "time from a show_immediately event to the first frame of that show",
+    buckets=metrics.SLOW_BUCKETS,
+)
+
+
+async def receive_binary_frames(response, stream_info):
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        while len(buffer) >= FRAME_LENGTH.size:
+            (length,) = FRAME_LENGTH.unpack_from(buffer)
+            if length == 0:
+                stream_info["completed"] = True
+                return
+            if len(buffer) < FRAME_LENGTH.size + length:
+                break
+            started = time.perf_counter()
+            frame = bytes(buffer[FRAME_LENGTH.size : FRAME_LENGTH.size + length])
+            del buffer[: FRAME_LENGTH.size + length]
+            FRAME_DECODE_SECONDS.observe(time.perf_counter() - started, "binary")
+            yield frame
+
+
+async def receive_sse_events(response):
+    # yields (event, data) -- just enough of the SSE format for the renderers
+    # and django_eventstream
+    event, data = "message", []
+    async for line in response.aiter_lines():
+        if not line:
+            if data or event != "message":
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith(":"):
+            # comment
+            continue
+        else:
+            field, _, value = line.partition(":")
+            value = value.removeprefix(" ")
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+
+async def receive_sse_frames(response, stream_info):
+    async for event, data in receive_sse_events(response):
+        if event == "screen_update":
+            started = time.perf_counter()
+            image_bytes = base64.b64decode(data)
+            FRAME_DECODE_SECONDS.observe(time.perf_counter() - started, "sse")
+            yield image_bytes
+        elif event == "end":
+            stream_info["completed"] = True
+            return
+
+
+async def receive_frames_from_renderer(renderer_name, json_payload, stream_info):
+    # stream_info gets the stream's "frame_rate" and "max_hold_s" (see
+    # RENDERER_STALL_FRAMES) before the first frame,
+    # "completed" if the renderer got all the way to the end of the show
+    # (see frame_cache), "error" if the request failed because of the
+    # renderer (it couldn't be reached, timed out or answered 5xx), and
+    # "rejected" if it was the show's fault (4xx, i.e. a bad payload)
+    requested_at = time.monotonic()
     try:
-        response = requests.post(
-            RENDERER_URLS[renderer_name],
-            headers={
-                "Accept": "text/event-stream",
-                "Content-Type": "application/json",
-            },
-            stream=True,
-            json=json_payload,
-            # timeout is a tuple of (connect, read) second timeout values
-            timeout=(RENDERER_CONNECT_TIMEOUT_S, RENDERER_READ_TIMEOUT_S),
-        )
-    except requests.RequestException as e:
+        # probes don't count it against the renderer if it's slow to answer
+        # meanwhile, see renderer_health.py
+        with renderer_health.streaming(renderer_name):
+            async with HTTP_CLIENT.stream(
+                "POST",
+                RENDERER_URLS[renderer_name],
+                headers={
+                    "Accept": f"{FRAMES_MIMETYPE}, text/event-stream;q=0.9",
+                    "Content-Type": "application/json",
+                    "X-Canvas-Size": f"{CANVAS_WIDTH}x{CANVAS_HEIGHT}",
+                },
+                json=json_payload,
+            ) as response:
+                if not response.is_success:
+                    await response.aread()
+                    log.error("request failed!! %s", response.text)
+                    if response.is_client_error:
+                        stream_info["rejected"] = f"status {response.status_code}"
+                    else:
+                        stream_info["error"] = f"status {response.status_code}"
+                    return
+
+                stream_info["frame_rate"] = float(
+                    response.headers.get("X-Frame-Rate", DEFAULT_FRAME_RATE)
+                )
+                stream_info["max_hold_s"] = float(
+                    response.headers.get("X-Max-Hold", 0)
+                )
+
+                content_type = response.headers.get("Content-Type", "")
+                if content_type.startswith(FRAMES_MIMETYPE):
+                    frames = receive_binary_frames(response, stream_info)
+                else:
+                    frames = receive_sse_frames(response, stream_info)
+
+                async with aclosing(frames):
+                    first_frame = True
+                    async for frame in frames:
+                        if first_frame:
+                            TIME_TO_FIRST_FRAME.observe(
+                                time.monotonic() - requested_at, renderer_name
+                            )
+                            first_frame = False
+                        yield frame
+    except httpx.HTTPError as e:
         log.error("request exception!! %s", e)
+        stream_info["error"] = repr(e)
+
+
+def to_canvas(frame):
+    # a 96x38 frame from a renderer that doesn't know about the canvas goes on
+    # every display
+    if len(frame) != CANVAS_FRAME_SIZE:
+        assert len(frame) == frame_encoder.FRAME_SIZE
+        frame = frame_encoder.mirror_to_canvas(frame, MIRROR_INDEX)
+    return frame
+
+
+def send_frame_to_display(pillow_raw_image_data, force=False):
+    # pillow_raw_image_data is the raw data of a mode "1" image the size of
+    # the canvas, or 96x38 (i.e. exactly 456 bytes) to show on every display.
+    # force sends it even if it's the frame that was just sent
+    global LAST_SENT_FRAME, LAST_SENT_AT
+    pillow_raw_image_data = to_canvas(pillow_raw_image_data)
+
+    now = time.monotonic()
+    if (
+        not force
+        and pillow_raw_image_data == LAST_SENT_FRAME
+        and now - LAST_SENT_AT < DISPLAY_MAX_HOLD_S
+    ):
+        DISPLAY_FRAMES.inc("suppressed")
+        if DO_NOT_SEND_TO_RITER:
+            TERMINAL_DISPLAY.catch_up()
         return
-
-    if not response.ok:
-        log.error("request failed!! %s", response.text)
-        return
-
-    assert response.status_code == 200
-
-    try:
-        for event in sseclient.SSEClient(response).events():
-            if event.event == "screen_update":
-                base64_text = event.data
-                image_bytes = base64.b64decode(base64_text)
-                yield image_bytes
-            elif event.event == "end":
-                return
-    except requests.RequestException as e:
-        # log.error("request exception!! %s", e)
-        return
-
-
-def send_frame_to_display(pillow_raw_image_data):
-    # FIXME
-    # FIXME
-    # FIXME
-    # THIS ASSUMES THAT pillow_raw_image_data WAS IN MODE 1!!!!
-    # IT MIGHT NOT BE!!!
-
-    # expecting base64 1 channel png, fail otherwise
-    pil_image = Image.frombytes("1", (96, 38), pillow_raw_image_data)
-    # assert that it's exactly 96x38
-    assert pil_image.size == (SCREEN_WIDTH, SCREEN_HEIGHT)
-    # assert that its mode is 1 i.e. black and white
-    assert pil_image.mode == "1"
-
-    frame = np.zeros((SCREEN_HEIGHT * SCREEN_WIDTH, 1), bool)
-
-    np_image = np.asarray(pil_image)
-
-    # flip img from right-left to left-right
-    np_image = np.flip(np_image, 1)
-
-    frame_packed_bits = np.packbits(
-        np_image.astype("bool"), axis=None, bitorder="little"
-    )
+    # a copy, the frame could be a view into something that changes
+    LAST_SENT_FRAME = bytes(pillow_raw_image_data)
+    LAST_SENT_AT = now
+    DISPLAY_FRAMES.inc("sent")
+    if RECORDER is not None:
+        RECORDER.frame(LAST_SENT_FRAME)
 
     if DO_NOT_SEND_TO_RITER:
-        # go through the lines and columns
-        # and print '.' for 0 bit and '#' for 1 bit
-        # clear terminal!!!!!
-
-        # alternative, minimal-frame debugging - sometimes
-        # necessary to better see the other print output here
-        # print('F', end='', flush=True)
-
-        lines = []
-        for y in range(SCREEN_HEIGHT):
-            line = ""
-            for x in range(SCREEN_WIDTH - 1, 0, -1):
-                line += "#" if np_image[y][x] == 1 else "."
-            lines.append(line)
-        frame = "\033[H" + "\n".join(lines)
-        print(frame, flush=True)
+        TERMINAL_DISPLAY.draw(pillow_raw_image_data)
     else:
-        SCREEN_SOCK.sendto(frame_packed_bits, (SCREEN_UDP_IP, SCREEN_UDP_PORT))
-
-
-def consume_server_side_events():
+        started = time.perf_counter()
+        frames_packed_bits = frame_encoder.encode_tiles(
+            pillow_raw_image_data, TILE_INDEX, SCREEN_BUFFERS
+        )
+        for frame_packed_bits, address in zip(frames_packed_bits, DISPLAY_ADDRESSES):
+            try:
+                SCREEN_SOCK.sendto(frame_packed_bits, address)
+            except OSError as e:
+                # i.e. no route to the display or the socket buffer is full,
+                # try again with the next frame
+                if not UDP_SEND_ERRORS.get():
+                    log.error(f"error sending frame to display {address}: {e}")
+                UDP_SEND_ERRORS.inc()
+        FRAME_PACK_SECONDS.observe(time.perf_counter() - started)
+
+
+def show_immediately(show_id):
+    global SHOW_IMMEDIATELY_AT
+    SHOW_IMMEDIATELY_AT = time.monotonic()
+    SHOW_IMMEDIATELY_IDS.add(show_id)
+    SHOW_IDS_TO_PLAY.appendleft(show_id)
+    if PLAYING_TASK is not None:
+        PLAYING_TASK.cancel()
+
+
+async def consume_server_side_events():
     print("consume_server_side_events")
     # consume WEB_SERVICE_HOST + "/internalapi/events"
     # to set the current show and change to osc mode
@@ -146,61 +422,107 @@ def consume_server_side_events():
         print("consume_server_side_events loop")
 
         try:
-            response = requests.get(
+            async with HTTP_CLIENT.stream(
+                "GET",
                 WEB_SERVICE_HOST + "/internalapi/events",
                 headers={
                     "Accept": "text/event-stream",
                     "Content-Type": "application/json",
                 },
-                stream=True,
-            )
+                # this one stays open for as long as it can
+                timeout=httpx.Timeout(RENDERER_READ_TIMEOUT_S, read=None),
+            ) as response:
+                print('consume_server_side_events response???', response)
+
+                if not response.is_success:
+                    await response.aread()
+                    print("consume_server_side_events response not ok!!!", response.text)
+                else:
+                    async for event, data in receive_sse_events(response):
+                        print('consume_server_side_events event!!!', event, data)
+
+                        # we get 'keep-alive' events from the server, which are nice, sure,
+                        # but they are defffffffinitely not something we want to queue or care
+                        # about!!!
+
+                        if event == "keep-alive":
+                            continue
+
+                        if event == 'show_immediately':
+                            show_immediately(json.loads(data)["show_id"])
         except Exception as e:
-            print("consume_server_side_events exception!!!", e)
-            time.sleep(1)
-            continue
+            print("consume_server_side_events exception during event loop!!!", e)
 
-        print('consume_server_side_events response???', response)
+        print('consume_server_side_events sleep')
+        await asyncio.sleep(1)
 
-        if not response.ok:
-            print("consume_server_side_events response not ok!!!", response.text)
-            time.sleep(1)
-            continue
 
-        try:
-            for event in sseclient.SSEClient(response).events():
-                print('consume_server_side_events event!!!', event)
+async def get_renderer_info(renderer_name):
+    fetched_at, info = RENDERER_INFO.get(renderer_name, (0, {}))
+    # no point asking a renderer that's down, what we knew still holds (i.e.
+    # whether its shows can be played from the frame cache)
+    if (
+        time.monotonic() - fetched_at < RENDERER_INFO_TTL_S
+        or renderer_health.is_open(renderer_name)
+    ):
+        return info
 
-                # we get 'keep-alive' events from the server, which are nice, sure,
-                # but they are defffffffinitely not something we want to queue or care
-                # about!!!
+    try:
+        r = await HTTP_CLIENT.get(RENDERER_HOSTS[renderer_name] + "/info")
+        # renderers without an /info endpoint are assumed to be non-deterministic
+        info = r.json() if r.is_success else {}
+    except Exception as e:
+        log.error(f"error fetching renderer info for {renderer_name}: {e}")
+        renderer_health.record_failure(renderer_name, "info")
 
-                if event.event == "keep-alive":
-                    continue
+    RENDERER_INFO[renderer_name] = (time.monotonic(), info)
+    return info
 
-                if event.event == 'show_immediately':
-                    SHOW_IDS_TO_PLAY.appendleft(json.loads(event.data)["show_id"])
-                    SHOW_IMMEDIATELY_FLAG.set()
-        except Exception as e:
-            print("consume_server_side_events exception during event loop!!!", e)
 
-        print('consume_server_side_events sleep')
-        time.sleep(1)
+async def sync_shows():
+    # brings show_store up to date with the web microservice, in one request
+    # (or a 304 if nothing changed), and returns the ids of the shows to play.
+    # if the web service can't be reached, we go on with what we have
+    state = show_store.load_state()
 
+    headers = {}
+    if state["etag"]:
+        headers["If-None-Match"] = state["etag"]
 
-def get_all_show_ids():
-    # fetch all shows from the web microservice
     try:
-        r = requests.get(WEB_SERVICE_HOST + "/internalapi/get_all_show_ids")
+        r = await HTTP_CLIENT.get(
+            WEB_SERVICE_HOST + "/internalapi/shows",
+            params={"since": state["version"]},
+            headers=headers,
+        )
+        if r.status_code == 304:
+            return state["show_ids"]
+        r.raise_for_status()
+        json_response = r.json()
     except Exception as e:
-        log.error(f"error fetching all show ids: {e}")
-        return []
-    json_response = r.json()
-    # just a list of ids!
-    return json_response["show_ids"]
+        log.error(f"error syncing shows, playing the ones we already have: {e}")
+        return state["show_ids"]
 
-def get_show(show_id):
+    # only the shows that changed since state["version"] are in there
+    for show_id, show in json_response["shows"].items():
+        show_store.save_show(show_id, show)
+    show_store.remove_shows_except(json_response["show_ids"])
+
+    log.info(
+        f"synced shows: {len(json_response['shows'])} updated, "
+        f"{len(json_response['show_ids'])} in total"
+    )
+    state = {
+        "version": json_response["version"],
+        "etag": r.headers.get("ETag"),
+        "show_ids": json_response["show_ids"],
+    }
+    show_store.save_state(state)
+    return state["show_ids"]
+
+async def get_show(show_id):
     try:
-        r = requests.get(
+        r = await HTTP_CLIENT.get(
             WEB_SERVICE_HOST + f"/internalapi/get_show/{show_id}"
         )
     except Exception as e:
@@ -208,41 +530,393 @@ def get_show(show_id):
         return None
 
     # handle 404/errors by returning None!
-    if not r.ok:
+    if not r.is_success:
         return None
     json_response = r.json()
     return json_response
 
-def worker():
-    while True:
-        log.info("worker loop")
+class PrerolledShow:
+    """
+    fetches a show and reads its renderer stream in a background task,
+    into a bounded buffer of at most PREROLL_DEPTH frames. that buffer is
+    also what absorbs the jitter of the renderer and of the network.
+
+    every frame goes into the buffer along with its due time, in seconds from
+    the start of the show -- computed from the show's frame rate, or from the
+    holds recorded in the frame cache.
+
+    iterating over it plays the show on the worker's clock (see __aiter__)
+    """
+
+    def __init__(self, show_id, fetch_fresh=False):
+        self.show_id = show_id
+        self.fetch_fresh = fetch_fresh
+        # when it was taken off SHOW_IDS_TO_PLAY (time.monotonic())
+        self.created_at = time.monotonic()
+        # known once the show is fetched, for metrics
+        self.show_type = "unknown"
+        self.frames = asyncio.Queue(maxsize=PREROLL_DEPTH)
+        self.task = asyncio.create_task(self._fill())
+
+    async def _fill(self):
+        end_due = 0
+        try:
+            # shows that aren't in the store (i.e. previews sent with
+            # show_immediately) come straight from the web service, and so do
+            # those queued by show_immediately (unless it can't be reached)
+            if self.fetch_fresh:
+                show = await get_show(self.show_id) or show_store.get_show(
+                    self.show_id
+                )
+            else:
+                show = show_store.get_show(self.show_id) or await get_show(
+                    self.show_id
+                )
+            if show is None:
+                log.info(f"show id {self.show_id} not found, skipping")
+                return
+            self.show_type = show["show_type"]
+
+            key = None
+            renderer_info = await get_renderer_info(show["show_type"])
+            if renderer_info.get("deterministic"):
+                key = frame_cache.cache_key(
+                    show["show_type"],
+                    show["payload"],
+                    renderer_info.get("version"),
+                    f"{CANVAS_WIDTH}x{CANVAS_HEIGHT}",
+                )
+                cached_show = frame_cache.lookup(key)
+                if cached_show is not None:
+                    log.info(f"show id {self.show_id} playing from frame cache")
+                    # the renderer isn't involved at all, the frames are
+                    # due according to the holds that were recorded
+                    for frame, hold in cached_show:
+                        FRAMES_RECEIVED.inc(self.show_type, self.show_id, "cache")
+                        await self.frames.put((end_due, frame))
+                        end_due += hold
+                    return
+
+            if not renderer_health.allow_request(self.show_type):
+                log.info(
+                    f"show id {self.show_id}: renderer {self.show_type} is down, "
+                    f"skipping"
+                )
+                SHOWS_SKIPPED.inc(self.show_type, "renderer_down")
+                return
+
+            stream_info = {}
+            frames = receive_frames_from_renderer(
+                show["show_type"], show["payload"], stream_info
+            )
+            if key is not None:
+                frames = frame_cache.record(key, frames, stream_info)
+
+            async with aclosing(frames):
+                i = 0
+                stall_timeout_s = None
+                while True:
+                    try:
+                        async with asyncio.timeout(stall_timeout_s):
+                            frame = await anext(frames)
+                    except StopAsyncIteration:
+                        break
+                    except TimeoutError:
+                        log.error(
+                            f"show id {self.show_id}: renderer {self.show_type} "
+                            f"stalled after {i} frames, moving on"
+                        )
+                        renderer_health.record_failure(self.show_type, "stall")
+                        return
+
+                    FRAMES_RECEIVED.inc(self.show_type, self.show_id, "renderer")
+                    stall_timeout_s = max(
+                        RENDERER_STALL_MIN_S,
+                        RENDERER_STALL_FRAMES / stream_info["frame_rate"],
+                        stream_info.get("max_hold_s", 0) + RENDERER_STALL_MIN_S,
+                    )
+                    await self.frames.put((i / stream_info["frame_rate"], frame))
+                    i += 1
+                    # i.e. the last frame stays up for one frame, or for however
+                    # long the renderer takes to end the show
+                    end_due = i / stream_info["frame_rate"]
+
+            if "error" in stream_info:
+                renderer_health.record_failure(self.show_type, "request")
+            else:
+                # a show the renderer rejected only fails itself, the renderer
+                # answered just fine
+                if "rejected" in stream_info:
+                    SHOWS_SKIPPED.inc(self.show_type, "rejected")
+                renderer_health.record_success(self.show_type)
+        finally:
+            # None marks the end of the show -- unless we've been cancelled,
+            # then no one is listening anymore
+            if not self.task.cancelling():
+                await self.frames.put((end_due, None))
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def __aiter__(self):
+        """
+        ticks DISPLAY_FPS times a second, and on each tick yields the latest
+        frame that is due -- or None if there's none, so that the compositor
+        can go on animating (transitions, the overlay) between frames.
+
+        if several frames are due on a tick, only the latest one is sent and
+        the others are dropped. if a frame shows up after it was due, it's sent
+        right away, and counted as late (the previous frame stayed up longer,
+        i.e. it got duplicated)
+        """
+        period = 1 / DISPLAY_FPS
+        sent = dropped = late = 0
+
+        # the show's clock starts when the jitter buffer is filled up. the
+        # ticks go on meanwhile, i.e. for the display's keep-alive
+        while (
+            self.frames.qsize() < min(JITTER_BUFFER_FRAMES, PREROLL_DEPTH)
+            and not self.task.done()
+        ):
+            yield None
+            await asyncio.sleep(period)
+        pending = await self.frames.get()
+
+        start = deadline = time.monotonic()
+        previous_elapsed = -1
+        try:
+            while True:
+                elapsed = time.monotonic() - start
+                frame_to_send = None
+                ended = False
+
+                while True:
+                    if pending is None:
+                        try:
+                            pending = self.frames.get_nowait()
+                        except asyncio.QueueEmpty:
+                            break
+                    due, frame = pending
+                    if due > elapsed:
+                        break
+                    pending = None
+                    if frame is None:
+                        ended = True
+                        break
+                    if frame_to_send is not None:
+                        dropped += 1
+                    frame_to_send, frame_due = frame, due
+
+                if frame_to_send is not None:
+                    sent += 1
+                    # i.e. it should have been sent on the previous tick already
+                    if previous_elapsed >= frame_due:
+                        late += 1
+                    yield frame_to_send
+                elif not ended:
+                    yield None
+                previous_elapsed = elapsed
+
+                if ended:
+                    return
+
+                deadline += period
+                now = time.monotonic()
+                if now - deadline > period:
+                    # we fell behind (i.e. the machine was busy), don't try
+                    # to catch up on the ticks we missed
+                    deadline = now
+                await asyncio.sleep(max(0, deadline - now))
+        finally:
+            log.info(
+                f"show id {self.show_id}: {sent} frames sent, "
+                f"{dropped} dropped, {late} late (underruns)"
+            )
+            labels = (self.show_type, self.show_id)
+            FRAMES_PLAYED.inc(*labels, amount=sent)
+            FRAMES_DROPPED.inc(*labels, amount=dropped)
+            FRAMES_LATE.inc(*labels, amount=late)
+            played_s = time.monotonic() - start
+            if played_s > 0:
+                SHOW_FPS.set(sent / played_s, *labels)
+
 
-        all_show_ids = get_all_show_ids()
+LAST_PLAYLIST_FETCH = 0
+
+
+async def preroll_next_show():
+    global LAST_PLAYLIST_FETCH
+
+    if not len(SHOW_IDS_TO_PLAY):
+        # don't go through the playlist more than once a second, i.e. if
+        # every show is failing
+        await asyncio.sleep(max(0, LAST_PLAYLIST_FETCH + 1 - time.monotonic()))
+        LAST_PLAYLIST_FETCH = time.monotonic()
+
+        log.info("worker loop")
         # push them onto the deque
-        for show_id in all_show_ids:
+        for show_id in await sync_shows():
             SHOW_IDS_TO_PLAY.append(show_id)
 
-        while len(SHOW_IDS_TO_PLAY):
-            show_id = SHOW_IDS_TO_PLAY.popleft()
-            show = get_show(show_id)
-            if show is None:
-                log.info(f"show id {show_id} not found, skipping")
+    if not len(SHOW_IDS_TO_PLAY):
+        return None
+
+    show_id = SHOW_IDS_TO_PLAY.popleft()
+    fetch_fresh = show_id in SHOW_IMMEDIATELY_IDS
+    SHOW_IMMEDIATELY_IDS.discard(show_id)
+    return PrerolledShow(show_id, fetch_fresh)
+
+
+async def play(show, preempted_at=None):
+    first_frame = True
+    current_frame = None
+    suppressed_before = DISPLAY_FRAMES.get("suppressed")
+    try:
+        async for frame in show:
+            now = time.monotonic()
+            if frame is None:
+                # a tick without a new frame: the compositor might still have
+                # something new to show (a transition going on, the clock)
+                if current_frame is not None and COMPOSITOR.needs_redraw(now):
+                    send_frame_to_display(COMPOSITOR.compose(current_frame, now))
+                elif (
+                    LAST_SENT_FRAME is not None
+                    and now - LAST_SENT_AT >= DISPLAY_MAX_HOLD_S
+                ):
+                    # keep-alive, nothing was sent for a while
+                    send_frame_to_display(LAST_SENT_FRAME, force=True)
+                elif DO_NOT_SEND_TO_RITER:
+                    # a frame the terminal skipped for SIMULATOR_MAX_FPS
+                    TERMINAL_DISPLAY.catch_up()
                 continue
 
-            for frame in receive_frames_from_renderer(
-                show["show_type"], json_payload=show["payload"]
-            ):
-                send_frame_to_display(frame)
+            if COMPOSITOR.active:
+                if first_frame:
+                    COMPOSITOR.start_transition(now)
+                current_frame = to_canvas(frame)
+                frame = COMPOSITOR.compose(current_frame, now)
+            send_frame_to_display(frame)
+
+            if first_frame and preempted_at is not None:
+                latency_s = time.monotonic() - preempted_at
+                PREEMPTION_SECONDS.observe(latency_s)
+                log.info(
+                    f"show_immediately: first frame of show id {show.show_id} "
+                    f"{latency_s * 1000:.1f} ms after the event"
+                )
+            first_frame = False
+    finally:
+        suppressed = DISPLAY_FRAMES.get("suppressed") - suppressed_before
+        if suppressed:
+            log.info(
+                f"show id {show.show_id}: {suppressed} identical frames not resent "
+                f"({suppressed * frame_encoder.FRAME_SIZE * len(DISPLAYS)} bytes saved)"
+            )
 
-                if SHOW_IMMEDIATELY_FLAG.is_set():
-                    log.info("SHOW_IMMEDIATELY_FLAG set, breaking out of current show")
-                    SHOW_IMMEDIATELY_FLAG.clear()
-                    break
-        time.sleep(1)
 
+async def worker():
+    global PLAYING_TASK
 
-if __name__ == "__main__":
-    thread = threading.Thread(target=consume_server_side_events)
-    thread.start()
+    upcoming = None
+    preempted_at = None
+    while True:
+        if (
+            upcoming is not None
+            and SHOW_IMMEDIATELY_AT is not None
+            and upcoming.created_at < SHOW_IMMEDIATELY_AT
+        ):
+            # a show_immediately came in after the next show was pre-rolled:
+            # the show to play immediately was pushed to the front of the
+            # deque, the pre-rolled show goes right after it. (one pre-rolled
+            # after the event *is* the show to play immediately)
+            upcoming.cancel()
+            SHOW_IDS_TO_PLAY.insert(1, upcoming.show_id)
+            if upcoming.fetch_fresh:
+                SHOW_IMMEDIATELY_IDS.add(upcoming.show_id)
+            upcoming = None
+            preempted_at = preempted_at or SHOW_IMMEDIATELY_AT
+
+        current = upcoming or await preroll_next_show()
+        upcoming = None
+        if current is None:
+            continue
+
+        # the current show is playing (i.e. it can be cancelled by
+        # show_immediately) before we wait for anything else
+        PLAYING_TASK = asyncio.create_task(play(current, preempted_at))
+        preempted_at = None
+        # start fetching + rendering the next show right away, while the
+        # current one plays
+        next_show = asyncio.create_task(preroll_next_show())
+        try:
+            await PLAYING_TASK
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # we're being shut down, not preempted
+                next_show.cancel()
+                raise
+
+            # show_immediately cancelled the current show. no need to wait for
+            # the playlist, the show to play immediately is at the front of
+            # the deque (a pre-rolled show is put after it at the top of the
+            # loop)
+            current.cancel()
+            next_show.cancel()
+            preempted_at = SHOW_IMMEDIATELY_AT
+            log.info(
+                "show_immediately: current show stopped "
+                f"{(time.monotonic() - preempted_at) * 1000:.1f} ms after the event"
+            )
+        finally:
+            PLAYING_TASK = None
+            current.cancel()
+
+        try:
+            upcoming = await next_show
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # cancelled for show_immediately, see above
+            upcoming = None
+
+
+async def main():
+    global HTTP_CLIENT, RECORDER
 
-    worker()
+    # docker stop (and systemd) send SIGTERM: everything gets cancelled, so
+    # that the finally below still runs, i.e. the recording is closed properly
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
+
+    if RECORD_DIR:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        RECORDER = show_bundle.BundleRecorder(
+            RECORD_DIR, {"displays": DISPLAY_TILES}, CANVAS_WIDTH, CANVAS_HEIGHT
+        )
+
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            RENDERER_READ_TIMEOUT_S, connect=RENDERER_CONNECT_TIMEOUT_S
+        ),
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60),
+    ) as HTTP_CLIENT:
+        try:
+            await asyncio.gather(
+                consume_server_side_events(),
+                worker(),
+                metrics.serve(),
+                renderer_health.probe_forever(HTTP_CLIENT, RENDERER_HOSTS),
+            )
+        finally:
+            if TERMINAL_DISPLAY is not None:
+                TERMINAL_DISPLAY.close()
+            if RECORDER is not None:
+                RECORDER.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        log.info("stopped")